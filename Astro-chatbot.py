@@ -3,17 +3,42 @@
 # 
 # To run this bot, open a terminal with python 3.8+ 
 # and type: python3 Astro-chatbot.py
+# (add --preload to load everything before the greeting
+# instead of in the background while it is shown)
 # 
 # To read more documentation on this bot, check out 
 # the Github page: 
 #
 # =========================================================================================================
 
+import os
 import re
+import sys
 import math
-from collections import defaultdict
-
-dst = defaultdict(list)
+import threading
+import tagger
+import intent
+import tokenizer
+import document
+import qa
+import answer_cache
+import templates
+import policy
+import tracing
+from scheduler import lookup_scheduler
+from session import DialogueSession
+
+# the dialogue state of the conversation in the terminal; other conversations (e.g. from a server) pass
+# their own session to nlu, update_dst, get_dst and dialogue_policy
+dst = DialogueSession("terminal")
+
+# patterns nlu checks the input against, compiled once when the bot starts rather than on every call
+who_am_i_pattern = re.compile(r"([Ww]ho|[Ww]hat) are you[?]")
+yes_pattern = re.compile(r"\b([Yy]es)|([Yy]eah)|([Ss]ure)|([Oo][Kk](ay)?)\b")
+no_pattern = re.compile(r"\b([Nn]o(pe)?)|([Nn]ah)\b")
+goodbye_pattern = re.compile(r"\b((good)?bye|see you|that'?s all|that is all|thanks|thank you)\b", re.IGNORECASE)
+learn_more_pattern = re.compile(r"\b(sources?|where did you (find|get|read)|tell me more|more about that)\b", re.IGNORECASE)
+question_pattern = re.compile(r"[?]\s*$|^\s*(how|what|when|where|which|who|whom|whose|why|is|are|was|were|do|does|did|can|could|will|would|should|has|have)\b", re.IGNORECASE)
 
 # wikisetup
 # prepare to get wiki articles, for now it will just load some that we need but later will wait for user
@@ -27,11 +52,13 @@ def wiki(query):
     pass
 
 # nlu(input): Interprets a natural language input and identifies relevant slots and their values
-# Input: A string of text.
+# Input: A string of text, and optionally the DialogueSession of the conversation it belongs to.
 # Returns: A list ([]) of (slot, value) pairs.  Slots should be strings; values can be whatever is most
 #          appropriate for the corresponding slot.  If no slot values are extracted, the function should
 #          return an empty list.
-def nlu(input=""):
+@tracing.traced("nlu")
+def nlu(input="", session=None):
+    state = session if session is not None else dst
     slots_and_values = []
 
     # at first, this will just look up against a few articles hosted on the machine, to get this out as asap as possible
@@ -40,14 +67,14 @@ def nlu(input=""):
     # thread to lookup results online.
     user_intent = ""
 
-    # possible dialogue_state_history values are:
-    # 'greetings','who_am_i','prompt_user','question','thinking','answer','check_correctness','off_topic','source','find_out_more','cool_fact','unsure_answer','forbidden_speech','goodbye'
-    # possible user_intent_history values are:
-    # 'greetings','question','statement','unknown','learn_more','inappropriate_speech','goodbye'
+    # possible dialogue_state_history values are policy.states:
+    # 'greetings','who_am_i','question','thinking','check_correctness','answer','sources','no_sources','off_topic','inappropriate_speech','terminate'
+    # possible user_intent_history values are policy.intents:
+    # 'greetings','who_am_i','question','statement','unknown','respond_yes','respond_no','learn_more','inappropriate_speech','goodbye'
     
     # if there's no dialouge_state_history, then this is likely 'greetings' and the bot
     # should start from the beginnning state
-    if "dialouge_state_history" not in dst:
+    if "dialogue_state_history" not in state:
         user_intent = "greetings"
         slots_and_values.append(("user_intent_history", ["greetings"]))
 
@@ -57,27 +84,41 @@ def nlu(input=""):
     
     # To narrow the set of expected slots, you may (optionally) first want to determine the user's intent,
     # based on what the chatbot said most recently.
-    if "dialogue_state_history" in dst:
-        if dst["dialogue_state_history"][0] == "greetings":
+    if "dialogue_state_history" in state:
+        if state["dialogue_state_history"][0] == "greetings":
             # Check to see if the input matches any of the pre-defined states.
-            pattern = re.compile(r"([Ww]ho|[Ww]hat) are you[?]")
-            match = re.search(pattern, input)
+            match = who_am_i_pattern.search(input)
             if match:
                 user_intent = "who_am_i"
                 slots_and_values.append(("user_intent_history", ["who_am_i"]))
+            elif goodbye_pattern.search(input):
+                user_intent = "goodbye"
+                slots_and_values.append(("user_intent_history", ["goodbye"]))
+            elif question_pattern.search(input):
+                user_intent = "question"
+                slots_and_values.append(("user_intent_history", ["question"]))
             else:
                 user_intent = "unknown"
                 slots_and_values.append(("user_intent_history", ["unknown"]))
+        elif goodbye_pattern.search(input):
+            user_intent = "goodbye"
+            slots_and_values.append(("user_intent_history", ["goodbye"]))
+        elif learn_more_pattern.search(input):
+            # "where did you find that?" asks for the sources rather than being a new question
+            user_intent = "learn_more"
+            slots_and_values.append(("user_intent_history", ["learn_more"]))
+        elif question_pattern.search(input):
+            # A question is a question whatever the bot said last, even if it contains "no" or "ok"
+            user_intent = "question"
+            slots_and_values.append(("user_intent_history", ["question"]))
         else:
             # Check to see if the user entered "yes" or "no."
-            yes_pattern = re.compile(r"\b([Yy]es)|([Yy]eah)|([Ss]ure)|([Oo][Kk](ay)?)\b")
-            match = re.search(yes_pattern, input)
+            match = yes_pattern.search(input)
             if match:
                 user_intent = "respond_yes"
                 slots_and_values.append(("user_intent_history", ["respond_yes"]))
             else:
-                no_pattern = re.compile(r"\b([Nn]o(pe)?)|([Nn]ah)\b")
-                match = re.search(no_pattern, input)
+                match = no_pattern.search(input)
                 if match:
                     user_intent = "respond_no"
                     slots_and_values.append(("user_intent_history", ["respond_no"]))
@@ -90,6 +131,15 @@ def nlu(input=""):
     
     # Then, based on what type of user intent you think the user had, you can determine which slot values
     # to try to extract.
+    if user_intent == "question":
+        # The classifier is trained on the question keywords csv, and tells which article (Intent) and
+        # which part of it (Subtopic) the question is about
+        topic, subtopic, confidence = intent.classify(input)
+        slots_and_values.append(("question", input))
+        slots_and_values.append(("intent", topic))
+        slots_and_values.append(("subtopic", subtopic))
+        slots_and_values.append(("intent_confidence", confidence))
+
     if user_intent == "respond_size":
         # In our sample chatbot, there's only one slot value we'd want to extract if we thought the user
         # was responding with a pizza size.
@@ -116,34 +166,26 @@ def nlu(input=""):
 
 # update_dst(input): Updates the dialogue state tracker
 # Input: A list ([]) of (slot, value) pairs.  Slots should be strings; values can be whatever is
-#        most appropriate for the corresponding slot.  Defaults to an empty list.
+#        most appropriate for the corresponding slot.  Defaults to an empty list.  Optionally, the
+#        DialogueSession to update instead of the terminal's.
 # Returns: Nothing
-def update_dst(input=[]):
-    global dst
-    for slot, value in input:
-        if slot in dst and isinstance(dst[slot], list):
-            if isinstance(value, list):
-                for val in value:
-                    dst[slot].insert(0, val)
-            else:
-                dst[slot].insert(0, value)
-        else:
-            dst[slot] = value
+def update_dst(input=[], session=None):
+    (session if session is not None else dst).update(input)
     return
 
 # get_dst(slot): Retrieves the stored value for the specified slot, or the full dialogue state at the
 #                current time if no argument is provided.
-# Input: A string value corresponding to a slot name.
-# Returns: A dictionary representation of the full dialogue state (if no slot name is provided), or the
+# Input: A string value corresponding to a slot name, and optionally the DialogueSession to read.
+# Returns: A dictionary-like representation of the full dialogue state (if no slot name is provided), or the
 #          value corresponding to the specified slot.
-def get_dst(slot=""):
-    global dst
+def get_dst(slot="", session=None):
+    state = session if session is not None else dst
     if slot != "":
         try:
-            return dst[slot]
+            return state[slot]
         except KeyError as ERR:
             pass
-    return dst
+    return state
 
 
 # dialogue_policy(dst): Selects the next dialogue state to be uttered by the chatbot.
@@ -155,134 +197,189 @@ def get_dst(slot=""):
 # TODO: Look into user intents/slot values
 #https://towardsdatascience.com/natural-language-understanding-with-sequence-to-sequence-models-e87d41ad258b
 #https://towardsdatascience.com/representing-text-in-natural-language-processing-1eead30e57d8
-def dialogue_policy(dst=[]):
-    next_state = "greetings"
-    slot_values = []
-    
-    if len(dst) == 0:
-        next_state = "greetings"
-    elif dst["dialogue_state_history"][0] == "greetings":
-        next_state = "question"
-    elif dst["dialogue_state_history"][0] == "question" and dst["user_intent_history"][0] == "question":
-        next_state = "thinking"
-    elif dst["dialogue_state_history"][0] == "question" and dst["user_intent_history"][0] == "statement":
-        next_state = "check_correctness"
-        # slot values here will re-state the statement and then determine if it is true/false with the same lookup as a question
-        # type: string
-        slot_values = []
-    elif dst["dialogue_state_history"][0] == "question" and dst["user_intent_history"][0] == "unknown":
-        next_state = "off_topic"
-        # slot values here will ask for clarification and restate what the user said
-        # type: string
-        slot_values = []
-    elif dst["dialogue_state_history"][0] == "thinking":
-        next_state = "answer"
-    elif dst["dialogue_state_history"][0] == "answer" or dst["dialogue_state_history"][0] == "check_correctness" or dst["dialogue_state_history"][0] == "off_topic" and dst["user_intent_history"][0] == "more_info":
-        next_state = "sources"
-        # slot values here will be the sources, with a snippet about each one
-        # these sources are taken from the fetch algorithm, not here, so this will stay empty here
-        # type: list of strings
-        slot_values = [] 
-    elif dst["dialogue_state_history"][0] == "answer" or dst["dialogue_state_history"][0] == "check_correctness" or dst["dialogue_state_history"][0] == "off_topic" and dst["user_intent_history"][0] == "thanks":
-        next_state = "terminate"
-    elif dst["dialogue_state_history"][0] == "answer" or dst["dialogue_state_history"][0] == "check_correctness" or dst["dialogue_state_history"][0] == "off_topic":
-        next_state = "question"
-    else:
-        pass
-
-    
-    update_dst([("dialogue_state_history", [next_state])])
+def dialogue_policy(dst=None):
+    if dst is None:
+        dst = get_dst()
+    # the transitions are a table in policy.py, looked up by what the bot said last and what the user meant
+    states = dst.get("dialogue_state_history")
+    intents = dst.get("user_intent_history")
+    next_state = policy.default.next_state(states[0] if states else None, intents[0] if intents else "unknown", dst)
+    slot_values = policy.default.slot_values(next_state, dst)
+    update_dst([("dialogue_state_history", [next_state])], dst)
     return next_state, slot_values
-	
+
+# the bot's sentences for each dialogue state; a slot in angle brackets (e.g. <answer>) is filled in from the
+# policy's slot values, see templates.py for the rest of the syntax
+default_templates = {
+    "greetings": ["Hello, I am a robot that can find the answer to any question you have about space.",
+                  "Greetings, earthling. I'm a robot that knows things about the cosmos."],
+    "who_am_i": ["I'm Astro-chatter, a robot that looks up the answers to your questions about space."],
+    "question": ["What would you like to know about space?",
+                 "Ask me anything about the cosmos!"],
+    "thinking": ["Let me look that up...",
+                 "Hmm, let me think about that."],
+    "answer": ["<answer>"],
+    "check_correctness": ["Let me check whether that's right."],
+    "off_topic": ["I'm not sure I understood. Could you ask me a question about space?"],
+    "sources": ["I found that on Wikipedia, in the <count:article/articles> <sources>.",
+                "That came from the Wikipedia <count:article/articles> <sources>."],
+    "no_sources": ["I couldn't find a source for that."],
+    "inappropriate_speech": ["That's not very appropriate.",
+                             "Could you phrase that differently?",
+                             "Don't be rude."],
+    "terminate": ["Alrighty, come back if there's anything else you're curious about!",
+                  "I hope I helped you find what you're looking for! Stay curious."],
+}
+
+# the templates are compiled once, when the bot starts. They can be replaced without touching the code by a
+# json file of {state: [template, ...]} at data/templates.json (or wherever ASTRO_TEMPLATES points).
+templates_path = os.environ.get("ASTRO_TEMPLATES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "templates.json"))
+responses = templates.load(templates_path) if os.path.exists(templates_path) else templates.template_table(default_templates)
+
 # nlg(state, slots=[]): Generates a surface realization for the specified dialogue act.
 # Input: A string indicating a valid state, and optionally a list of (slot, value) tuples.
 # Returns: A string representing a sentence generated for the specified state, optionally
-#          including the specified slot values if they are needed by the template.
+#          including the specified slot values if they are needed by the template. One of the state's
+#          templates is picked at random.
+@tracing.traced("nlg")
 def nlg(state, slots=[]):
-    # non-answer results can be pre-generated:
-    #'greetings','question','statement','unknown','learn_more','inappropriate_speech','goodbye'
-    templates = defaultdict(list)
-    
-    templates["greetings"] = []
-    templates["greetings"].append("Hello, I am a robot that can find the answer to any question you have about space.")
-    templates["greetings"].append("Greetings, earthling. I'm a robot that knows things about the cosmos.")
+    return responses.render(state, slots)
 
-    templates["inappropriate_speech"].append("That's not very appropriate.")
-    templates["inappropriate_speech"].append("Could you phrase that differently?")
-    templates["inappropriate_speech"].append("Don't be rude.")
 
-    templates["terminate"] = []
-    templates["terminate"].append("Alrighty, come back if there's anything else you're curious about!")
-    templates["terminate"].append("I hope I helped you find what you're looking for! Stay curious.")
-    
-    # When you implement this for real, you'll need to randomly select one of the templates for
-    # the specified state, rather than always selecting template 0.  You probably also will not
-    # want to rely on hardcoded input slot positions (e.g., slots[0][1]).  Optionally, you might
-    # want to include logic that handles a/an and singular/plural terms, to make your chatbot's
-    # output more natural (e.g., avoiding "did you say you want 1 pizzas?").
-    output = ""
-    if len(slots) > 0:
-        output = templates[state][0].replace("<num_pizzas>", str(slots[0][1]))
-    else:
-        output = templates[state][0]
-    return output
-
-
-# parse will assign the part of speech to each word in the input, using the Veterbi algorithm
+# parse will assign the part of speech to each word in the input, using the Viterbi algorithm
 # then filter unnessesary words to get the response slot values and appropriate lookup string
+# Returns: A list of (word, tag) pairs, with tags from the universal tagset (NOUN, VERB, ADJ, ...)
+@tracing.traced("parse")
 def parse(input=""):
-    #TODO: implement veterbi algorithm (log-based)
-    # Veterbi is a dynamic programming approach to assigning part-of-speech
-    # labels to words. This implementation is based on the Pseudocode found here:
+    # Viterbi is a dynamic programming approach to assigning part-of-speech
+    # labels to words. The log-space implementation is in tagger.py, based on the Pseudocode found here:
     # https://web.stanford.edu/~jurafsky/slp3/8.pdf#subsection.8.4.5
 
-    # split input into observations (i.e. split into words, removing punctuation)
-    res = Veterbi()
-
     # TODO: investigate wordnet & implement it in data folder
     # https://www.youtube.com/watch?v=2IHA8QgKwbw
-    def Veterbi(observations,state_matrix,emission_matrix,trans_prob=None):
-        # Parameters:
-        # observations      array(T,): observation state sequence, int dtype.
-        # state_matrix      array(K,K): state transition matrix, an HMM
-        # emission_matrix   array(K,M): emisson matrix, based on the HMM probabilites
-        # trans_prob        Optional; array(K,): initial state probailities, trans_prob[i] is the probability
-        #                                        x[0] == i. If None, uniform initial distribution is assumed: 
-        #                                        trans_prob[:] == 1/K
-
-        # Returns:
-
-
-        # Create a path probability matrix Viterbi[N,T]
-        V = [{}]
-        # Cardinality of the state sequence
-        K = len(observations)
-        # Set up the backpointer matrix:
-        B = [{}]
-        # see trans_prob above for explanation: [1/k] * K makes a 1D array size K filled with values of 1/K
-        trans_prob = trans_prob if trans_prob is not None else [1/K] * K
-        # it's 1-K, but 1+k here becuase of how range() works
-        for state in range(1,K):
-            # multiply trans_prob by emission_matrix at state
-            V[0][state] = {trans_prob[state]*emission_matrix[state]}
-        for observation in range(1, len(observations)):
-            for state in range(len(state_matrix)):
-                pass
-        pass
+
+    # split input into observations (i.e. split into words, keeping punctuation as its own observation)
+    words = tagger.split_words(input)
+    return list(zip(words, tagger.default_tagger().tag(words)))
+
+# parse_batch does the same as parse for many inputs at once, tagging them all in one batch
+def parse_batch(inputs=[]):
+    sentences = [tagger.split_words(input) for input in inputs]
+    return [list(zip(words, tags)) for words, tags in zip(sentences, tagger.default_tagger().tag_batch(sentences))]
 
 # lookup will take a question(string) and will look up results on wikipedia, gather results,
 # and then parse through them to find an answer; then, if the user was looking for an answer
 # will respond with the relevant answer and source(s); if the user said a statement and wanted
 # confirmation, will respond with either yes, the statement is accurate, or not it is not,
 # with the same info as if answering a question and source(s)
+# Returns: (answer, score, sources), or None if no answer was found. The answer is the best matching sentence
+#          of the articles read so far (see qa.py), after reading the article the question is classified into.
+#          Answers are cached, so a question asked before (or one very much like it) is answered straight away.
+@tracing.traced("lookup", profile=True)
 def lookup(question=""):
-    pass
+    # the question is tokenized and its features computed once, for the classifier and the answer cache
+    words = tokenizer.chunk_terms(question)
+    features = intent.word_features(words)
+    topic, subtopic, confidence = intent.default_classifier().classify_features(*features)
+    asked = answer_cache.prepare(question, features, words) if answers is not None else None
+    if answers is not None:
+        cached = answers.get(asked, topic, subtopic)
+        if cached is not None:
+            tracing.count("lookup.cache_hit")
+            return cached
+    engine = qa.default_engine()
+    if topic not in looked_up and topic not in ("None", "Other"):
+        item = document.get_from_wiki(topic)
+        # an article that couldn't be fetched (e.g. the network is down) is tried again by the next lookup
+        if item is not None:
+            engine.add(item)
+            looked_up.add(topic)
+    result = engine.answer(question, topic)
+    tracing.count("lookup.answered" if result is not None else "lookup.unanswered")
+    if result is not None and answers is not None:
+        answers.put(asked, topic, subtopic, result)
+    return result
+
+# the answers lookup has found, kept across restarts in the file ASTRO_ANSWER_CACHE names (if set); None turns
+# the cache off
+answers = answer_cache.persistent(os.environ["ASTRO_ANSWER_CACHE"]) if os.environ.get("ASTRO_ANSWER_CACHE") else answer_cache.answer_cache()
+
+# intents whose article has been read into the answer engine
+looked_up = set()
+
+# lookups run here in the background, so the bot can say it's thinking straight away
+lookups = None
+
+def get_lookups():
+    global lookups
+    if lookups is None:
+        # the lambda looks lookup up at call time, so it can be replaced (e.g. by a benchmark)
+        lookups = lookup_scheduler(lambda question: lookup(question))
+    return lookups
+
+no_answer = "Sorry, I couldn't find an answer to that one."
+
+# start_lookup(session): Submits the lookup of the question in the session to the background workers.
+# Returns: a concurrent.futures.Future of the lookup's result.
+def start_lookup(session=None):
+    state = session if session is not None else dst
+    return get_lookups().submit(state.get("question", ""))
+
+# store_answer(result, session): Stores the result of a lookup (or the fallback answer if it is None) for the
+#                                answer state.
+def store_answer(result, session=None):
+    state = session if session is not None else dst
+    if result:
+        text, score, sources = result
+        update_dst([("answer", text), ("answer_score", score), ("sources", sources)], state)
+    else:
+        update_dst([("answer", no_answer), ("answer_score", 0.0), ("sources", [])], state)
+
+# find_answer(session): Looks up the answer to the question in the session and waits for it (up to the
+#                       scheduler's timeout), then stores the answer (and its sources) for the answer state.
+def find_answer(session=None):
+    state = session if session is not None else dst
+    question = state.get("question", "")
+    store_answer(get_lookups().result(question, start_lookup(state)), state)
+
+# warm_up(): Loads what the first turns need (the tagger, the intent classifier, the answer engine and, if the
+#            bot may go online, the wikipedia package), which would otherwise be loaded by the first turn that
+#            uses each of them.
+def warm_up():
+    with tracing.span("warm_up"):
+        tagger.default_tagger()
+        intent.default_classifier()
+        qa.default_engine()
+        if not document.offline:
+            import wikipedia
+
+warming = None
+
+# start_warm_up(): Runs warm_up on a background thread (once), so it happens while the user reads the
+#                  greeting. A turn that needs something still loading waits for it.
+def start_warm_up():
+    global warming
+    if warming is None:
+        warming = threading.Thread(target=quiet_warm_up, name="warm-up", daemon=True)
+        warming.start()
+    return warming
+
+def quiet_warm_up():
+    try:
+        warm_up()
+    except Exception:
+        # whatever failed is loaded again by the turn that needs it, which reports the error
+        pass
 
 
 # Use this main function to test your code when running it from a terminal
 # Eventually will have a function to place it in a website that can be called
 
 def main():
+    # With --preload everything is loaded before the greeting; otherwise it loads in the background after it.
+    preload = "--preload" in sys.argv[1:]
+    if preload:
+        warm_up()
     
     # You can choose whether your chatbot or the participant will make the first dialogue utterance.
     # In the sample here, the chatbot makes the first utterance.
@@ -290,6 +387,8 @@ def main():
     next_state, slot_values = dialogue_policy(current_state_tracker)
     output = nlg(next_state, slot_values)
     print(output)
+    if not preload:
+        start_warm_up()
     
     # With our first utterance complete, we'll enter a loop for the rest of the dialogue.  In some cases,
     # especially if the participant makes the first utterance, you can enter this loop directly without
@@ -315,6 +414,12 @@ def main():
         
         # Print the output to the terminal.
         print(output)
+
+        # While thinking, look up the answer and then give it without waiting for more input.
+        if next_state in policy.lookup_states:
+            find_answer()
+            next_state, slot_values = dialogue_policy(get_dst())
+            print(nlg(next_state, slot_values))
         
 
 
@@ -0,0 +1,233 @@
+import os
+import json
+import time
+import math
+import atexit
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+import intent
+import tokenizer
+
+# Answer cache
+# Most questions people ask are asked over and over, in slightly different words ("how long does it take to
+# get to mars", "how long would it take to get to mars"). The cache sits in front of lookup and answers
+# those without retrieving anything. Entries are grouped by the (Intent, Subtopic) the classifier gives the
+# question, and a question is found in two ways:
+#
+#   exact       its normalized form is the same: case, apostrophes and stop words dropped and the remaining
+#               words sorted, so "which layer of the atmosphere is the coldest" and "which is the coldest
+#               layer of the atmosphere" are the same question
+#   similar     the hashed features of the classifier (words, word pairs and character trigrams) of a question
+#               in the same (Intent, Subtopic) have a cosine similarity of at least threshold with it, and it
+#               has the same question words and negations
+#
+# Question words and negations are stop words, but they change what is asked: "who was the first person on
+# the moon" and "when was the first person on the moon", or "is there life on mars" and "is there no life on
+# mars", want different answers. So they are kept in the normalized form, and questions that differ in them
+# are never similar.
+#
+# A question is tokenized and hashed into features once per lookup: lookup passes the features the intent
+# classifier already computed to prepare, and get and put take the prepared question. Two questions are compared
+# on the sparse (bucket, weight) arrays of their features (a question has a few dozen), never on dense vectors,
+# and most pairs don't get that far: the number of buckets they share bounds their similarity (see bound), and
+# a pair sharing too few to reach threshold is passed over on that count alone.
+#
+# The threshold is high on purpose: "how big is the international space station" and "how old is the
+# international space station" already have a similarity of 0.89, and must not share an answer.
+#
+# Entries are evicted least recently used first beyond max_entries, and expire ttl seconds after they were
+# stored. The cache can be saved to a json file and loaded back, so a restart doesn't start from cold.
+
+# stop words kept in the normalized form of a question (see above), with the one they are kept as: "which
+# planet has no atmosphere" and "what planet has no atmosphere" are the same question
+kept_words = {"what": "what", "which": "what", "who": "who", "whom": "who", "whose": "whose", "when": "when",
+              "where": "where", "why": "why", "how": "how", "no": "no", "nor": "not", "not": "not"}
+
+question_words = frozenset(kept_words.values())
+
+# terms(question, words): The words of question that count for its normalized form (see above), from the
+#                         tokenizer terms of question if they are given.
+def terms(question, words=None):
+    words = tokenizer.tokens(question) if words is None else words
+    return set(kept_words.get(term, term) for term in words if term not in tokenizer.stop_set or term in kept_words)
+
+def normalize(question):
+    return " ".join(sorted(terms(question)))
+
+# a question as the cache looks it up: its text, normalized form, question words and negations, and the
+# buckets and weights of its features
+class prepared:
+    __slots__ = ("text", "normalized", "kept", "buckets", "weights", "bucket_keys", "least")
+
+    def __init__(self, text, normalized, kept, buckets, weights):
+        self.text = text
+        self.normalized = normalized
+        self.kept = kept
+        self.buckets = buckets
+        self.weights = weights
+        self.bucket_keys = None
+        self.least = 0.0
+
+    # bucket_set(): The buckets as a set, with the smallest squared weight in least, made the first time a bound
+    #               needs them; a question found exactly, or with nothing in its (Intent, Subtopic) to compare
+    #               with, never does.
+    def bucket_set(self):
+        if self.bucket_keys is None:
+            weights = self.weights.tolist()
+            self.least = min(weights) ** 2 if weights else 0.0
+            self.bucket_keys = frozenset(self.buckets.tolist())
+        return self.bucket_keys
+
+# prepare(question, features, words): The prepared form of question, with its intent.features and tokenizer
+#                                     terms if they have already been computed.
+def prepare(question, features=None, words=None):
+    if isinstance(question, prepared):
+        return question
+    buckets, weights = features if features is not None else intent.features(question)
+    words = terms(question, words)
+    return prepared(question, " ".join(sorted(words)), frozenset(words & question_words), buckets, weights)
+
+# similarity(a, b): The cosine similarity of two prepared questions, whose weights are unit length.
+def similarity(a, b):
+    shared, left, right = np.intersect1d(a.buckets, b.buckets, assume_unique=True, return_indices=True)
+    return float(a.weights[left] @ b.weights[right])
+
+# bound(a, b): An upper bound of similarity(a, b) from the number of buckets a and b share. Each bucket of a
+#              that b doesn't have takes at least a.least off the part of a's squared weights that can count
+#              (and the same for b), so a pair sharing few buckets is ruled out without multiplying weights.
+def bound(a, b):
+    shared = len(a.bucket_set() & b.bucket_set())
+    left = 1.0 - (len(a.buckets) - shared) * a.least
+    right = 1.0 - (len(b.buckets) - shared) * b.least
+    return math.sqrt(left * right) if left > 0 and right > 0 else 0.0
+
+class answer_cache:
+    # max_entries   most answers kept
+    # ttl           seconds an answer is kept after it was stored, None to keep answers until evicted
+    # threshold     least similarity for a question to share the answer of another in its (Intent, Subtopic)
+    def __init__(self, max_entries=10000, ttl=24*60*60, threshold=0.9):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        # (intent, subtopic, normalized question) -> entry, least recently used first
+        self.entries = OrderedDict()
+        # (intent, subtopic) -> {key: entry}, the entries a similar question is looked for in
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    # get(question, topic, subtopic): The cached answer to question (a string, or prepared), classified as
+    #                                 (topic, subtopic), or None.
+    def get(self, question, topic, subtopic, now=None):
+        now = time.time() if now is None else now
+        question = prepare(question)
+        key = (topic, subtopic, question.normalized)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.fresh(entry, now):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry["answer"]
+            entry = self.similar(question, (topic, subtopic), now)
+            if entry is not None:
+                self.entries.move_to_end(entry["key"])
+                self.similar_hits += 1
+                return entry["answer"]
+            self.misses += 1
+            return None
+
+    def fresh(self, entry, now):
+        if self.ttl is None or now - entry["stored"] <= self.ttl:
+            return True
+        self.remove(entry["key"])
+        self.expired += 1
+        return False
+
+    # similar(question, bucket, now): The most similar fresh entry of bucket, if it is similar enough.
+    def similar(self, question, bucket, now):
+        # the bound is computed in floats from float32 weights, so it is allowed to fall short of threshold by a
+        # rounding error
+        least = self.threshold - 1e-6
+        entries = [entry for entry in list(self.buckets.get(bucket, {}).values())
+                   if entry["asked"].kept == question.kept and bound(question, entry["asked"]) >= least and self.fresh(entry, now)]
+        if not entries:
+            return None
+        score, best = max((similarity(question, entry["asked"]), -i) for i, entry in enumerate(entries))
+        return entries[-best] if score >= self.threshold else None
+
+    # put(question, topic, subtopic, answer): Stores the answer to question (a string, or prepared), classified
+    #                                         as (topic, subtopic).
+    def put(self, question, topic, subtopic, answer, now=None):
+        question = prepare(question)
+        key = (topic, subtopic, question.normalized)
+        entry = {"key": key, "question": question.text, "asked": question, "answer": answer,
+                 "stored": time.time() if now is None else now}
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = entry
+            self.buckets.setdefault(key[:2], {})[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.remove(next(iter(self.entries)))
+                self.evicted += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            bucket = self.buckets[key[:2]]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[key[:2]]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+
+    def stats(self):
+        lookups = self.hits + self.similar_hits + self.misses
+        return {"entries": len(self.entries), "hits": self.hits, "similar_hits": self.similar_hits,
+                "misses": self.misses, "evicted": self.evicted, "expired": self.expired,
+                "hit_rate": (self.hits + self.similar_hits) / lookups if lookups else 0.0}
+
+    # save(path): Writes the entries to a json file, least recently used first. Answers must be json values
+    #             (tuples come back as lists).
+    def save(self, path):
+        with self.lock:
+            items = [{"topic": entry["key"][0], "subtopic": entry["key"][1], "question": entry["question"],
+                      "answer": entry["answer"], "stored": entry["stored"]} for entry in self.entries.values()]
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(items, f)
+        os.replace(tmp, path)
+
+    # load(path): Adds the entries of a file written by save, skipping the ones that have expired since.
+    def load(self, path):
+        with open(path) as f:
+            items = json.load(f)
+        now = time.time()
+        for item in items:
+            if self.ttl is None or now - item["stored"] <= self.ttl:
+                self.put(item["question"], item["topic"], item["subtopic"], item["answer"], item["stored"])
+        return self
+
+# persistent(path, ...): A cache that starts from the file at path (if there is one) and is saved back to it
+#                        when the process exits.
+def persistent(path, **settings):
+    cache = answer_cache(**settings)
+    if os.path.exists(path):
+        try:
+            cache.load(path)
+        except (OSError, ValueError, KeyError):
+            pass
+    atexit.register(cache.save, path)
+    return cache
@@ -0,0 +1,700 @@
+import os
+import sys
+import time
+import numpy as np
+
+# Benchmarks
+# Run with: python3 benchmark.py <name> [<name> ...], or with no names to run all of them.
+# Every benchmark prints one line per measurement so the numbers can be compared across commits.
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+# synthetic_documents(n, V, length): n documents of term -> frequency dicts, with terms drawn from a zipf
+#                                    distribution over a vocabulary of V words, like natural text.
+def synthetic_documents(n, V=50000, length=300, seed=0):
+    rng = np.random.default_rng(seed)
+    documents = []
+    for i in range(n):
+        terms, counts = np.unique(np.minimum(rng.zipf(1.3, length), V), return_counts=True)
+        documents.append(dict(zip(("w%d" % term for term in terms), (counts / length).tolist())))
+    return documents
+
+# index: query latency of corpus_index.top_k at 10, 1k and 100k documents
+def bench_index():
+    import index
+    rng = np.random.default_rng(1)
+    for n in (10, 1000, 100000):
+        corpus = index.corpus_index()
+        documents = synthetic_documents(n)
+        start = time.perf_counter()
+        for i, frequencies in enumerate(documents):
+            corpus.add_terms("doc%d" % i, frequencies)
+        corpus.commit()
+        build = time.perf_counter() - start
+        queries = [" ".join("w%d" % term for term in np.minimum(rng.zipf(1.3, 4), 50000)) for i in range(50)]
+        latency = timed(lambda: [corpus.top_k(query, 10) for query in queries], 3) / len(queries)
+        print("index  docs=%-7d build=%8.3fs  top_k=%8.3fms" % (n, build, latency * 1000))
+        # one more document goes into the delta matrix rather than rebuilding the index
+        corpus.add_terms("extra", {"w1": 0.5, "new": 0.5})
+        update = timed(lambda: corpus.top_k("new w1", 10), 1)
+        print("index  docs=%-7d add one document + top_k=%8.3fms" % (n + 1, update * 1000))
+
+# large_article(size): Text of about size bytes, made by repeating the fixture articles.
+def large_article(size):
+    import json
+    import store
+    with open(store.fixture_path) as f:
+        text = "\n\n".join(item["content"] for item in json.load(f))
+    return text * (size // len(text) + 1)
+
+# tokenizer: throughput and memory of document.pre_compute against the old clean() + dict of floats version
+def bench_tokenizer():
+    import re
+    import tracemalloc
+    import tokenizer
+
+    def old_pre_compute(text):
+        mydict = {}
+        total = 0
+        for word in text.split():
+            total += 1
+            cleaned_word = re.sub(r'\W+', '', word)
+            mydict[cleaned_word] = mydict.get(cleaned_word, 0) + 1
+        return {word: float(count) / float(total) for word, count in mydict.items()}
+
+    text = large_article(8 * 1024 * 1024)
+    megabytes = len(text) / (1024 * 1024)
+    for name, function in (("old dict", old_pre_compute), ("tokenizer", tokenizer.count)):
+        seconds = timed(lambda: function(text), 1)
+        tracemalloc.start()
+        result = function(text)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        if isinstance(result, dict):
+            stored = sys.getsizeof(result) + sum(sys.getsizeof(value) for value in result.values())
+        else:
+            stored = result[0].nbytes + result[1].nbytes
+        print("tokenizer  %-9s %6.1fMB/s  peak=%7.2fMB  stored counts=%8.1fKB" % (name, megabytes / seconds, peak / 1e6, stored / 1024))
+
+# fixture_sentences(): The sentences of the fixture articles as lists of terms.
+def fixture_sentences():
+    import json
+    import re
+    import store
+    import tokenizer
+    with open(store.fixture_path) as f:
+        text = " ".join(item["content"] for item in json.load(f))
+    return [list(tokenizer.tokens(sentence)) for sentence in re.split(r"[.?!]\s", text)]
+
+# word2vec: time per epoch of the one-hot train loop against the minibatch train_batch on the fixture corpus
+def bench_word2vec():
+    import word2vec
+    sentences = fixture_sentences() * 10
+    words = sorted({word for sentence in sentences for word in sentence})
+    model = word2vec.word2vec()
+    model.initialize(len(words), words)
+    centers, contexts = model.skipgram_pairs(sentences)
+    pairs = len(centers)
+    # the one-hot loop is far too slow for the whole corpus, so time a sample and scale it up
+    sample = 200
+    model.X_train = [[int(i == center) for i in range(model.V)] for center in centers[:sample]]
+    model.y_train = [[int(i == context) for i in range(model.V)] for context in contexts[:sample]]
+    old = timed(lambda: model.train(2), 1) / sample * pairs
+    print("word2vec  V=%d pairs=%d" % (model.V, pairs))
+    print("word2vec  one-hot train      %9.2fs/epoch (estimated from %d pairs)" % (old, sample))
+    for batch_size in (32, 128, 512):
+        model.initialize(len(words), words)
+        model.skipgram_pairs(sentences)
+        new = timed(lambda: model.train_batch(1, batch_size, verbose=False), 3)
+        print("word2vec  train_batch %4d    %9.2fs/epoch  speedup=%.0fx" % (batch_size, new, old / new))
+
+# topic_sentences(topics, words_per_topic, n): Sentences that each use the words of one topic plus some words
+#                                            shared by all topics, so good embeddings put a topic's words
+#                                            next to each other.
+def topic_sentences(topics, words_per_topic, n, length=8, seed=0):
+    rng = np.random.default_rng(seed)
+    shared = ["the", "of", "is", "a", "and", "in"]
+    sentences = []
+    for i in range(n):
+        topic = rng.integers(topics)
+        words = ["t%d_%d" % (topic, word) for word in rng.zipf(1.5, length) % words_per_topic]
+        for position in rng.integers(length, size=2):
+            words[position] = shared[rng.integers(len(shared))]
+        sentences.append(words)
+    return sentences
+
+# neighbour_quality(model, k): How many of the k nearest neighbours of each topic word share its topic.
+def neighbour_quality(model, k=5):
+    vectors = model.W / np.linalg.norm(model.W, axis=1, keepdims=True)
+    topics = np.array([word.split("_")[0] for word in model.words])
+    similarity = vectors @ vectors.T
+    np.fill_diagonal(similarity, -np.inf)
+    neighbours = np.argpartition(-similarity, k, axis=1)[:, :k]
+    topic_words = np.char.startswith(topics, "t")
+    return float(np.mean(topics[neighbours][topic_words] == topics[topic_words][:, None]))
+
+# objectives: throughput and neighbour quality of the softmax, negative sampling and hierarchical objectives
+def bench_objectives():
+    import word2vec
+    for topics in (20, 200):
+        sentences = topic_sentences(topics, 50, 2000 + topics * 20)
+        for objective, alpha in (("softmax", 0.01), ("negative", 0.025), ("hierarchical", 0.025)):
+            np.random.seed(0)
+            model = word2vec.word2vec()
+            model.N = 50
+            model.alpha = alpha
+            model.objective = objective
+            words = sorted({word for sentence in sentences for word in sentence})
+            model.initialize(len(words), words)
+            model.W *= 0.1 / model.N
+            model.skipgram_pairs(sentences)
+            seconds = timed(lambda: model.train_batch(2, 256, verbose=False), 1)
+            print("objectives  V=%-6d %-12s %9.0f pairs/s  neighbour quality=%.2f" % (model.V, objective, 2 * len(model.centers) / seconds, neighbour_quality(model)))
+
+# parallel: vocabulary building and Hogwild training throughput with 1, 2, 4 and 8 worker processes
+def bench_parallel():
+    import os
+    import tempfile
+    import word2vec
+    # read_sentences only keeps letters, so spell the topic words with letters only
+    letters = str.maketrans("0123456789_", "abcdefghijx")
+    sentences = topic_sentences(200, 50, 40000)
+    directory = tempfile.mkdtemp(prefix="astro-corpus-")
+    file_names = []
+    for i in range(16):
+        file_names.append(os.path.join(directory, "part%d.txt" % i))
+        with open(file_names[-1], "w") as f:
+            f.write(". ".join(" ".join(sentence) for sentence in sentences[i::16]).translate(letters))
+    print("parallel  %d files, %d sentences, %d cpus" % (len(file_names), len(sentences), os.cpu_count()))
+    for workers in (1, 2, 4, 8):
+        vocabulary = timed(lambda: word2vec.build_vocabulary(file_names, 5, workers), 1)
+        start = time.perf_counter()
+        model = word2vec.train_parallel(file_names, workers, epochs=1, N=50)
+        seconds = time.perf_counter() - start
+        print("parallel  workers=%d  vocabulary=%6.2fs  train=%6.2fs  %8.0f pairs/s  loss/pair=%.3f" % (workers, vocabulary, seconds, model.pairs / seconds, model.loss / model.pairs))
+
+# similar: most_similar and most_similar_batch against the one-hot predict, and loading a saved model
+def bench_similar():
+    import tempfile
+    import word2vec
+    np.random.seed(0)
+    model = word2vec.word2vec()
+    model.N = 100
+    model.initialize(50000, ["w%d" % i for i in range(50000)])
+    queries = ["w%d" % i for i in np.random.randint(50000, size=100)]
+
+    def old_predict(word, num_predictions):
+        X = [0 for i in range(model.V)]
+        X[model.word_index[word]] = 1
+        prediction = model.feed_forward(X)
+        output = {}
+        for i in range(model.V):
+            output[prediction[i][0]] = i
+        return [model.words[output[k]] for k in sorted(output, reverse=True)[:num_predictions + 1]]
+
+    print("similar  V=%d N=%d" % (model.V, model.N))
+    print("similar  one-hot predict      %8.3fms/word" % (timed(lambda: old_predict(queries[0], 10), 3) * 1000))
+    print("similar  predict              %8.3fms/word" % (timed(lambda: model.predict(queries[0], 10), 20) * 1000))
+    model.vectors()
+    print("similar  most_similar         %8.3fms/word" % (timed(lambda: [model.most_similar(word, 10) for word in queries], 3) * 1000 / len(queries)))
+    print("similar  most_similar_batch   %8.3fms/word" % (timed(lambda: model.most_similar_batch(queries, 10), 3) * 1000 / len(queries)))
+    path = tempfile.mkdtemp(prefix="astro-model-")
+    model.save(path)
+    print("similar  load (memory-mapped) %8.3fms" % (timed(lambda: word2vec.load(path), 5) * 1000))
+    print("similar  load (read in full)  %8.3fms" % (timed(lambda: word2vec.load(path, None), 5) * 1000))
+    loaded = word2vec.load(path)
+    print("similar  first query after memory-mapped load %8.3fms" % (timed(lambda: loaded.most_similar(queries[0], 10), 1) * 1000))
+
+# tagger: accuracy of the HMM tagger on held out sentences of the bundled corpus, and tokens/s tagging one
+#         sentence at a time against tagging in batches
+def bench_tagger():
+    import tagger
+    sentences = tagger.read_corpus()
+    correct = total = 0
+    for fold in range(5):
+        test = sentences[fold::5]
+        model = tagger.hmm_tagger().train([sentence for i, sentence in enumerate(sentences) if i % 5 != fold])
+        predicted = model.tag_batch([[word for word, tag in sentence] for sentence in test])
+        for sentence, tags in zip(test, predicted):
+            correct += sum(tag == guess for (word, tag), guess in zip(sentence, tags))
+            total += len(sentence)
+    print("tagger  5-fold held out accuracy=%.3f over %d tokens" % (correct / total, total))
+    model = tagger.default_tagger()
+    words = [[word for word, tag in sentence] for sentence in sentences] * 10
+    tokens = sum(len(sentence) for sentence in words)
+    single = timed(lambda: [model.tag(sentence) for sentence in words], 3)
+    print("tagger  one sentence at a time  %9.0f tokens/s" % (tokens / single))
+    for batch_size in (32, 256):
+        batched = timed(lambda: [model.tag_batch(words[i:i + batch_size]) for i in range(0, len(words), batch_size)], 3)
+        print("tagger  batches of %-4d         %9.0f tokens/s" % (batch_size, tokens / batched))
+
+# intent: 5-fold accuracy of the intent classifier on the question keywords csv, and latency per utterance
+def bench_intent():
+    import importlib
+    import intent
+    rows = intent.read_questions()
+    intents = subtopics = 0
+    for fold in range(5):
+        model = intent.intent_classifier().train([row for i, row in enumerate(rows) if i % 5 != fold])
+        for question, topic, subtopic in rows[fold::5]:
+            guess = model.classify(question)
+            intents += guess[0] == topic
+            subtopics += guess[:2] == (topic, subtopic)
+    print("intent  5-fold accuracy: intent=%.3f intent+subtopic=%.3f over %d questions" % (intents / len(rows), subtopics / len(rows), len(rows)))
+    model = intent.default_classifier()
+    print("intent  load model file   %8.3fms" % (timed(lambda: intent.intent_classifier().load(), 5) * 1000))
+    questions = [question for question, topic, subtopic in rows]
+    print("intent  classify          %8.3fms/utterance" % (timed(lambda: [model.classify(question) for question in questions], 3) * 1000 / len(questions)))
+    chatbot = importlib.import_module("Astro-chatbot")
+    chatbot.dst["dialogue_state_history"] = ["question"]
+    print("intent  nlu (with parse)  %8.3fms/utterance" % (timed(lambda: [chatbot.nlu(question) for question in questions], 3) * 1000 / len(questions)))
+
+# session: cost of a turn's dst update with the old global lists against DialogueSession, memory per session,
+#          and the session manager with tens of thousands of sessions
+def bench_session():
+    import tracemalloc
+    from collections import defaultdict
+    import session
+
+    def old_update(dst, input):
+        for slot, value in input:
+            if slot in dst and isinstance(dst[slot], list):
+                for val in value:
+                    dst[slot].insert(0, val)
+            else:
+                dst[slot] = value
+
+    # a fresh list every turn, since the old update_dst keeps the first list it is given and inserts into it
+    def turn():
+        return [("user_intent_history", ["question"]), ("dialogue_state_history", ["thinking"])]
+
+    for turns in (1000, 100000):
+        old = defaultdict(list)
+        old_seconds = timed(lambda: [old_update(old, turn()) for i in range(turns)], 1)
+        new = session.DialogueSession()
+        new_seconds = timed(lambda: [new.update(turn()) for i in range(turns)], 1)
+        print("session  %6d turns: global dst %7.2fus/turn (%d entries kept)  DialogueSession %5.2fus/turn (%d kept)" % (turns, old_seconds / turns * 1e6, len(old["dialogue_state_history"]), new_seconds / turns * 1e6, len(new.dialogue_state_history)))
+    count = 50000
+    tracemalloc.start()
+    manager = session.SessionManager(idle_timeout=60, max_sessions=count)
+    for i in range(count):
+        manager.get("user%d" % i).update(turn() * 5)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("session  %d sessions with 5 turns each: %.0f bytes/session" % (count, size / count))
+    ids = ["user%d" % i for i in np.random.default_rng(0).integers(count, size=100000)]
+    print("session  manager.get with %d sessions: %.2fus" % (len(manager), timed(lambda: [manager.get(session_id) for session_id in ids], 1) / len(ids) * 1e6))
+    start = time.perf_counter()
+    dropped = manager.evict(time.monotonic() + 120)
+    print("session  evicting %d idle sessions: %.1fms" % (dropped, (time.perf_counter() - start) * 1000))
+
+# simulated_users(users, questions, ...): Has users talk to a chat server at once through the line protocol,
+#                                         each saying hello, asking one of questions and asking for the sources.
+#                                         lookup is replaced by a sleep of lookup_seconds.
+# Returns: (first, whole, seconds, stats): milliseconds until the first reply and until the end of each turn,
+#          as a turns x users array each, the wall time and the lookup scheduler's counters.
+def simulated_users(users, questions, workers=64, lookup_seconds=0.05, timeout=10.0):
+    import asyncio
+    import server
+
+    def slow_lookup(question=""):
+        time.sleep(lookup_seconds)
+        return ("An answer.", 1.0, [])
+
+    async def user(port, question, first, whole):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=64 * 1024)
+        await reader.readuntil(b"\n\n")
+        # hello -> asked for a question, the question -> thinking and the answer, yes -> the sources
+        for turn, line in enumerate(("hello", question, "yes")):
+            start = time.perf_counter()
+            writer.write(line.encode() + b"\n")
+            await reader.readline()
+            first[turn].append(time.perf_counter() - start)
+            while await reader.readline() != b"\n":
+                pass
+            whole[turn].append(time.perf_counter() - start)
+        writer.close()
+
+    async def run():
+        chat = server.chat_server(workers=workers, timeout=timeout)
+        listening = (await chat.start(port=0, http_port=None))[0]
+        port = listening.sockets[0].getsockname()[1]
+        first, whole = [[], [], []], [[], [], []]
+        start = time.perf_counter()
+        await asyncio.gather(*(user(port, questions[i % len(questions)], first, whole) for i in range(users)))
+        seconds = time.perf_counter() - start
+        listening.close()
+        chat.lookups.shutdown()
+        return np.array(first) * 1000, np.array(whole) * 1000, seconds, chat.lookups.stats()
+
+    lookup = server.chatbot.lookup
+    server.chatbot.lookup = slow_lookup
+    try:
+        # load the tagger and intent model before timing anything
+        server.chatbot.nlu("how far is mars?", server.chatbot.DialogueSession())
+        return asyncio.run(run())
+    finally:
+        server.chatbot.lookup = lookup
+
+# server: p50/p99 latency of a turn through the line protocol with 1, 100 and 1000 users talking to the
+#         server at once. lookup is replaced by a 50ms sleep, the time a fetch of a cached article might take,
+#         so the numbers show whether slow lookups hold up the other users' turns.
+def bench_server():
+    for users in (1, 100, 1000):
+        first, whole, seconds, stats = simulated_users(users, ["how far is mars from earth? (%d)" % i for i in range(users)])
+        print("server  %4d users: p50 %7.1fms  p99 %7.1fms  %6.0f turns/s" % (users, np.percentile(whole, 50), np.percentile(whole, 99), whole.size / seconds))
+
+# lookup: time to the first reply (the bot saying it's thinking) against time to the answer, for the turns that
+#         ask a question, with 8 lookup workers and a 200ms lookup. The questions come from the keywords csv, so
+#         popular ones are asked by many users at once and share a lookup.
+def bench_lookup():
+    import intent
+    questions = [question for question, topic, subtopic in intent.read_questions()]
+    for users in (100, 1000):
+        first, whole, seconds, stats = simulated_users(users, questions, workers=8, lookup_seconds=0.2, timeout=5.0)
+        # every user's second turn is the question
+        first, whole = first[1], whole[1]
+        print("lookup  %4d users: first reply p50 %6.1fms p99 %6.1fms  answer p50 %7.1fms p99 %7.1fms  %d lookups, %d shared, %d expired" % (users, np.percentile(first, 50), np.percentile(first, 99), np.percentile(whole, 50), np.percentile(whole, 99), stats["submitted"], stats["deduplicated"], stats["expired"]))
+
+# qa: latency of answer_engine.answer for the csv questions, on the fixture corpus and on the fixture corpus
+#     padded with synthetic articles to thousands of passages, and how often the answer comes from the article
+#     the csv labels the question with
+def bench_qa():
+    import json
+    import intent
+    import qa
+    import store
+    with open(store.fixture_path) as f:
+        articles = [store.article(**item) for item in json.load(f)]
+    titles = {item.title for item in articles}
+    questions = intent.read_questions()
+    labelled = [(question, topic) for question, topic, subtopic in questions if topic in titles]
+    classifier = intent.default_classifier()
+
+    def run(name, engine, boost=True):
+        engine.commit()
+        latencies = []
+        right = 0
+        for question, topic, subtopic in questions:
+            start = time.perf_counter()
+            result = engine.answer(question, classifier.classify(question)[0] if boost else None)
+            latencies.append(time.perf_counter() - start)
+            right += result is not None and topic in titles and result[2][0] == topic
+        latencies = np.array(latencies) * 1000
+        print("qa  %-22s %5d passages: p50 %6.2fms  p99 %6.2fms  answer from the labelled article %.3f (%d questions)" % (name, len(engine), np.percentile(latencies, 50), np.percentile(latencies, 99), right / len(labelled), len(labelled)))
+
+    engine = qa.answer_engine()
+    start = time.perf_counter()
+    for item in articles:
+        engine.add(item)
+    engine.commit()
+    print("qa  split and index %d articles: %.1fms" % (len(articles), (time.perf_counter() - start) * 1000))
+    run("fixtures", engine, False)
+    run("fixtures + intent", engine)
+    start = time.perf_counter()
+    model = qa.build_model(articles * 20, epochs=3)
+    print("qa  train word2vec on the fixtures: %.1fs" % (time.perf_counter() - start))
+    embedded = qa.answer_engine(model)
+    for item in articles:
+        embedded.add(item)
+    run("fixtures + embeddings", embedded)
+    # synthetic articles of paragraphs of random fixture words, so they share the vocabulary of the questions
+    rng = np.random.default_rng(0)
+    vocabulary = np.array(sorted({word for item in articles for word in item.content.split()}))
+    for item in range(500):
+        paragraphs = [" ".join(rng.choice(vocabulary, 12)) + "." for i in range(10)]
+        paragraphs = [" ".join(paragraphs[i:i + 2]) for i in range(0, 10, 2)]
+        engine.add(store.article("Synthetic %d" % item, "\n\n".join(paragraphs)))
+        embedded.add(store.article("Synthetic %d" % item, "\n\n".join(paragraphs)))
+    run("padded", engine)
+    run("padded + embeddings", embedded)
+
+# cache: the question keywords csv replayed through lookup as a traffic trace, with and without the answer
+#        cache: once in csv order (only rephrased questions can hit), and as 5000 requests drawn with
+#        probability 1/rank, the csv being ordered by how often each question is asked
+def bench_cache():
+    import csv
+    import importlib
+    import answer_cache
+    import document
+    import store
+    document.offline = True
+    document.use_store(store.fixture_store())
+    chatbot = importlib.import_module("Astro-chatbot")
+    with open(store.csv_path, newline="") as f:
+        questions = [row["Most Asked “Space” Question Keywords"].strip() for row in csv.DictReader(f)]
+    ranks = np.arange(1, len(questions) + 1)
+    trace = [questions[i] for i in np.random.default_rng(0).choice(len(questions), 5000, p=(1 / ranks) / (1 / ranks).sum())]
+    # read every article in before timing, so only answering is measured
+    for question in questions:
+        chatbot.lookup(question)
+    cache = chatbot.answers
+    try:
+        for name, requests in (("csv order", questions), ("zipf trace", trace)):
+            # the runs with and without the cache take turns, and the best of each counts, so the difference
+            # isn't lost in the noise of one run
+            uncached = cached = float("inf")
+            for repeat in range(5):
+                chatbot.answers = None
+                uncached = min(uncached, timed(lambda: [chatbot.lookup(question) for question in requests], 1))
+                chatbot.answers = answer_cache.answer_cache()
+                cached = min(cached, timed(lambda: [chatbot.lookup(question) for question in requests], 1))
+            stats = chatbot.answers.stats()
+            print("cache  %-10s %5d requests: hit rate %.3f (%d exact, %d similar)  %.3fms/request uncached, %.3fms cached" % (name, len(requests), stats["hit_rate"], stats["hits"], stats["similar_hits"], uncached * 1000 / len(requests), cached * 1000 / len(requests)))
+    finally:
+        chatbot.answers = cache
+
+# templates: cost of an nlg call with the old nlg, which built its template dict on every call, against the
+#            compiled template table, over a stream of turns like a busy server's
+def bench_templates():
+    import importlib
+    from collections import defaultdict
+    import templates
+    chatbot = importlib.import_module("Astro-chatbot")
+
+    def old_nlg(state, slots=[]):
+        templates = defaultdict(list)
+        for name, texts in chatbot.default_templates.items():
+            templates[name] = []
+            for text in texts:
+                templates[name].append(text)
+        output = templates[state][0]
+        for slot, value in slots:
+            output = output.replace("<" + slot + ">", str(value))
+        return output
+
+    answer = [("answer", "Mars has two small moons, Phobos and Deimos, which may be captured asteroids.")]
+    turns = [("greetings", []), ("question", []), ("thinking", []), ("answer", answer), ("sources", [])] * 20000
+    old = timed(lambda: [old_nlg(state, slots) for state, slots in turns], 1)
+    new = timed(lambda: [chatbot.nlg(state, slots) for state, slots in turns], 1)
+    print("templates  %d turns: old nlg %.2fus/call  compiled %.2fus/call" % (len(turns), old / len(turns) * 1e6, new / len(turns) * 1e6))
+    rotating = templates.template_table({"moons": ["<Topic> has <count> <count:moon/moons>, <a name> among them."]}, "rotate")
+    slots = {"Topic": "Mars", "count": 2, "name": "odd little rock"}
+    print("templates  a/an + plural slots: %.2fus/call" % (timed(lambda: [rotating.render("moons", slots) for i in range(100000)], 1) / 100000 * 1e6))
+
+# policy: dialogue_policy turns per second, the old if/elif chain against the compiled transition table, over
+#         every (state, intent) pair
+def bench_policy():
+    import importlib
+    import policy
+    import session
+    chatbot = importlib.import_module("Astro-chatbot")
+
+    def old_policy(dst):
+        next_state = "greetings"
+        slot_values = []
+        if len(dst) == 0:
+            next_state = "greetings"
+        elif dst["dialogue_state_history"][0] == "greetings":
+            next_state = "question"
+        elif dst["dialogue_state_history"][0] == "question" and dst["user_intent_history"][0] == "question":
+            next_state = "thinking"
+        elif dst["dialogue_state_history"][0] == "question" and dst["user_intent_history"][0] == "statement":
+            next_state = "check_correctness"
+        elif dst["dialogue_state_history"][0] == "question" and dst["user_intent_history"][0] == "unknown":
+            next_state = "off_topic"
+        elif dst["dialogue_state_history"][0] == "thinking":
+            next_state = "answer"
+            slot_values = [("answer", dst.get("answer", ""))]
+        elif dst["dialogue_state_history"][0] == "answer" or dst["dialogue_state_history"][0] == "check_correctness" or dst["dialogue_state_history"][0] == "off_topic" and dst["user_intent_history"][0] == "more_info":
+            next_state = "sources"
+        elif dst["dialogue_state_history"][0] == "answer" or dst["dialogue_state_history"][0] == "check_correctness" or dst["dialogue_state_history"][0] == "off_topic" and dst["user_intent_history"][0] == "thanks":
+            next_state = "terminate"
+        elif dst["dialogue_state_history"][0] == "answer" or dst["dialogue_state_history"][0] == "check_correctness" or dst["dialogue_state_history"][0] == "off_topic":
+            next_state = "question"
+        dst.update([("dialogue_state_history", [next_state])])
+        return next_state, slot_values
+
+    pairs = [(state, intent) for state in policy.states for intent in policy.intents]
+    conversations = []
+    for state, intent in pairs * (20000 // len(pairs)):
+        conversation = session.DialogueSession()
+        conversation.update([("dialogue_state_history", [state]), ("user_intent_history", [intent]), ("sources", ["Mars"])])
+        conversations.append(conversation)
+    reached = {}
+    for name, function in (("if/elif chain", old_policy), ("transition table", chatbot.dialogue_policy)):
+        # every conversation is put back in the same state before each run
+        for conversation, (state, intent) in zip(conversations, pairs * (20000 // len(pairs))):
+            conversation["dialogue_state_history"] = [state]
+        start = time.perf_counter()
+        reached[name] = {function(conversation)[0] for conversation in conversations}
+        seconds = time.perf_counter() - start
+        print("policy  %-16s %8.0f turns/s  %2d of %d states reached" % (name, len(conversations) / seconds, len(reached[name]), len(policy.states)))
+    table = policy.default
+    print("policy  next_state lookup alone: %.3fus" % (timed(lambda: [table.next_state(state, intent) for state, intent in pairs], 200) / len(pairs) * 1e6))
+
+# replay: the scripted conversations of replay.py through nlu, update_dst, dialogue_policy, nlg and lookup, with
+#         the latency of each stage, turns per second and peak memory (python3 replay.py --output/--compare
+#         keeps the report to check later commits against)
+def bench_replay():
+    import replay
+    replay.print_report(replay.run())
+
+# tracing: what the tracing hooks cost on nlg and nlu calls: the undecorated function, traced with tracing
+#          off, and traced with it on; and the whole replay with tracing on, with the snapshot it gives
+def bench_tracing():
+    import importlib
+    import replay
+    import session
+    import tracing
+    chatbot = importlib.import_module("Astro-chatbot")
+    answer = [("answer", "Mars has two small moons, Phobos and Deimos.")]
+    conversation = session.DialogueSession()
+    conversation.update([("dialogue_state_history", ["answer"])])
+    calls = {"nlg": lambda function: [function("answer", answer) for i in range(50000)],
+             "nlu": lambda function: [function("where did you find that?", conversation) for i in range(2000)]}
+    for name, run in calls.items():
+        traced = getattr(chatbot, name)
+        bare = timed(lambda: run(traced.__wrapped__), 3)
+        off = timed(lambda: run(traced), 3)
+        tracing.enable(True)
+        on = timed(lambda: run(traced), 3)
+        tracing.enable(False)
+        count = len(run(lambda *args: None))
+        print("tracing  %s  bare %.3fus  off %.3fus (+%.3f)  on %.3fus (+%.3f)" % (name, bare / count * 1e6, off / count * 1e6,
+              (off - bare) / count * 1e6, on / count * 1e6, (on - bare) / count * 1e6))
+    tracing.reset()
+    off = replay.run(memory=False)
+    tracing.enable(True)
+    on = replay.run(memory=False)
+    tracing.enable(False)
+    print("tracing  replay  off %.0f turns/s  on %.0f turns/s" % (off["turns_per_second"], on["turns_per_second"]))
+    for name, numbers in tracing.snapshot(reset=True)["spans"].items():
+        print("tracing  %-14s n=%-6d mean %8.3fms  p50 %8.3fms  p99 %8.3fms" % (name, numbers["count"], numbers["mean_ms"], numbers["p50_ms"], numbers["p99_ms"]))
+
+# packed: startup time and memory of a process reading a corpus of 1000 articles (the fixtures padded with
+#         synthetic ones) from the article store and tokenizing them, against opening a packed corpus and
+#         taking the pre-computed counts of every article, or of only the 10 a process actually uses. Each is
+#         run in a fresh process; rss is its resident memory at the end, shared the part of it that is pages of
+#         files (the corpus among them), which other processes mapping the same corpus share
+def bench_packed():
+    import json
+    import subprocess
+    import tempfile
+    import packed
+    import store
+    with open(store.fixture_path) as f:
+        articles = [store.article(**item) for item in json.load(f)]
+    # synthetic articles of 3000 words drawn from a zipf distribution over 50000 words, like natural text
+    rng = np.random.default_rng(0)
+    for item in range(1000 - len(articles)):
+        words = ["w%d" % word for word in np.minimum(rng.zipf(1.3, 3000), 50000).tolist()]
+        paragraphs = [" ".join(words[i:i + 100]) + "." for i in range(0, len(words), 100)]
+        articles.append(store.article("Synthetic %d" % item, "\n\n".join(paragraphs)))
+    directory = tempfile.mkdtemp(prefix="astro-packed-")
+    article_store = store.article_store(os.path.join(directory, "store"), ttl=None, max_bytes=None)
+    for item in articles:
+        article_store.put(item)
+    corpus_path = os.path.join(directory, "corpus.pack")
+    start = time.perf_counter()
+    packed.write_corpus(corpus_path, ((item, ()) for item in articles))
+    print("packed  built %d articles in %.2fs: %.1fMB packed, %.1fMB in the store" % (len(articles), time.perf_counter() - start,
+          os.path.getsize(corpus_path) / 1e6, article_store.size / 1e6))
+    common = """
+import os, sys, time, json
+start = time.perf_counter()
+import numpy as np, store, tokenizer, packed
+%s
+seconds = time.perf_counter() - start
+pages = [int(n) * os.sysconf("SC_PAGE_SIZE") for n in open("/proc/self/statm").read().split()]
+print(json.dumps({"seconds": seconds, "rss": pages[1], "shared": pages[2], "terms": len(tokenizer.term_list)}))
+"""
+    ways = {
+        "store + tokenize all": "s = store.article_store(%r, ttl=None, max_bytes=None)\ncounts = [tokenizer.count(s.get(name).content) for name in list(s.index)]",
+        "packed, all counts": "c = packed.packed_corpus(%r)\ncounts = [item.term_counts() for item in c]",
+        "packed, 10 articles": "c = packed.packed_corpus(%r)\ncounts = [c.get(title).term_counts() for title in c.titles[:10]]",
+    }
+    paths = {"store + tokenize all": article_store.path}
+    for name, code in ways.items():
+        script = common % (code % paths.get(name, corpus_path))
+        result = json.loads(subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout)
+        print("packed  %-22s %7.3fs  rss %6.1fMB = private %6.1fMB + shared %6.1fMB  %6d terms interned" % (name, result["seconds"], result["rss"] / 1e6,
+              (result["rss"] - result["shared"]) / 1e6, result["shared"] / 1e6, result["terms"]))
+
+# ingest: time to ingest 20 titles and the pages they link to two links away (about 250 pages of a
+#         synthetic wiki, every request taking 10ms) with 1, 8 and 32 workers, with no rate limit and limited
+#         to 200 requests a second, and with every request failing once before it succeeds
+def bench_ingest():
+    import tempfile
+    import ingest
+    import store
+    rng = np.random.default_rng(0)
+    articles = [store.article("Page %d" % page, "Page %d." % page, links=["Page %d" % link for link in rng.integers(0, 400, 4).tolist()]) for page in range(400)]
+    seeds = ["Page %d" % page for page in range(20)]
+    for workers, rate, failures in ((1, None, 0), (8, None, 0), (32, None, 0), (32, 200.0, 0), (32, None, 1)):
+        wiki = ingest.local_wiki(articles, latency=0.01, failures=failures)
+        target = store.article_store(tempfile.mkdtemp(prefix="astro-ingest-"), ttl=None, max_bytes=None)
+        start = time.perf_counter()
+        stats = ingest.ingester(wiki, target, workers, rate, burst=10, backoff=0.01).run(seeds, depth=2)
+        seconds = time.perf_counter() - start
+        print("ingest  %2d workers, rate %-5s failures %d: %4d pages in %5.2fs (%5.1f pages/s, %d requests, %d retries)" % (workers, rate, failures,
+              stats["stored"], seconds, stats["stored"] / seconds, wiki.requests, stats["retries"]))
+
+# startup: import times, and how long after starting python3 Astro-chatbot.py the greeting is shown and how
+#          long the answer to the first question then takes, with the models loading in the background after
+#          the greeting and with --preload, against the fixture store. The wikipedia import is what the bot
+#          used to pay before its greeting.
+def bench_startup():
+    import subprocess
+    import store
+    here = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, ASTRO_OFFLINE="1", ASTRO_STORE=store.fixture_store().path, PYTHONUNBUFFERED="1")
+
+    def seconds_to_run(script):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", script], check=True, cwd=here, env=environment)
+        return time.perf_counter() - start
+
+    python = seconds_to_run("pass")
+    print("startup  python alone %.0fms" % (python * 1000))
+    for name, script in (("numpy", "import numpy"), ("wikipedia", "import wikipedia"), ("Astro-chatbot", "import importlib; importlib.import_module('Astro-chatbot')")):
+        print("startup  import %-14s %4.0fms" % (name, (seconds_to_run(script) - python) * 1000))
+    for arguments in ([], ["--preload"]):
+        greetings, answers = [], []
+        for run in range(5):
+            start = time.perf_counter()
+            bot = subprocess.Popen([sys.executable, "Astro-chatbot.py"] + arguments, cwd=here, env=environment, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+            bot.stdout.readline()
+            greetings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            bot.stdin.write("how far is mars from earth?\n")
+            bot.stdin.flush()
+            bot.stdout.readline()
+            bot.stdout.readline()
+            answers.append(time.perf_counter() - start)
+            bot.stdin.write("bye\n")
+            bot.stdin.close()
+            bot.wait()
+        print("startup  %-11s greeting after %4.0fms, first answer %4.0fms later (median of 5)" % (" ".join(arguments) or "background", np.median(greetings) * 1000, np.median(answers) * 1000))
+
+benchmarks = {
+    "index": bench_index,
+    "tokenizer": bench_tokenizer,
+    "word2vec": bench_word2vec,
+    "objectives": bench_objectives,
+    "parallel": bench_parallel,
+    "similar": bench_similar,
+    "tagger": bench_tagger,
+    "intent": bench_intent,
+    "session": bench_session,
+    "server": bench_server,
+    "lookup": bench_lookup,
+    "qa": bench_qa,
+    "cache": bench_cache,
+    "templates": bench_templates,
+    "policy": bench_policy,
+    "replay": bench_replay,
+    "tracing": bench_tracing,
+    "packed": bench_packed,
+    "ingest": bench_ingest,
+    "startup": bench_startup,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or benchmarks:
+        benchmarks[name]()
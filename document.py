@@ -1,8 +1,44 @@
+import os
 import re
-import wikipedia
+import numpy as np
+import store
+import ingest
+import tokenizer
+import tracing
 
 documents = []
 
+# Articles are looked up in the local article store before going to wikipedia. With offline set (or the
+# ASTRO_OFFLINE environment variable), nothing is fetched and stale articles are served as they are, so the
+# bot can be replayed against a fixture corpus.
+offline = os.environ.get("ASTRO_OFFLINE", "") not in ("", "0")
+articles = None
+
+def get_store():
+    global articles
+    if articles is None:
+        articles = store.article_store(os.environ.get("ASTRO_STORE", store.default_path))
+    return articles
+
+def use_store(article_store):
+    global articles
+    articles = article_store
+
+# A packed corpus (see packed.py), looked in before the article store: the one ASTRO_CORPUS names, or the one
+# given to use_corpus.
+corpus = None
+
+def get_corpus():
+    global corpus
+    if corpus is None and os.environ.get("ASTRO_CORPUS"):
+        import packed
+        corpus = packed.packed_corpus(os.environ["ASTRO_CORPUS"])
+    return corpus
+
+def use_corpus(packed_corpus):
+    global corpus
+    corpus = packed_corpus
+
 def clean(word):
     return re.sub(r'\W+', '', word)
 
@@ -13,35 +49,36 @@ class document:
     # Computing the term_frequency for a document is a relatively inefficient process. 
     # We must iterate over the entire document to calculate the frequency of a single word. 
     # To make this process more efficient we should pre-compute the term frequencies of a document. 
-    # The initializer should construct a dictionary which maps from terms (string) to their frequency in the document (floats).
-    def pre_compute(self):
-        mydict = {}
+    # The counts are kept as two parallel uint32 arrays, the sorted term ids (from the shared term table in
+    # tokenizer) and how often each occurs, which is a fraction of the size of a dict of floats.
+    # An article from a packed corpus has its counts already, so they are read from the corpus instead.
+    @tracing.traced("pre_compute")
+    def pre_compute(self, remove_stop_words=False):
+        self.terms = np.zeros(0, dtype=np.uint32)
+        self.counts = np.zeros(0, dtype=np.uint32)
         self.total = 0
         if self.wiki is None:
             return None
-        for word in self.wiki.content:
-            self.total += 1
-            cleaned_word = clean(word)
-            if cleaned_word in mydict:
-                mydict[cleaned_word] += 1
-            else:
-                mydict[cleaned_word] = 1
-        self.dict = {}
-        for word in mydict:
-            self.dict[word] = frequency(mydict[word],self.total)
+        if hasattr(self.wiki, "term_counts"):
+            self.terms, self.counts, self.total = self.wiki.term_counts(remove_stop_words)
+            return self
+        self.terms, self.counts, self.total = tokenizer.count(self.wiki.content, remove_stop_words)
         return self
 
+    # dict maps terms (string) to their frequency in the document (floats), built on demand from the arrays
+    @property
+    def dict(self):
+        return {tokenizer.term_list[term]: frequency(count, self.total) for term, count in zip(self.terms.tolist(), self.counts.tolist())}
+
     def term_frequency(self,term):
-        if(term in self.dict):
-            return self.dict[term]
+        term_id = tokenizer.lookup(tokenizer.normalize(term))
+        position = np.searchsorted(self.terms, term_id)
+        if term_id >= 0 and position < len(self.terms) and self.terms[position] == term_id:
+            return frequency(self.counts[position], self.total)
         return 0
         
     def get_words(self):
-        words = []
-        for word in self.dict:
-            if word not in words:
-                words.append(word)
-        return words
+        return [tokenizer.term_list[term] for term in self.terms.tolist()]
 
     def get_name(self):
         return self.name
@@ -51,11 +88,34 @@ class document:
         self.name = name
         self.wiki = get_from_wiki(name)
 
+@tracing.traced("get_from_wiki")
 def get_from_wiki(article_name):
-    # check article exsists, get most relevant, and return it
-    results = wikipedia.search(article_name)
-    for result in results:
-        if(result == article_name):
-            return wikipedia.WikipediaPage(result)
-    return None
-    pass
\ No newline at end of file
+    # check the packed corpus and the local store first, and only go online if the article isn't there (or
+    # has expired)
+    packed_corpus = get_corpus()
+    if packed_corpus is not None:
+        found = packed_corpus.get(article_name)
+        if found is not None:
+            tracing.count("get_from_wiki.packed")
+            return found
+    local = get_store()
+    cached = local.get(article_name, allow_stale=offline)
+    if cached is not None or offline:
+        tracing.count("get_from_wiki.stored" if cached is not None else "get_from_wiki.missing")
+        return cached
+    # the wikipedia package (and requests and BeautifulSoup behind it) takes longer to import than the rest
+    # of the bot, so it is only imported once something has to be fetched
+    import wikipedia
+    # search for the article, fetch the most relevant result (see ingest.best_result), and return it
+    try:
+        result = ingest.best_result(article_name, wikipedia.search(article_name))
+        if result is not None:
+            page = store.from_page(wikipedia.WikipediaPage(result))
+            local.put(page, [article_name])
+            tracing.count("get_from_wiki.fetched")
+            return page
+    except (OSError, wikipedia.exceptions.WikipediaException):
+        pass
+    # the network is down or the article is gone, an expired copy is better than nothing
+    tracing.count("get_from_wiki.failed")
+    return local.get(article_name, allow_stale=True)
@@ -0,0 +1,183 @@
+import numpy as np
+import tokenizer
+
+# Corpus index
+# document.pre_compute gives each document its own term -> frequency dict, which is fine for one article but
+# means answering a query over the corpus would walk every document. The corpus index keeps the whole corpus
+# as one sparse term-document matrix in CSR form with a row per term, i.e. an inverted index:
+#
+#   indptr[t]:indptr[t+1]   the slice of docs/freqs holding the postings of term t
+#   docs                    document id of each posting (int32)
+#   freqs                   term frequency of each posting (float32)
+#
+# Scoring a query is then one sparse matrix-vector product: gather the rows of the query terms, weight them
+# by the query's tf-idf and sum the weights per document with np.bincount.
+#
+# Documents can be added at any time. New postings go into a small delta matrix that is rebuilt when it is
+# queried, and merged into the main matrix once it grows past a quarter of it, so adding documents one at a
+# time costs amortised O(postings) instead of a full rebuild per document.
+#
+# Term ids are the ones from the shared term table in tokenizer, so documents can be added straight from
+# their pre-computed count arrays.
+#
+# The length (number of terms) of every document is kept too, for BM25: frequency * length gives back a
+# term's count in the document, and a term found in a long document counts for less than in a short one.
+
+def empty_matrix():
+    return np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+
+# build_matrix(terms, docs, freqs, V): Builds a term-row CSR matrix from parallel arrays of postings.
+def build_matrix(terms, docs, freqs, V):
+    order = np.argsort(terms, kind="stable")
+    counts = np.bincount(terms, minlength=V)
+    indptr = np.zeros(V + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    return indptr, docs[order], freqs[order]
+
+# matrix_postings(matrix): The inverse of build_matrix, gives back (terms, docs, freqs).
+def matrix_postings(matrix):
+    indptr, docs, freqs = matrix
+    terms = np.repeat(np.arange(len(indptr) - 1, dtype=np.int32), np.diff(indptr))
+    return terms, docs, freqs
+
+class corpus_index:
+    def __init__(self):
+        self.names = []
+        self.lengths = []
+        self.length_array = np.zeros(0, dtype=np.float64)
+        self.df = np.zeros(0, dtype=np.int64)
+        self.main = empty_matrix()
+        self.delta = empty_matrix()
+        self.pending = []
+
+    def __len__(self):
+        return len(self.names)
+
+    # add(doc): Adds a pre-computed document to the index and returns its document id.
+    def add(self, doc):
+        if not hasattr(doc, "terms"):
+            doc.pre_compute()
+        return self.add_counts(doc.get_name(), doc.terms, doc.counts / max(doc.total, 1), doc.total)
+
+    # add_counts(name, terms, freqs, length): Adds a document given as an array of term ids and their
+    #                                         frequencies. length is the number of terms in the document,
+    #                                         by default the sum of freqs.
+    def add_counts(self, name, terms, freqs, length=None):
+        doc_id = len(self.names)
+        self.names.append(name)
+        self.lengths.append(float(np.sum(freqs)) if length is None else float(length))
+        terms = np.asarray(terms, dtype=np.int32)
+        self.pending.append((terms, np.full(len(terms), doc_id, dtype=np.int32), np.asarray(freqs, dtype=np.float32)))
+        return doc_id
+
+    # add_terms(name, frequencies): Adds a document given as a dict of term -> frequency.
+    def add_terms(self, name, frequencies):
+        terms = np.fromiter(map(tokenizer.intern, frequencies), dtype=np.int32, count=len(frequencies))
+        freqs = np.fromiter(frequencies.values(), dtype=np.float32, count=len(frequencies))
+        return self.add_counts(name, terms, freqs)
+
+    # add_postings(names, lengths, terms, docs, freqs): Adds several documents at once, given as the arrays of
+    #                                                  all their postings, docs numbering them from 0.
+    def add_postings(self, names, lengths, terms, docs, freqs):
+        first = len(self.names)
+        self.names.extend(names)
+        self.lengths.extend(float(length) for length in lengths)
+        self.pending.append((np.asarray(terms, dtype=np.int32), np.asarray(docs, dtype=np.int32) + first, np.asarray(freqs, dtype=np.float32)))
+
+    # all_postings(): Every posting in the index, as (terms, docs, freqs) arrays.
+    def all_postings(self):
+        self.commit()
+        return tuple(np.concatenate(parts) for parts in zip(matrix_postings(self.main), matrix_postings(self.delta)))
+
+    def commit(self):
+        if not self.pending:
+            return
+        V = len(tokenizer.term_list)
+        terms, docs, freqs = (np.concatenate(parts) for parts in zip(*self.pending))
+        self.pending = []
+        self.length_array = np.asarray(self.lengths, dtype=np.float64)
+        if len(self.df) < V:
+            self.df = np.concatenate([self.df, np.zeros(V - len(self.df), dtype=np.int64)])
+        self.df += np.bincount(terms, minlength=V)
+        old = matrix_postings(self.delta)
+        terms, docs, freqs = np.concatenate([old[0], terms]), np.concatenate([old[1], docs]), np.concatenate([old[2], freqs])
+        if len(terms) * 4 > len(self.main[1]):
+            old = matrix_postings(self.main)
+            terms, docs, freqs = np.concatenate([old[0], terms]), np.concatenate([old[1], docs]), np.concatenate([old[2], freqs])
+            self.main = build_matrix(terms, docs, freqs, V)
+            self.delta = empty_matrix()
+        else:
+            self.delta = build_matrix(terms, docs, freqs, V)
+
+    # idf(): Smoothed inverse document frequency of every term in the vocabulary.
+    def idf(self):
+        self.commit()
+        return np.log((1 + len(self.names)) / (1 + self.df)) + 1
+
+    def query_vector(self, query):
+        weights = {}
+        for word in tokenizer.tokens(query):
+            term = tokenizer.lookup(word)
+            # terms interned by documents that aren't in this index can't match anything
+            if 0 <= term < len(self.df):
+                weights[term] = weights.get(term, 0) + 1
+        terms = np.fromiter(weights, dtype=np.int64, count=len(weights))
+        counts = np.fromiter(weights.values(), dtype=np.float64, count=len(weights))
+        return terms, counts
+
+    # postings(terms): The postings of the given (in range) term ids in both matrices.
+    # Returns: (which, docs, freqs) arrays with an entry per posting, which being the position in terms of the
+    #          posting's term.
+    def postings(self, terms):
+        self.commit()
+        parts = []
+        for indptr, docs, freqs in (self.main, self.delta):
+            # terms added after this matrix was built have no rows in it
+            present = np.flatnonzero(terms < len(indptr) - 1)
+            starts, ends = indptr[terms[present]], indptr[terms[present] + 1]
+            lengths = ends - starts
+            if lengths.sum() == 0:
+                continue
+            # offsets of every posting in the query rows, without a python loop over postings
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            parts.append((np.repeat(present, lengths), docs[offsets], freqs[offsets]))
+        if not parts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+        return tuple(np.concatenate(part) for part in zip(*parts))
+
+    # scores(query): The tf-idf score of every document for the query, as an array indexed by document id.
+    def scores(self, query):
+        idf = self.idf()
+        terms, counts = self.query_vector(query)
+        weights = counts * idf[terms] if len(terms) else counts
+        which, docs, freqs = self.postings(terms)
+        return np.bincount(docs, weights=weights[which] * freqs, minlength=len(self.names)).astype(np.float64)
+
+    # bm25(query, k1, b): The Okapi BM25 score of every document for the query, as an array indexed by
+    #                     document id. query is a string, or an array of term ids.
+    # k1    how quickly repeating a term stops adding to the score
+    # b     how much a document's length (against the average length) discounts its term counts
+    def bm25(self, query, k1=1.2, b=0.75, remove_stop_words=False):
+        self.commit()
+        if isinstance(query, str):
+            terms = np.fromiter((tokenizer.lookup(word) for word in tokenizer.tokens(query, remove_stop_words)), dtype=np.int64)
+            terms = np.unique(terms[(terms >= 0) & (terms < len(self.df))])
+        else:
+            terms = np.asarray(query, dtype=np.int64)
+        df = self.df[terms]
+        idf = np.log(1 + (len(self.names) - df + 0.5) / (df + 0.5))
+        which, docs, freqs = self.postings(terms)
+        doc_lengths = self.length_array[docs]
+        tf = freqs * doc_lengths
+        norm = k1 * (1 - b + b * doc_lengths / max(self.length_array.mean(), 1e-12))
+        return np.bincount(docs, weights=idf[which] * tf * (k1 + 1) / (tf + norm), minlength=len(self.names))
+
+    # top_k(query, k): The k best matching documents for query as a list of (name, score), best first.
+    def top_k(self, query, k=10):
+        scores = self.scores(query)
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(self.names[i], float(scores[i])) for i in best if scores[i] > 0]
@@ -0,0 +1,267 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import store
+
+# Bulk ingestion
+# Fills the article store with many articles at once: a list of titles (by default every Intent of the
+# question keywords csv), and the pages they link to, to a depth. Fetching is what takes the time, so it
+# runs on a bounded pool of worker threads, with
+#
+#   a rate limit    a token bucket shared by the workers: at most rate requests a second on average, in
+#                   bursts of up to burst, so ingesting doesn't get us throttled
+#   retries         a request that fails with a network error (OSError, which timeouts and requests'
+#                   connection errors are) is retried up to attempts times, with exponential backoff and jitter
+#   a checkpoint    the titles done, not found and failed are written to a json file as the ingestion goes,
+#                   and an ingestion started with the same checkpoint skips the titles it has already done
+#
+# A title whose fetch fails any other way (a parse error on a strange page, say) is recorded as failed with
+# the error, like one that ran out of attempts, and the ingestion carries on with the others.
+#
+# Articles are written to the store from the calling thread as their fetches complete. A title already in
+# the store isn't fetched again, but its links are still followed.
+#
+# A title is looked up with a search, and the best result is fetched: the one whose title is the same as the
+# query (ignoring case and spacing) if there is one, and otherwise the one the search ranked first.
+#
+# The wiki is anything with search(query) -> [titles] and page(title) -> store.article (or None if there is
+# no such page): wikipedia_api for the real one, local_wiki for a stand-in serving a fixed set of articles.
+#
+# Run with: python3 ingest.py [--depth 1] [--workers 8] [--rate 5] [--checkpoint data/ingest.json] [title ...]
+
+default_checkpoint = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "ingest.json")
+
+class wikipedia_api:
+    def search(self, query):
+        import wikipedia
+        try:
+            return wikipedia.search(query)
+        except wikipedia.exceptions.HTTPTimeoutError as error:
+            raise TimeoutError(str(error))
+
+    def page(self, title):
+        import wikipedia
+        try:
+            return store.from_page(wikipedia.page(title, auto_suggest=False))
+        except (wikipedia.exceptions.PageError, wikipedia.exceptions.DisambiguationError):
+            return None
+        except wikipedia.exceptions.HTTPTimeoutError as error:
+            raise TimeoutError(str(error))
+
+class local_wiki:
+    # articles      the articles it serves
+    # latency       seconds every request takes
+    # failures      how many times in a row each request fails with a ConnectionError before it succeeds
+    def __init__(self, articles, latency=0.0, failures=0):
+        self.articles = {store.normalize_title(item.title): item for item in articles}
+        self.latency = latency
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.requests = 0
+
+    def request(self, kind, name):
+        with self.lock:
+            self.requests += 1
+            attempt = self.attempts[(kind, name)] = self.attempts.get((kind, name), 0) + 1
+        if self.latency:
+            time.sleep(self.latency)
+        if attempt <= self.failures:
+            raise ConnectionError("%s %r failed (attempt %d)" % (kind, name, attempt))
+
+    # search(query): The titles containing every word of query, exact matches first.
+    def search(self, query):
+        self.request("search", query)
+        name = store.normalize_title(query)
+        words = name.split()
+        found = [item.title for key, item in self.articles.items() if all(word in key.split() for word in words)]
+        return sorted(found, key=lambda title: store.normalize_title(title) != name)
+
+    def page(self, title):
+        self.request("page", title)
+        return self.articles.get(store.normalize_title(title))
+
+# best_result(query, results): The search result to fetch for query: the one titled query, or the first.
+def best_result(query, results):
+    name = store.normalize_title(query)
+    for result in results:
+        if store.normalize_title(result) == name:
+            return result
+    return results[0] if results else None
+
+class token_bucket:
+    # rate      tokens added a second, None for no limit
+    # burst     most tokens held at once
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # take(): Waits until a token is available, and takes it.
+    def take(self):
+        if self.rate is None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class ingester:
+    # wiki          the wiki to fetch from (see above)
+    # article_store where the articles go
+    # workers       fetches running at once
+    # rate, burst   the rate limit of requests (searches and page fetches), in requests a second
+    # attempts      tries of a request that fails with a network error
+    # backoff       seconds before the first retry; doubled (with jitter) for every retry after it
+    # checkpoint    path of the checkpoint file, None for none
+    def __init__(self, wiki, article_store, workers=8, rate=5.0, burst=5, attempts=4, backoff=0.5, max_backoff=30.0, checkpoint=None):
+        self.wiki = wiki
+        self.article_store = article_store
+        self.workers = workers
+        self.bucket = token_bucket(rate, burst)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.checkpoint = checkpoint
+        self.done = set()
+        self.missing = set()
+        self.failed = {}
+        self.fetched = 0
+        self.stored = 0
+        self.retries = 0
+        self.lock = threading.Lock()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+            self.done = set(state["done"])
+            self.missing = set(state["missing"])
+
+    # request(function, *args): Calls function through the rate limit, retrying network errors with backoff.
+    def request(self, function, *args):
+        for attempt in range(self.attempts):
+            self.bucket.take()
+            try:
+                return function(*args)
+            except OSError:
+                if attempt == self.attempts - 1:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    # fetch(title): Searches for title and fetches the best result. Returns the article, or None.
+    def fetch(self, title):
+        result = best_result(title, self.request(self.wiki.search, title))
+        return self.request(self.wiki.page, result) if result is not None else None
+
+    def save_checkpoint(self):
+        # the store only writes its index every so many puts; a title must not be checkpointed as done before
+        # the index that has its article is on disk
+        self.article_store.flush()
+        if self.checkpoint is None:
+            return
+        state = {"done": sorted(self.done), "missing": sorted(self.missing), "failed": self.failed}
+        directory = os.path.dirname(os.path.abspath(self.checkpoint))
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.checkpoint)
+
+    # run(titles, depth, links_per_page): Ingests titles, and the pages they link to down to depth links away
+    #                                     (following at most links_per_page links of each page, None for all).
+    # Returns: the stats of the ingestion.
+    def run(self, titles, depth=0, links_per_page=None, checkpoint_every=20):
+        seen = set()
+        level = []
+        for title in titles:
+            if store.normalize_title(title) not in seen:
+                seen.add(store.normalize_title(title))
+                level.append(title)
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="ingest") as executor:
+            for distance in range(depth + 1):
+                links = []
+                futures = {}
+                for title in level:
+                    name = store.normalize_title(title)
+                    if name in self.missing:
+                        continue
+                    stored = self.article_store.get(title, allow_stale=True) if name in self.done or title in self.article_store else None
+                    if stored is not None:
+                        self.done.add(name)
+                        links.append(stored.links)
+                    else:
+                        futures[executor.submit(self.fetch, title)] = title
+                for completed, future in enumerate(as_completed(futures), 1):
+                    title = futures[future]
+                    name = store.normalize_title(title)
+                    try:
+                        item = future.result()
+                    except Exception as error:
+                        self.failed[name] = "%s: %s" % (type(error).__name__, error)
+                        continue
+                    self.fetched += 1
+                    if item is None:
+                        self.missing.add(name)
+                    else:
+                        self.article_store.put(item, [title])
+                        self.stored += 1
+                        self.done.add(name)
+                        self.failed.pop(name, None)
+                        links.append(item.links)
+                    if completed % checkpoint_every == 0:
+                        self.save_checkpoint()
+                self.save_checkpoint()
+                if distance == depth:
+                    break
+                level = []
+                for page_links in links:
+                    for link in page_links[:links_per_page]:
+                        if store.normalize_title(link) not in seen:
+                            seen.add(store.normalize_title(link))
+                            level.append(link)
+        return self.stats()
+
+    def stats(self):
+        return {"done": len(self.done), "fetched": self.fetched, "stored": self.stored, "missing": len(self.missing),
+                "failed": len(self.failed), "retries": self.retries}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch many wikipedia articles into the article store")
+    parser.add_argument("titles", nargs="*", help="titles to fetch (default: every Intent of the question keywords csv)")
+    parser.add_argument("--depth", type=int, default=0, help="follow links this many pages away from the titles")
+    parser.add_argument("--links-per-page", type=int, default=20, help="most links of a page followed, 0 for all")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rate", type=float, default=5.0, help="most requests a second")
+    parser.add_argument("--attempts", type=int, default=4, help="tries of a request that fails with a network error")
+    parser.add_argument("--checkpoint", default=default_checkpoint, help="resume from (and record progress in) this file")
+    args = parser.parse_args(argv)
+    import document
+    titles = args.titles or store.csv_intents()
+    start = time.perf_counter()
+    stats = ingester(wikipedia_api(), document.get_store(), args.workers, args.rate, max(1, int(args.rate)), args.attempts,
+                     checkpoint=args.checkpoint).run(titles, args.depth, args.links_per_page or None)
+    print("ingested in %.1fs: %s" % (time.perf_counter() - start, ", ".join("%d %s" % (n, name) for name, n in stats.items())))
+    # index the new articles now, rather than in the first lookup of the next process that starts
+    import qa
+    start = time.perf_counter()
+    engine = qa.stored_engine(document.get_store(), qa.load_model())
+    print("indexed %d passages in %.1fs" % (len(engine), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,140 @@
+import os
+import sys
+import csv
+import zlib
+import threading
+import numpy as np
+import store
+import tokenizer
+
+# Intent classifier
+# Classifies a question into the Intent and Subtopic columns of the question keywords csv (e.g. "how far is
+# mars from earth" -> Mars, Distance). A question is turned into a sparse vector of hashed features (words,
+# pairs of words and the character trigrams of each word, so "astronaut" and "astronauts" still overlap), and
+# the label whose centroid has the highest cosine similarity wins. The subtopic is only chosen among the
+# subtopics of the predicted intent.
+#
+# Training takes a fraction of a second, but the model is still kept in a file (data/intent_model.npz) so a
+# process only loads it once; it is rebuilt from the csv when the file is missing or older than the csv.
+
+model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "intent_model.npz")
+dimensions = 1 << 12
+
+# hash_feature(feature): A stable bucket for a feature string. Python's hash() is salted per process, so it
+#                        can't be used for a model that is saved to disk.
+def hash_feature(feature):
+    return zlib.crc32(feature.encode("utf-8")) & (dimensions - 1)
+
+# features(text): The hashed feature buckets of text and their weights, l2 normalized.
+# Returns: (buckets, weights) arrays, buckets sorted and unique.
+def features(text):
+    return word_features(tokenizer.chunk_terms(text))
+
+# word_features(words): features, for text already split into its (tokenizer) terms.
+def word_features(words):
+    names = ["w:" + word for word in words]
+    names += ["b:" + first + " " + second for first, second in zip(words, words[1:])]
+    for word in words:
+        padded = "<" + word + ">"
+        names += ["c:" + padded[i:i + 3] for i in range(len(padded) - 2)]
+    buckets, counts = np.unique(np.fromiter(map(hash_feature, names), dtype=np.int64, count=len(names)), return_counts=True)
+    weights = counts.astype(np.float32)
+    norm = np.linalg.norm(weights)
+    return buckets, weights / norm if norm else weights
+
+# read_questions(path): The (question, intent, subtopic) rows of the question keywords csv, without duplicates.
+def read_questions(path=store.csv_path):
+    rows = []
+    seen = set()
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            question = row["Most Asked “Space” Question Keywords"].strip()
+            if question and question not in seen:
+                seen.add(question)
+                rows.append((question, row["Intent"].strip(), row["Subtopic"].strip()))
+    return rows
+
+# centroids(vectors, labels): The normalized mean vector of each label, as a dimensions x labels matrix so the
+#                             rows of a question's buckets can be gathered in one go.
+def centroids(vectors, labels):
+    names = sorted(set(labels))
+    index = {name: i for i, name in enumerate(names)}
+    matrix = np.zeros((dimensions, len(names)), dtype=np.float32)
+    for (buckets, weights), label in zip(vectors, labels):
+        matrix[buckets, index[label]] += weights
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=0, keepdims=True), 1e-12)
+    return names, matrix
+
+class intent_classifier:
+    # train(rows): Builds the intent and subtopic centroids from (question, intent, subtopic) rows.
+    def train(self, rows):
+        vectors = [features(question) for question, intent, subtopic in rows]
+        self.intents, self.intent_centroids = centroids(vectors, [intent for question, intent, subtopic in rows])
+        labels = [intent + "/" + subtopic for question, intent, subtopic in rows]
+        names, self.subtopic_centroids = centroids(vectors, labels)
+        self.subtopics = [name.split("/", 1) for name in names]
+        self.subtopic_intents = np.array([self.intents.index(intent) for intent, subtopic in self.subtopics])
+        return self
+
+    def save(self, path=model_path):
+        np.savez_compressed(path, intents=np.array(self.intents), intent_centroids=self.intent_centroids,
+                            subtopics=np.array(["/".join(pair) for pair in self.subtopics]),
+                            subtopic_centroids=self.subtopic_centroids)
+
+    def load(self, path=model_path):
+        with np.load(path) as data:
+            self.intents = data["intents"].tolist()
+            self.intent_centroids = data["intent_centroids"]
+            self.subtopics = [name.split("/", 1) for name in data["subtopics"].tolist()]
+            self.subtopic_centroids = data["subtopic_centroids"]
+        self.subtopic_intents = np.array([self.intents.index(intent) for intent, subtopic in self.subtopics])
+        return self
+
+    # classify(text): The most likely (intent, subtopic, similarity) of text. The subtopic is "" where the csv
+    #                 doesn't give one, and the similarity is the cosine similarity to the intent's centroid.
+    def classify(self, text):
+        return self.classify_features(*features(text))
+
+    # classify_features(buckets, weights): classify, for a question whose features have already been computed.
+    def classify_features(self, buckets, weights):
+        # only the rows of the buckets text actually has are touched
+        scores = weights @ self.intent_centroids[buckets]
+        best = int(scores.argmax())
+        subtopic_scores = weights @ self.subtopic_centroids[buckets]
+        subtopic_scores[self.subtopic_intents != best] = -1
+        return self.intents[best], self.subtopics[int(subtopic_scores.argmax())][1], float(scores[best])
+
+default = None
+default_lock = threading.Lock()
+
+# default_classifier(): The classifier from the model file, built from the csv first if needed. Loaded once
+#                       per process, by whichever thread needs it first.
+def default_classifier():
+    global default
+    if default is None:
+        with default_lock:
+            if default is None:
+                default = load_classifier()
+    return default
+
+def load_classifier():
+    fresh = os.path.exists(model_path) and os.path.getmtime(model_path) >= os.path.getmtime(store.csv_path)
+    if fresh:
+        return intent_classifier().load()
+    classifier = intent_classifier().train(read_questions())
+    try:
+        classifier.save()
+    except OSError:
+        pass
+    return classifier
+
+def classify(text):
+    return default_classifier().classify(text)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        intent_classifier().train(read_questions()).save()
+        print("wrote", model_path)
+    else:
+        print("usage: python intent.py build")
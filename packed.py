@@ -0,0 +1,259 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import tempfile
+from collections import Counter
+import numpy as np
+import store
+import tokenizer
+
+# Packed corpus
+# The article store keeps every article as its own compressed json object, which is read, decompressed and
+# tokenized again by every process that wants it. A packed corpus is the whole prepared corpus in one binary
+# file, built once, with the term counts of every article already computed. It is opened with mmap, so
+# opening it reads next to nothing, the pages of the articles a process actually touches are read in on
+# demand, and any number of worker processes share one copy of it in the page cache.
+#
+# Layout of the file (little-endian, every section aligned to 8 bytes):
+#
+#   magic, version, header length     b"ASTROPK1", uint32, uint64
+#   header                            json: number of documents and terms, the titles, the name -> document
+#                                     map, and the offset, dtype and length of every section below
+#   terms_offsets, terms              the corpus' own term table: term t is terms[terms_offsets[t]:...[t+1]]
+#   doc_offsets                       document d's terms are term_ids[doc_offsets[d]:doc_offsets[d+1]]
+#   term_ids, term_counts             uint32 ids (into the corpus' term table, sorted) and counts
+#   totals                            number of terms in each document
+#   content_offsets, content          the utf-8 text of every document
+#   meta_offsets, meta                json {"url": ..., "links": [...]} of every document
+#
+# The corpus has its own term ids, so it can be built without the running process' term table. A document's
+# ids are mapped to the process-wide ids of tokenizer when it is first used, and only its terms are interned,
+# so the term table grows with what the process reads rather than with the size of the corpus.
+#
+# Articles of a corpus are packed_article views: the title is in the header, and the content, links and
+# counts are only decoded from the map when asked for. document.get_from_wiki looks in the corpus named by
+# ASTRO_CORPUS (or given to document.use_corpus) before the article store, and document.pre_compute takes
+# the counts of a packed article as they are instead of tokenizing its content.
+#
+# Build one from the article store (or a fixture file) with:
+#   python3 packed.py build [data/corpus.pack] [--fixtures data/fixtures/articles.json]
+
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "corpus.pack")
+
+magic = b"ASTROPK1"
+version = 1
+prefix = struct.Struct("<8sIQ")
+
+def aligned(n):
+    return (n + 7) // 8 * 8
+
+# offsets(blobs): The uint64 offsets of a list of byte strings laid end to end, with the total at the end.
+def offsets(blobs):
+    result = np.zeros(len(blobs) + 1, dtype=np.uint64)
+    np.cumsum([len(blob) for blob in blobs], out=result[1:])
+    return result
+
+# write_corpus(path, articles): Writes a packed corpus of articles, given as (article, names) pairs where
+#                               names are the extra titles the article is found by (may be empty).
+# Returns: the number of documents written.
+def write_corpus(path, articles):
+    term_ids = {}
+    names = {}
+    titles = []
+    doc_terms = []
+    doc_counts = []
+    totals = []
+    contents = []
+    metas = []
+    for item, aliases in articles:
+        doc = len(titles)
+        titles.append(item.title)
+        for name in (item.title,) + tuple(aliases):
+            names.setdefault(store.normalize_title(name), doc)
+        counts = Counter(tokenizer.tokens(item.content))
+        ids = np.fromiter((term_ids.setdefault(term, len(term_ids)) for term in counts), dtype=np.uint32, count=len(counts))
+        values = np.fromiter(counts.values(), dtype=np.uint32, count=len(counts))
+        order = np.argsort(ids)
+        doc_terms.append(ids[order])
+        doc_counts.append(values[order])
+        totals.append(int(values.sum()))
+        contents.append(item.content.encode("utf-8"))
+        metas.append(json.dumps({"url": item.url, "links": item.links}).encode("utf-8"))
+    terms = [term.encode("utf-8") for term in term_ids]
+    sections = [
+        ("terms_offsets", offsets(terms)),
+        ("terms", np.frombuffer(b"".join(terms), dtype=np.uint8)),
+        ("doc_offsets", offsets(doc_terms)),
+        ("term_ids", np.concatenate(doc_terms) if doc_terms else np.zeros(0, dtype=np.uint32)),
+        ("term_counts", np.concatenate(doc_counts) if doc_counts else np.zeros(0, dtype=np.uint32)),
+        ("totals", np.array(totals, dtype=np.uint64)),
+        ("content_offsets", offsets(contents)),
+        ("content", np.frombuffer(b"".join(contents), dtype=np.uint8)),
+        ("meta_offsets", offsets(metas)),
+        ("meta", np.frombuffer(b"".join(metas), dtype=np.uint8)),
+    ]
+    header = {"documents": len(titles), "terms": len(terms), "built": time.time(), "titles": titles, "names": names, "sections": {}}
+    # the section offsets depend on the length of the header, which depends on the offsets: lay the sections
+    # out after a header with room to spare, then pad the header to that room
+    room = aligned(len(json.dumps(header)) + 64 * len(sections) + 64)
+    position = aligned(prefix.size + room)
+    for name, array in sections:
+        header["sections"][name] = [position, array.dtype.str, len(array)]
+        position = aligned(position + array.nbytes)
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (room - len(encoded))
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(prefix.pack(magic, version, room))
+        f.write(encoded)
+        for name, array in sections:
+            f.seek(header["sections"][name][0])
+            f.write(array.tobytes())
+        f.truncate(position)
+    os.replace(tmp, path)
+    return len(titles)
+
+class packed_article:
+    __slots__ = ("corpus", "doc", "title")
+
+    def __init__(self, corpus, doc):
+        self.corpus = corpus
+        self.doc = doc
+        self.title = corpus.titles[doc]
+
+    @property
+    def content(self):
+        return self.corpus.text("content", self.doc)
+
+    @property
+    def url(self):
+        return self.corpus.meta(self.doc)["url"]
+
+    @property
+    def links(self):
+        return self.corpus.meta(self.doc)["links"]
+
+    def term_counts(self, remove_stop_words=False):
+        return self.corpus.term_counts(self.doc, remove_stop_words)
+
+    def to_json(self):
+        return {"title": self.title, "url": self.url, "links": self.links, "content": self.content}
+
+class packed_corpus:
+    def __init__(self, path=default_path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        found, file_version, room = prefix.unpack_from(self.map)
+        if found != magic or file_version != version:
+            self.map.close()
+            raise ValueError("%s is not a version %d packed corpus" % (path, version))
+        header = json.loads(self.map[prefix.size:prefix.size + room])
+        self.titles = header["titles"]
+        self.names = header["names"]
+        self.built = header["built"]
+        self.sections = {}
+        for name, (offset, dtype, length) in header["sections"].items():
+            self.sections[name] = np.frombuffer(self.map, dtype=dtype, count=length, offset=offset)
+        # process-wide term id of each of the corpus' terms, -1 until a document using it is read
+        self.remap = np.full(header["terms"], -1, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __contains__(self, title):
+        return store.normalize_title(title) in self.names
+
+    # get(title): The article found by title, as a packed_article, or None.
+    def get(self, title):
+        doc = self.names.get(store.normalize_title(title))
+        return packed_article(self, doc) if doc is not None else None
+
+    def __iter__(self):
+        return (packed_article(self, doc) for doc in range(len(self.titles)))
+
+    def slice(self, name, index):
+        offsets = self.sections[name + "_offsets"]
+        return self.sections[name][int(offsets[index]):int(offsets[index + 1])]
+
+    def text(self, name, index):
+        return self.slice(name, index).tobytes().decode("utf-8")
+
+    def meta(self, doc):
+        return json.loads(self.text("meta", doc))
+
+    def term(self, local):
+        return self.text("terms", local)
+
+    # global_ids(local): The process-wide term ids of an array of the corpus' term ids, interning the ones
+    #                    that haven't been seen yet.
+    def global_ids(self, local):
+        ids = self.remap[local]
+        missing = np.unique(local[ids < 0])
+        if len(missing):
+            self.remap[missing] = [tokenizer.intern(self.term(int(term))) for term in missing]
+            ids = self.remap[local]
+        return ids
+
+    # term_counts(doc, remove_stop_words): The counts of document doc, like tokenizer.count gives them for
+    #                                      its content: (sorted uint32 term ids, uint32 counts, total).
+    def term_counts(self, doc, remove_stop_words=False):
+        start, end = (int(offset) for offset in self.sections["doc_offsets"][doc:doc + 2])
+        ids = self.global_ids(self.sections["term_ids"][start:end].astype(np.int64))
+        counts = self.sections["term_counts"][start:end]
+        total = int(self.sections["totals"][doc])
+        if remove_stop_words:
+            keep = np.fromiter((tokenizer.term_list[term] not in tokenizer.stop_set for term in ids.tolist()), dtype=bool, count=len(ids))
+            ids, counts = ids[keep], counts[keep]
+            total = int(counts.sum())
+        order = np.argsort(ids)
+        return ids[order].astype(np.uint32), counts[order].copy(), total
+
+    def close(self):
+        # the arrays are views of the map, which can't be closed while they exist
+        self.sections = {}
+        self.map.close()
+
+# store_articles(article_store): Every distinct article of an article store with all the titles it is stored
+#                                under, as write_corpus takes them.
+def store_articles(article_store):
+    names = {}
+    with article_store.lock:
+        entries = list(article_store.index.items())
+    for name, entry in entries:
+        names.setdefault(entry["key"], []).append(name)
+    for key, aliases in names.items():
+        item = article_store.get(aliases[0], allow_stale=True)
+        if item is not None:
+            yield item, aliases
+
+# build(path, article_store): Packs every article of an article store (by default the document store).
+def build(path=default_path, article_store=None):
+    if article_store is None:
+        import document
+        article_store = document.get_store()
+    return write_corpus(path, store_articles(article_store))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        arguments = sys.argv[2:]
+        fixtures = None
+        if "--fixtures" in arguments:
+            at = arguments.index("--fixtures")
+            fixtures = arguments[at + 1] if at + 1 < len(arguments) else store.fixture_path
+            del arguments[at:at + 2]
+        path = arguments[0] if arguments else default_path
+        start = time.perf_counter()
+        count = build(path, store.fixture_store(fixtures) if fixtures else None)
+        print("packed %d articles into %s (%.1fMB) in %.1fs" % (count, path, os.path.getsize(path) / 1e6, time.perf_counter() - start))
+    elif len(sys.argv) > 2 and sys.argv[1] == "info":
+        corpus = packed_corpus(sys.argv[2])
+        print("%d articles, %d terms, %d postings, built %s" % (len(corpus), len(corpus.remap), len(corpus.sections["term_ids"]), time.ctime(corpus.built)))
+    else:
+        print("usage: python packed.py build [path] [--fixtures [json]] | info <path>")
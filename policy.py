@@ -0,0 +1,183 @@
+# Dialogue policy
+# The bot's dialogue policy as a table: given the state the bot is in (what it said last) and the intent of
+# what the user said, the table names the state the bot goes to next. The transitions are written as
+# (state, intent, next_state) rows, where "*" as the state matches every state and "*" as the intent matches
+# every intent the state has no row of its own for:
+#
+#   (state, intent)     a transition out of one state
+#   ("*", intent)       an intent that means the same whatever the bot said last (e.g. goodbye)
+#   (state, "*")        where a state goes for any other intent; every state needs one
+#
+# The rows are compiled once into a dict keyed by (state, intent), with the wildcards already expanded, so
+# a turn is one dict lookup however many states and intents there are. Compiling checks the table: every
+# state must have a way out, every transition must go to a known state, and every state must be reachable
+# from the start state, so a typo or a forgotten row fails when the bot starts rather than mid-conversation.
+#
+# A few states only make sense when the conversation has something to say in them: the sources of an answer
+# that wasn't found are an empty list. Those states have a guard, a check of the dst and the state to go to
+# instead when it fails, applied after the table lookup.
+
+# the states the bot can be in, i.e. the things it can say (each has templates in nlg)
+states = ("greetings", "who_am_i", "question", "thinking", "check_correctness", "answer", "sources", "no_sources",
+          "off_topic", "inappropriate_speech", "terminate")
+
+# the intents nlu can recognise in what the user says. nlu doesn't tell statements or inappropriate speech
+# apart yet, so the check_correctness and inappropriate_speech states are in the table but not reached
+intents = ("greetings", "who_am_i", "question", "statement", "unknown", "respond_yes", "respond_no", "learn_more",
+           "inappropriate_speech", "goodbye")
+
+# states in which the bot looks up an answer before saying anything else
+lookup_states = ("thinking", "check_correctness")
+
+transitions = [
+    ("*", "goodbye", "terminate"),
+    ("*", "inappropriate_speech", "inappropriate_speech"),
+
+    ("greetings", "who_am_i", "who_am_i"),
+    ("greetings", "question", "thinking"),
+    ("greetings", "*", "question"),
+
+    ("who_am_i", "question", "thinking"),
+    ("who_am_i", "*", "question"),
+
+    ("question", "question", "thinking"),
+    ("question", "statement", "check_correctness"),
+    ("question", "respond_no", "terminate"),
+    ("question", "*", "off_topic"),
+
+    # the answer is looked up first, so whatever the user said has been dealt with
+    ("thinking", "*", "answer"),
+    ("check_correctness", "*", "answer"),
+
+    ("answer", "learn_more", "sources"),
+    ("answer", "respond_yes", "sources"),
+    ("answer", "question", "thinking"),
+    ("answer", "statement", "check_correctness"),
+    ("answer", "*", "question"),
+
+    ("sources", "question", "thinking"),
+    ("sources", "statement", "check_correctness"),
+    ("sources", "respond_no", "terminate"),
+    ("sources", "*", "question"),
+
+    ("no_sources", "question", "thinking"),
+    ("no_sources", "statement", "check_correctness"),
+    ("no_sources", "respond_no", "terminate"),
+    ("no_sources", "*", "question"),
+
+    ("off_topic", "question", "thinking"),
+    ("off_topic", "statement", "check_correctness"),
+    ("off_topic", "respond_no", "terminate"),
+    ("off_topic", "*", "off_topic"),
+
+    ("inappropriate_speech", "question", "thinking"),
+    ("inappropriate_speech", "*", "question"),
+
+    ("terminate", "*", "terminate"),
+]
+
+# answer_slots(dst), sources_slots(dst): The slot values nlg needs for the answer and sources states.
+def answer_slots(dst):
+    return [("answer", dst.get("answer", ""))]
+
+def sources_slots(dst):
+    sources = list(dst.get("sources", []))
+    names = ", ".join(sources[:-1]) + " and " + sources[-1] if len(sources) > 1 else "".join(sources)
+    return [("sources", names), ("count", len(sources))]
+
+slot_functions = {"answer": answer_slots, "sources": sources_slots}
+
+# the sources state is only said when the answer has sources (see above)
+guards = {"sources": (lambda dst: bool(dst.get("sources")), "no_sources")}
+
+class state_machine:
+    # transitions   (state, intent, next_state) rows, with "*" wildcards as described above
+    # states        every state the machine may be in
+    # start         the state of a conversation that hasn't started yet
+    # slots         {state: function(dst)} giving the slot values of a state, for the states that have any
+    # guards        {state: (function(dst), other_state)}: the state is only gone to when function(dst) is true,
+    #               and other_state instead when it isn't
+    def __init__(self, transitions, states, start, slots=None, intents=(), guards=None):
+        self.states = tuple(states)
+        self.start = start
+        self.slots = dict(slots or {})
+        self.guards = dict(guards or {})
+        self.table, self.defaults = self.compile(transitions, intents)
+        self.validate()
+
+    # compile(transitions, intents): The (state, intent) -> next_state dict and the state -> next_state dict of
+    #                                 each state's "*" row. A state's own rows win over "*" state rows, which win
+    #                                 over its "*" intent row.
+    def compile(self, transitions, intents):
+        specific = {}
+        every_state = {}
+        defaults = {}
+        for state, intent, next_state in transitions:
+            if next_state not in self.states:
+                raise ValueError("transition (%r, %r) goes to unknown state %r" % (state, intent, next_state))
+            if state != "*" and state not in self.states:
+                raise ValueError("transition from unknown state %r" % (state,))
+            if state == "*" and intent == "*":
+                raise ValueError("a transition needs a state or an intent")
+            if state == "*":
+                every_state[intent] = next_state
+            elif intent == "*":
+                defaults[state] = next_state
+            else:
+                specific[(state, intent)] = next_state
+        for state in self.states:
+            if state not in defaults:
+                raise ValueError("state %r has no (%r, '*') transition" % (state, state))
+        table = {}
+        known = set(intents) | set(every_state) | {intent for state, intent in specific}
+        for state in self.states:
+            for intent in known:
+                table[(state, intent)] = specific.get((state, intent), every_state.get(intent, defaults[state]))
+        return table, defaults
+
+    # reachable(): The states that can be reached from the start state.
+    def reachable(self):
+        seen = {self.start}
+        frontier = [self.start]
+        while frontier:
+            state = frontier.pop()
+            next_states = [self.defaults[state]] + [to for (source, intent), to in self.table.items() if source == state]
+            next_states += [self.guards[to][1] for to in next_states if to in self.guards]
+            for next_state in next_states:
+                if next_state not in seen:
+                    seen.add(next_state)
+                    frontier.append(next_state)
+        return seen
+
+    def validate(self):
+        if self.start not in self.states:
+            raise ValueError("unknown start state %r" % (self.start,))
+        for state, (check, other) in self.guards.items():
+            if state not in self.states or other not in self.states:
+                raise ValueError("guard of %r goes to unknown state %r" % (state, other))
+        unreachable = [state for state in self.states if state not in self.reachable()]
+        if unreachable:
+            raise ValueError("states %s can't be reached from %r" % (", ".join(map(repr, unreachable)), self.start))
+
+    # next_state(state, intent, dst): Where the bot goes from state when the user's intent is intent. An intent
+    #                                 the table doesn't know goes to the state's "*" transition. A state of None
+    #                                 (the conversation hasn't started) gives the start state. With a dst, the
+    #                                 guard of the state gone to (if it has one) is checked.
+    def next_state(self, state, intent, dst=None):
+        if state is None:
+            return self.start
+        next_state = self.table.get((state, intent))
+        if next_state is None:
+            next_state = self.defaults[state]
+        if dst is not None and next_state in self.guards:
+            check, other = self.guards[next_state]
+            if not check(dst):
+                return other
+        return next_state
+
+    def slot_values(self, state, dst):
+        function = self.slots.get(state)
+        return function(dst) if function is not None else []
+
+# the bot's policy, compiled when it starts
+default = state_machine(transitions, states, "greetings", slot_functions, intents, guards)
@@ -0,0 +1,395 @@
+import os
+import re
+import sys
+import json
+import time
+import tempfile
+import threading
+import numpy as np
+import index
+import tokenizer
+import tracing
+import word2vec
+
+# Answer extraction
+# Finds the sentence that answers a question in the articles the bot has read. Every article is split into
+# passages (a paragraph, or a piece of one for long paragraphs) and sentences once, when it is added:
+#
+#   passages    a corpus_index with a document per passage, so the passages for a question are one BM25
+#               query over the term ids of the question
+#   sentences   the text of every sentence, its passage, and its terms as a CSR matrix (sentence_indptr,
+#               sentence_terms), so the candidate sentences of the best passages are scored in bulk
+#   vectors     with a word2vec model, the unit length idf-weighted mean embedding of every sentence, to
+#               break ties between sentences that score the same by their words
+#
+# A question is answered by taking the best passages by BM25, scoring every sentence in them by how much of
+# the question's idf weight it contains, and returning the best sentence along with the titles of the articles
+# the passages came from. With a model, a tie for the best score goes to the sentence whose embedding is
+# closest to the question's.
+#
+# Without a model ties go to the first sentence. Build one from the articles in the store with:
+#   python3 qa.py build
+#
+# Splitting and tokenizing every stored article again in every process is what made the first lookup slow, so
+# the engine over the document store is saved next to it (<store>/passages.npz) with the content keys of the
+# articles in it. A process loads that and only adds the articles stored since. Term ids are the process'
+# own, so the file keeps its terms as text and they are interned again on loading. Bring it up to date with
+# the store (ingest.py does so when it is done) with:
+#   python3 qa.py index
+
+model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "word2vec")
+
+heading_pattern = re.compile(r"^\s*=+\s*(.*?)\s*=+\s*$")
+sentence_pattern = re.compile(r"(?<=[.!?])\s+")
+# sections that are lists of links and citations rather than text
+skipped_sections = frozenset(["see also", "references", "external links", "further reading", "notes", "bibliography", "sources", "citations"])
+
+# how much each part counts towards a sentence's score
+overlap_weight = 0.85
+passage_weight = 0.15
+# what the passages of the article a question is classified into have their BM25 scores multiplied by
+topic_boost = 1.5
+
+# split_passages(content, max_words): Splits the text of an article into passages of whole sentences.
+# Returns: a list of (section, sentences) pairs, sentences being a list of strings.
+def split_passages(content, max_words=120):
+    passages = []
+    section = ""
+    for line in content.split("\n"):
+        heading = heading_pattern.match(line)
+        if heading:
+            section = heading.group(1)
+            continue
+        if not line.strip() or section.casefold() in skipped_sections:
+            continue
+        sentences = []
+        words = 0
+        for sentence in sentence_pattern.split(line.strip()):
+            length = len(sentence.split())
+            if sentences and words + length > max_words:
+                passages.append((section, sentences))
+                sentences, words = [], 0
+            sentences.append(sentence)
+            words += length
+        if sentences:
+            passages.append((section, sentences))
+    return passages
+
+class answer_engine:
+    # model             a word2vec model for the sentence embeddings, or None to rank sentences by overlap only
+    # passages_per_question     how many of the best passages have their sentences ranked
+    def __init__(self, model=None, passages_per_question=8):
+        self.model = model
+        self.passages_per_question = passages_per_question
+        self.passages = index.corpus_index()
+        self.titles = set()
+        # content keys of the store articles added (see add_stored)
+        self.keys = set()
+        # whether there is something the last save (or the file loaded) doesn't have
+        self.unsaved = True
+        self.passage_titles = []
+        self.sentences = []
+        self.sentence_passages = []
+        self.passage_sentences = [0]
+        self.sentence_lengths = []
+        self.sentence_term_parts = []
+        self.sentence_indptr = np.zeros(1, dtype=np.int64)
+        self.sentence_terms = np.zeros(0, dtype=np.int64)
+        self.sentence_vectors = None
+        self.dirty = False
+        # lookups run on several threads, and add, commit and answer all use the same arrays
+        self.lock = threading.RLock()
+        # row of each term id in the model's vectors, -1 for terms the model doesn't know
+        self.model_rows = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.passages)
+
+    def __contains__(self, title):
+        return title in self.titles
+
+    # add(item): Splits an article (anything with a title and content) into passages and sentences and adds
+    #            them. An article that was already added is skipped. Returns the number of passages added.
+    def add(self, item):
+        with self.lock:
+            return self.add_article(item)
+
+    def add_article(self, item):
+        if item is None or item.title in self.titles:
+            return 0
+        self.titles.add(item.title)
+        passages = split_passages(item.content)
+        for section, sentences in passages:
+            passage = len(self.passage_titles)
+            self.passage_titles.append(item.title)
+            terms, counts, total = tokenizer.count(" ".join(sentences), True)
+            self.passages.add_counts(item.title, terms, counts / max(total, 1), total)
+            for sentence in sentences:
+                terms = np.unique(np.fromiter(map(tokenizer.intern, tokenizer.tokens(sentence, True)), dtype=np.int64))
+                self.sentences.append(sentence)
+                self.sentence_passages.append(passage)
+                self.sentence_lengths.append(len(terms))
+                self.sentence_term_parts.append(terms)
+            self.passage_sentences.append(len(self.sentences))
+        self.dirty = True
+        return len(passages)
+
+    # add_stored(article_store): Adds every article of an article store that hasn't been added yet.
+    # Returns: the number of articles added.
+    def add_stored(self, article_store):
+        added = 0
+        for name, key in article_store.keys().items():
+            if key in self.keys:
+                continue
+            item = article_store.get(name, allow_stale=True)
+            if item is not None:
+                with self.lock:
+                    self.add_article(item)
+                    self.keys.add(key)
+                added += 1
+                self.unsaved = True
+        return added
+
+    # commit(): Packs the sentences added since the last commit into the sentence arrays.
+    def commit(self):
+        with self.lock:
+            if self.dirty:
+                self.pack()
+
+    def pack(self):
+        self.passages.commit()
+        if self.sentence_term_parts:
+            self.sentence_terms = np.concatenate([self.sentence_terms] + self.sentence_term_parts)
+            self.sentence_indptr = np.concatenate([[0], np.cumsum(self.sentence_lengths)])
+        new = self.sentence_term_parts
+        self.sentence_term_parts = []
+        if self.model is not None:
+            idf = self.idf()
+            self.update_model_rows()
+            vectors = np.stack([self.embed(terms, idf) for terms in new]) if new else np.zeros((0, self.model.N), dtype=np.float32)
+            self.sentence_vectors = vectors if self.sentence_vectors is None else np.concatenate([self.sentence_vectors, vectors])
+        self.passage_sentence_array = np.asarray(self.passage_sentences, dtype=np.int64)
+        self.passage_title_array = np.array(self.passage_titles, dtype=object)
+        self.dirty = False
+
+    # idf(): The BM25 idf of every term in the passage index, also used to weight the words of a sentence.
+    def idf(self):
+        df = self.passages.df
+        return np.log(1 + (len(self.passages) - df + 0.5) / (df + 0.5))
+
+    def update_model_rows(self):
+        start = len(self.model_rows)
+        rows = [self.model.word_index.get(term, -1) for term in tokenizer.term_list[start:]]
+        self.model_rows = np.concatenate([self.model_rows, np.array(rows, dtype=np.int64)])
+
+    # embed(terms, idf): The unit length idf-weighted mean of the embeddings of terms (zeros if the model knows
+    #                    none of them).
+    def embed(self, terms, idf):
+        terms = terms[terms < len(self.model_rows)]
+        rows = self.model_rows[terms]
+        known = rows >= 0
+        vector = idf[terms[known]] @ self.model.vectors()[rows[known]] if known.any() else np.zeros(self.model.N)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).astype(np.float32)
+
+    # answer(question, topic): The sentence that best answers question. The passages of the article titled topic
+    #                          (e.g. the intent classifier's guess), if given, have their scores raised.
+    # Returns: (answer, score, sources) with the score between 0 and 1 and sources the titles of the articles
+    #          the best passages came from, the answer's first; None if no passage shares a word with question.
+    def answer(self, question, topic=None):
+        with self.lock, tracing.span("qa.answer"):
+            self.commit()
+            return self.find(question, topic)
+
+    def find(self, question, topic):
+        terms = np.fromiter((tokenizer.lookup(word) for word in tokenizer.tokens(question, True)), dtype=np.int64)
+        terms = np.unique(terms[(terms >= 0) & (terms < len(self.passages.df))])
+        if len(terms) == 0:
+            return None
+        scores = self.passages.bm25(terms)
+        if topic in self.titles:
+            scores[self.passage_title_array == topic] *= topic_boost
+        best = word2vec.top_indices(scores, self.passages_per_question)
+        best = best[scores[best] > 0]
+        if len(best) == 0:
+            return None
+        # every sentence of the best passages is a candidate
+        starts, ends = self.passage_sentence_array[best], self.passage_sentence_array[best + 1]
+        counts = ends - starts
+        candidates = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        # the idf weight of the question terms each candidate contains, as a fraction of the question's
+        idf = self.idf()
+        lengths = self.sentence_indptr[candidates + 1] - self.sentence_indptr[candidates]
+        offsets = np.repeat(self.sentence_indptr[candidates] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        words = self.sentence_terms[offsets]
+        matched = np.isin(words, terms)
+        owners = np.repeat(np.arange(len(candidates)), lengths)
+        overlap = np.bincount(owners[matched], weights=idf[words[matched]], minlength=len(candidates)) / idf[terms].sum()
+        passage_scores = np.repeat(scores[best] / scores[best[0]], counts)
+        combined = overlap_weight * overlap + passage_weight * passage_scores
+        winner = int(combined.argmax())
+        if self.model is not None and self.sentence_vectors is not None:
+            # the embeddings only pick between the sentences tied for the best score: given any more say than
+            # that, sentences that merely use related words outvote the ones that answer the question
+            tied = np.flatnonzero(combined >= combined[winner] - 1e-9)
+            if len(tied) > 1:
+                self.update_model_rows()
+                similarity = self.sentence_vectors[candidates[tied]] @ self.embed(terms, idf)
+                winner = int(tied[similarity.argmax()])
+        sentence = int(candidates[winner])
+        sources = [self.passage_titles[self.sentence_passages[sentence]]]
+        for passage in best.tolist():
+            if self.passage_titles[passage] not in sources:
+                sources.append(self.passage_titles[passage])
+        return self.sentences[sentence], float(combined[winner]), sources
+
+    # save(path): Writes the engine to one .npz file, replacing it at once so a reader never sees half of one.
+    def save(self, path):
+        with self.lock:
+            self.commit()
+            terms = [term.encode("utf-8") for term in tokenizer.term_list]
+            sentences = [sentence.encode("utf-8") for sentence in self.sentences]
+            passage_terms, passage_docs, passage_freqs = self.passages.all_postings()
+            meta = {"titles": sorted(self.titles), "keys": sorted(self.keys), "passage_titles": self.passage_titles}
+            arrays = {
+                "meta": np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+                "terms_offsets": text_offsets(terms),
+                "terms": np.frombuffer(b"".join(terms), dtype=np.uint8),
+                "sentences_offsets": text_offsets(sentences),
+                "sentences": np.frombuffer(b"".join(sentences), dtype=np.uint8),
+                "passage_lengths": np.asarray(self.passages.lengths, dtype=np.float64),
+                "passage_terms": passage_terms,
+                "passage_docs": passage_docs,
+                "passage_freqs": passage_freqs,
+                "passage_sentences": np.asarray(self.passage_sentences, dtype=np.int64),
+                "sentence_passages": np.asarray(self.sentence_passages, dtype=np.int64),
+                "sentence_indptr": self.sentence_indptr,
+                "sentence_terms": self.sentence_terms,
+            }
+            if self.sentence_vectors is not None:
+                arrays["sentence_vectors"] = self.sentence_vectors
+            directory = os.path.dirname(os.path.abspath(path))
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, path)
+            self.unsaved = False
+
+# text_offsets(blobs): The offsets of a list of byte strings laid end to end, with the total at the end.
+def text_offsets(blobs):
+    result = np.zeros(len(blobs) + 1, dtype=np.int64)
+    np.cumsum([len(blob) for blob in blobs], out=result[1:])
+    return result
+
+def texts(data, offsets):
+    data = data.tobytes()
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+# load_engine(path, model): Reads an engine written by answer_engine.save. The sentence vectors are computed
+#                           again if the file has none, or ones of another size than the model's.
+def load_engine(path, model=None):
+    engine = answer_engine(model)
+    with np.load(path) as saved:
+        meta = json.loads(saved["meta"].tobytes())
+        # the saved term ids -> this process' term ids
+        remap = np.array([tokenizer.intern(term) for term in texts(saved["terms"], saved["terms_offsets"])], dtype=np.int64)
+        engine.titles = set(meta["titles"])
+        engine.keys = set(meta["keys"])
+        engine.passage_titles = meta["passage_titles"]
+        engine.passages.add_postings(meta["passage_titles"], saved["passage_lengths"], remap[saved["passage_terms"]], saved["passage_docs"], saved["passage_freqs"])
+        engine.sentences = texts(saved["sentences"], saved["sentences_offsets"])
+        engine.sentence_passages = saved["sentence_passages"].tolist()
+        engine.passage_sentences = saved["passage_sentences"].tolist()
+        engine.sentence_indptr = saved["sentence_indptr"]
+        engine.sentence_lengths = np.diff(engine.sentence_indptr).tolist()
+        engine.sentence_terms = remap[saved["sentence_terms"]]
+        vectors = saved["sentence_vectors"] if "sentence_vectors" in saved.files else None
+    if model is not None and vectors is not None and vectors.shape != (len(engine.sentences), model.N):
+        vectors = None
+    if model is not None and vectors is None:
+        engine.sentence_term_parts = np.split(engine.sentence_terms, engine.sentence_indptr[1:-1])
+        engine.sentence_terms = np.zeros(0, dtype=np.int64)
+    elif model is not None:
+        engine.sentence_vectors = vectors
+    engine.dirty = True
+    engine.commit()
+    engine.unsaved = model is not None and vectors is None
+    return engine
+
+# build_model(articles, epochs, N): Trains a word2vec model on the sentences of articles, with negative
+#                                   sampling so it stays quick on a few hundred thousand words.
+def build_model(articles, epochs=5, N=50):
+    sentences = []
+    for item in articles:
+        for section, passage in split_passages(item.content):
+            sentences += [list(tokenizer.tokens(sentence, True)) for sentence in passage]
+    return word2vec.train([sentence for sentence in sentences if len(sentence) > 1], epochs, 256, N, "negative")
+
+# stored_articles(article_store): Every distinct article in an article store.
+def stored_articles(article_store):
+    seen = set()
+    for name in article_store.titles():
+        item = article_store.get(name, allow_stale=True)
+        if item is not None and item.title not in seen:
+            seen.add(item.title)
+            yield item
+
+# load_model(): The model at model_path, or None if none has been built.
+def load_model():
+    return word2vec.load(model_path) if os.path.exists(os.path.join(model_path, "model.json")) else None
+
+default = None
+default_lock = threading.Lock()
+
+# index_path(article_store): Where the engine over an article store is saved.
+def index_path(article_store):
+    return os.path.join(article_store.path, "passages.npz")
+
+# stored_engine(article_store, model): The saved engine of an article store (a new one if there is none, or it
+#                                      can't be read), with the articles stored since it was saved added, and
+#                                      saved again if that changed it.
+def stored_engine(article_store, model=None):
+    path = index_path(article_store)
+    engine = None
+    if os.path.exists(path):
+        try:
+            engine = load_engine(path, model)
+        except (OSError, ValueError, KeyError, IndexError):
+            engine = None
+    if engine is None:
+        engine = answer_engine(model)
+    engine.add_stored(article_store)
+    if engine.unsaved:
+        engine.save(path)
+    return engine
+
+# default_engine(): An engine over every article in the document store, with the model from model_path if
+#                   one has been built. Built once per process, by whichever thread needs it first; lookup adds
+#                   articles as they are fetched.
+def default_engine():
+    global default
+    if default is None:
+        with default_lock:
+            if default is None:
+                import document
+                default = stored_engine(document.get_store(), load_model())
+    return default
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        import document
+        build_model(list(stored_articles(document.get_store()))).save(model_path)
+        # the saved engine's sentence vectors are the old model's
+        if os.path.exists(index_path(document.get_store())):
+            os.remove(index_path(document.get_store()))
+        print("wrote", model_path)
+    elif len(sys.argv) > 1 and sys.argv[1] == "index":
+        import document
+        start = time.perf_counter()
+        engine = stored_engine(document.get_store(), load_model())
+        print("indexed %d passages of %d articles in %.1fs" % (len(engine), len(engine.titles), time.perf_counter() - start))
+    elif len(sys.argv) > 1:
+        print(default_engine().answer(" ".join(sys.argv[1:])))
+    else:
+        print("usage: python qa.py build | index | <question>")
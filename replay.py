@@ -0,0 +1,175 @@
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import importlib
+import subprocess
+import tracemalloc
+import document
+import intent
+import policy
+import store
+import tracing
+from session import DialogueSession
+
+# Conversation replay
+# Measures the whole bot end to end: scripted conversations are replayed through nlu, update_dst,
+# dialogue_policy, nlg and lookup exactly as main() runs them, against the fixture article store so nothing
+# is fetched. Every conversation says hello, asks one or two of the questions from the question keywords csv,
+# asks where an answer came from and says goodbye.
+#
+# The time of every call of every stage goes into a histogram (tracing's, so the numbers are the same kind as
+# GET /metrics gives), and the report has the percentiles of each stage, the turns per second, and the peak
+# memory of a second replay under tracemalloc. Reports are json, so the report of one commit can be compared
+# with another's:
+#
+#   python3 replay.py --output before.json
+#   (change something)
+#   python3 replay.py --compare before.json
+#
+# which prints every number side by side and exits with status 1 if something got slower (or bigger) by more
+# than the tolerance.
+
+stages = ("nlu", "update_dst", "dialogue_policy", "nlg", "lookup", "turn")
+
+greetings = ["hi", "hello", "hey there", "good morning"]
+follow_ups = ["where did you find that?", "yes", "tell me more", "ok"]
+goodbyes = ["thanks, bye", "goodbye", "that's all, thank you"]
+
+# conversations(count, seed): Scripts of user turns, one per question of the csv (cycled if count is larger),
+#                             with every third conversation asking a second question.
+def conversations(count=None, seed=0):
+    questions = [question for question, topic, subtopic in intent.read_questions()]
+    count = len(questions) if count is None else count
+    rng = random.Random(seed)
+    scripts = []
+    for i in range(count):
+        script = [rng.choice(greetings), questions[i % len(questions)], rng.choice(follow_ups)]
+        if i % 3 == 2:
+            script += [questions[(i * 7 + 1) % len(questions)]]
+        script.append(rng.choice(goodbyes))
+        scripts.append(script)
+    return scripts
+
+class recorder:
+    def __init__(self):
+        self.histograms = {stage: tracing.histogram() for stage in stages}
+
+    def timed(self, stage, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.histograms[stage].add(time.perf_counter() - start)
+        return result
+
+# replay(chatbot, scripts, record): Runs the scripts through the chatbot's pipeline, timing every stage with
+#                                   record (a recorder, or None). Returns the number of user turns.
+def replay(chatbot, scripts, record=None):
+    timed = record.timed if record is not None else lambda stage, function, *args: function(*args)
+    turns = 0
+    for script in scripts:
+        conversation = DialogueSession()
+        next_state, slot_values = timed("dialogue_policy", chatbot.dialogue_policy, conversation)
+        timed("nlg", chatbot.nlg, next_state, slot_values)
+        for line in script:
+            if next_state == "terminate":
+                break
+            start = time.perf_counter()
+            slots = timed("nlu", chatbot.nlu, line, conversation)
+            timed("update_dst", chatbot.update_dst, slots, conversation)
+            next_state, slot_values = timed("dialogue_policy", chatbot.dialogue_policy, conversation)
+            timed("nlg", chatbot.nlg, next_state, slot_values)
+            if next_state in policy.lookup_states:
+                timed("lookup", chatbot.find_answer, conversation)
+                next_state, slot_values = timed("dialogue_policy", chatbot.dialogue_policy, conversation)
+                timed("nlg", chatbot.nlg, next_state, slot_values)
+            if record is not None:
+                record.histograms["turn"].add(time.perf_counter() - start)
+            turns += 1
+    return turns
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# run(count, seed, memory): Replays count conversations and returns the report. A first, untimed replay loads
+#                           the models and reads the articles in, and the answer cache is emptied before the
+#                           timed one, so the report is of a warm bot that still has to look every answer up.
+def run(count=None, seed=0, memory=True):
+    document.offline = True
+    document.use_store(store.fixture_store())
+    chatbot = importlib.import_module("Astro-chatbot")
+    scripts = conversations(count, seed)
+    replay(chatbot, scripts)
+    if chatbot.answers is not None:
+        chatbot.answers.clear()
+    record = recorder()
+    start = time.perf_counter()
+    turns = replay(chatbot, scripts, record)
+    seconds = time.perf_counter() - start
+    report = {"commit": git_commit(), "python": platform.python_version(), "conversations": len(scripts),
+              "turns": turns, "seconds": seconds, "turns_per_second": turns / seconds,
+              "bucket_bounds_us": list(tracing.bucket_bounds), "stages": {stage: record.histograms[stage].summary() for stage in stages}}
+    if memory:
+        if chatbot.answers is not None:
+            chatbot.answers.clear()
+        tracemalloc.start()
+        replay(chatbot, scripts)
+        report["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return report
+
+def print_report(report):
+    print("replay  %d conversations, %d turns in %.2fs: %.0f turns/s" % (report["conversations"], report["turns"], report["seconds"], report["turns_per_second"]))
+    for stage, numbers in report["stages"].items():
+        if numbers["count"]:
+            print("replay  %-16s n=%-6d mean %8.3fms  p50 %8.3fms  p90 %8.3fms  p99 %8.3fms  max %8.3fms" % (stage, numbers["count"], numbers["mean_ms"], numbers["p50_ms"], numbers["p90_ms"], numbers["p99_ms"], numbers["max_ms"]))
+    if "peak_memory_bytes" in report:
+        print("replay  peak memory %.2fMB" % (report["peak_memory_bytes"] / 1e6))
+
+# compare(old, new, tolerance): Prints the numbers of two reports side by side.
+# Returns: the names of the numbers that got worse by more than tolerance (a fraction).
+def compare(old, new, tolerance=0.2):
+    rows = [("turns/s", old["turns_per_second"], new["turns_per_second"], False)]
+    for stage in stages:
+        for key in ("p50_ms", "p99_ms"):
+            if key in old["stages"].get(stage, {}) and key in new["stages"].get(stage, {}):
+                rows.append((stage + " " + key[:3], old["stages"][stage][key], new["stages"][stage][key], True))
+    if "peak_memory_bytes" in old and "peak_memory_bytes" in new:
+        rows.append(("peak memory MB", old["peak_memory_bytes"] / 1e6, new["peak_memory_bytes"] / 1e6, True))
+    regressions = []
+    print("compare  %-22s %12s %12s  (%s -> %s)" % ("", "before", "after", old.get("commit"), new.get("commit")))
+    for name, before, after, lower_is_better in rows:
+        change = (after - before) / before if before else 0.0
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        if worse:
+            regressions.append(name)
+        print("compare  %-22s %12.3f %12.3f %+7.1f%%%s" % (name, before, after, change * 100, "  REGRESSION" if worse else ""))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay scripted conversations through the whole bot")
+    parser.add_argument("--conversations", type=int, default=None, help="how many (default: one per csv question)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc replay")
+    parser.add_argument("--output", help="write the report to this json file")
+    parser.add_argument("--compare", help="compare with the report in this json file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse a number may get before it counts as a regression")
+    args = parser.parse_args(argv)
+    report = run(args.conversations, args.seed, not args.no_memory)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), report, args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,128 @@
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, CancelledError
+from concurrent.futures import TimeoutError as FutureTimeout
+
+# Lookup scheduler
+# Looking up an answer (fetching articles, reading through them) takes much longer than the rest of a turn,
+# so lookups run on a bounded pool of worker threads while the bot says it is thinking. The scheduler adds
+# what a bare executor doesn't have:
+#
+#   deduplication   many users asking the same question at once share one lookup; the question is only
+#                   looked up once and every one of them gets the same future
+#   deadlines       every lookup has a timeout. A job still waiting for a worker when its deadline passes is
+#                   dropped instead of run, so a backlog can't keep the workers busy on answers nobody waits for
+#   cancellation    a caller that stops waiting (its user left, its turn timed out) cancels its interest, and
+#                   once nobody is waiting the job is cancelled if it hasn't started yet
+#   a bound         at most max_pending different questions are queued or running; beyond that new questions
+#                   fail straight away instead of waiting behind a queue they would time out in anyway
+#
+# Threads rather than processes: a lookup spends most of its time waiting on the network and the article
+# store, and it shares the store and the term table with the rest of the process.
+
+log = logging.getLogger(__name__)
+
+def question_key(question):
+    return " ".join(question.split()).casefold().rstrip("?!. ")
+
+class lookup_scheduler:
+    # function      the lookup to run, called with the question
+    # workers       lookups that run at the same time
+    # timeout       seconds a caller waits for an answer by default, None to wait forever
+    # max_pending   most different questions queued or running at once
+    def __init__(self, function, workers=4, timeout=10.0, max_pending=1024):
+        self.function = function
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="lookup")
+        self.lock = threading.Lock()
+        # question key -> [future, number of callers waiting on it]
+        self.pending = {}
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.expired = 0
+        self.cancelled = 0
+
+    # submit(question, timeout): Starts looking up question, or joins the lookup of the same question if one
+    #                            is already in flight. Every submit should be followed by result() or cancel().
+    # Returns: a concurrent.futures.Future of the lookup's result.
+    def submit(self, question, timeout=None):
+        key = question_key(question)
+        deadline = time.monotonic() + (timeout if timeout is not None else self.timeout or float("inf"))
+        with self.lock:
+            if key in self.pending:
+                self.pending[key][1] += 1
+                self.deduplicated += 1
+                return self.pending[key][0]
+            if len(self.pending) >= self.max_pending:
+                self.rejected += 1
+                future = Future()
+                future.set_exception(FutureTimeout("too many lookups in flight"))
+                return future
+            self.submitted += 1
+            future = self.executor.submit(self.run, question, deadline)
+            self.pending[key] = [future, 1]
+        future.add_done_callback(lambda done: self.finished(key, done))
+        return future
+
+    def run(self, question, deadline):
+        if time.monotonic() > deadline:
+            with self.lock:
+                self.expired += 1
+            raise FutureTimeout("lookup waited past its deadline")
+        return self.function(question)
+
+    def finished(self, key, future):
+        with self.lock:
+            if key in self.pending and self.pending[key][0] is future:
+                del self.pending[key]
+
+    # cancel(question, future): Stops waiting for the lookup of question. The lookup itself is cancelled when
+    #                           this was the last caller waiting and it hasn't started yet; a running lookup
+    #                           can't be interrupted and its result is dropped.
+    def cancel(self, question, future):
+        key = question_key(question)
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None or entry[0] is not future:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            del self.pending[key]
+        if future.cancel():
+            with self.lock:
+                self.cancelled += 1
+
+    # result(question, future, timeout): Waits for a submitted lookup. If it doesn't finish in time, is cancelled
+    #                                     or raises, the caller's interest is cancelled and None is returned (an
+    #                                     error is logged first).
+    def result(self, question, future, timeout=None):
+        try:
+            return future.result(timeout if timeout is not None else self.timeout)
+        except (FutureTimeout, CancelledError):
+            self.cancel(question, future)
+            return None
+        except Exception:
+            log.exception("lookup of %r failed", question)
+            self.cancel(question, future)
+            return None
+
+    # lookup(question, timeout): submit and result in one call, for callers that can block.
+    def lookup(self, question, timeout=None):
+        return self.result(question, self.submit(question, timeout), timeout)
+
+    # shutdown(wait): Cancels the lookups that haven't started and stops the workers.
+    def shutdown(self, wait=True):
+        with self.lock:
+            futures = [future for future, waiting in self.pending.values()]
+        for future in futures:
+            future.cancel()
+        self.executor.shutdown(wait)
+
+    def stats(self):
+        with self.lock:
+            return {"submitted": self.submitted, "deduplicated": self.deduplicated, "rejected": self.rejected,
+                    "expired": self.expired, "cancelled": self.cancelled, "pending": len(self.pending)}
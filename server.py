@@ -0,0 +1,219 @@
+import sys
+import json
+import asyncio
+import argparse
+import logging
+import importlib
+import tracing
+from scheduler import lookup_scheduler
+from session import SessionManager
+
+# Chat server
+# Serves the bot to many users at once from one asyncio event loop, on two front ends:
+#
+#   line protocol (TCP)     one conversation per connection. Every line sent is a user turn, and the bot's
+#                           replies come back one per line, followed by an empty line at the end of the turn.
+#   HTTP/JSON               POST /chat with {"session": <id>, "message": <text>} returns
+#                           {"session": <id>, "state": <state>, "replies": [...]}. Leave out "session" to
+#                           start a new conversation; the reply carries its id. GET /health returns "ok",
+#                           and GET /metrics the tracing snapshot and the lookup scheduler's counters.
+#
+# Each turn runs the same nlu -> update_dst -> dialogue_policy -> nlg pipeline as the terminal, on the
+# connection's own DialogueSession. The steps that only touch the session are fast and run on the event loop;
+# looking up an answer is slow, so it goes to the lookup scheduler's worker threads and one user's lookup
+# never holds up the others. The thinking reply is sent as soon as the lookup is submitted, and the answer
+# when it is done (or the fallback answer if it takes longer than the lookup timeout).
+#
+# Run with: python3 server.py [--port 8765] [--http-port 8080] [--preload]
+
+chatbot = importlib.import_module("Astro-chatbot")
+log = logging.getLogger(__name__)
+
+# largest HTTP request body accepted; a chat message is a line of text, so anything bigger gets a 413
+max_body = 64 * 1024
+
+class chat_server:
+    # workers       threads looking up answers at the same time
+    # timeout       seconds a user waits for an answer before getting the fallback answer
+    def __init__(self, sessions=None, workers=8, timeout=10.0):
+        self.sessions = sessions if sessions is not None else SessionManager()
+        # the lambda looks lookup up at call time, so it can be replaced (e.g. by a benchmark)
+        self.lookups = lookup_scheduler(lambda question: chatbot.lookup(question), workers, timeout)
+        self.turns = 0
+
+    # greet(session): The bot's opening utterance for a new conversation.
+    def greet(self, session):
+        next_state, slot_values = chatbot.dialogue_policy(session)
+        return next_state, chatbot.nlg(next_state, slot_values)
+
+    # turn(session, text): Runs one user turn, yielding (state, reply) for each thing the bot says. When the
+    #                      bot starts thinking (or checking a statement), the lookup is submitted and the thinking reply yielded right
+    #                      away, so it can be sent while the answer is being found.
+    async def turn(self, session, text):
+        self.turns += 1
+        with tracing.span("turn"):
+            async for reply in self.run_turn(session, text):
+                yield reply
+
+    async def run_turn(self, session, text):
+        chatbot.update_dst(chatbot.nlu(text, session), session)
+        next_state, slot_values = chatbot.dialogue_policy(session)
+        if next_state not in chatbot.policy.lookup_states:
+            yield next_state, chatbot.nlg(next_state, slot_values)
+            return
+        question = session.get("question", "")
+        future = self.lookups.submit(question)
+        waiter = asyncio.wrap_future(future)
+        try:
+            yield next_state, chatbot.nlg(next_state, slot_values)
+            # shield, so timing out (or this user leaving) doesn't cancel a lookup other users share
+            result = await asyncio.wait_for(asyncio.shield(waiter), self.lookups.timeout)
+        except asyncio.TimeoutError:
+            result = None
+        except Exception:
+            # a failed lookup gets the fallback answer like a slow one, rather than ending the conversation
+            log.exception("lookup of %r failed", question)
+            result = None
+        finally:
+            if not future.done():
+                self.lookups.cancel(question, future)
+            if not waiter.done():
+                # nobody reads the outcome of a lookup given up on, which asyncio would otherwise log
+                waiter.add_done_callback(lambda done: done.cancelled() or done.exception())
+        chatbot.store_answer(result, session)
+        next_state, slot_values = chatbot.dialogue_policy(session)
+        yield next_state, chatbot.nlg(next_state, slot_values)
+
+    async def handle_line(self, reader, writer):
+        session = self.sessions.get()
+        try:
+            next_state, reply = self.greet(session)
+            writer.write(reply.encode() + b"\n\n")
+            await writer.drain()
+            while next_state != "terminate":
+                line = await reader.readline()
+                if not line:
+                    break
+                # the session manager may have evicted an idle session; get brings it back as a fresh one
+                session = self.sessions.get(session.session_id)
+                async for next_state, reply in self.turn(session, line.decode(errors="replace").strip()):
+                    writer.write(reply.encode() + b"\n")
+                    await writer.drain()
+                writer.write(b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except ValueError:
+            # readline raises it for a line longer than the stream's limit; the rest of the line can't be told
+            # apart from the next one, so the conversation ends
+            pass
+        finally:
+            self.sessions.remove(session.session_id)
+            writer.close()
+
+    async def handle_http(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if not request:
+                    break
+                method, path, version = (request.decode("latin-1").split() + ["", "", ""])[:3]
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0) or 0)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if 0 <= length <= max_body:
+                    status, payload = await self.http_response(method, path, await reader.readexactly(length))
+                else:
+                    # the body isn't read, so the connection can't be used for another request
+                    status, payload = "413 Payload Too Large", {"error": "body over %d bytes" % max_body}
+                    keep_alive = False
+                data = json.dumps(payload).encode()
+                writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n" % (status, len(data), "keep-alive" if keep_alive else "close")).encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def http_response(self, method, path, body):
+        if method == "GET" and path == "/health":
+            return "200 OK", "ok"
+        if method == "GET" and path == "/metrics":
+            return "200 OK", {"turns": self.turns, "sessions": len(self.sessions), "lookups": self.lookups.stats(), "tracing": tracing.snapshot()}
+        if path != "/chat":
+            return "404 Not Found", {"error": "not found"}
+        if method != "POST":
+            return "405 Method Not Allowed", {"error": "use POST"}
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            return "400 Bad Request", {"error": "body must be json"}
+        if not isinstance(request, dict):
+            return "400 Bad Request", {"error": "body must be a json object"}
+        if not isinstance(request.get("session"), (str, type(None))):
+            return "400 Bad Request", {"error": "session must be a string"}
+        new = request.get("session") not in self.sessions
+        session = self.sessions.get(request.get("session"))
+        replies = []
+        next_state = None
+        if new:
+            next_state, reply = self.greet(session)
+            replies.append(reply)
+        if "message" in request:
+            async for next_state, reply in self.turn(session, str(request["message"])):
+                replies.append(reply)
+        if next_state == "terminate":
+            self.sessions.remove(session.session_id)
+        return "200 OK", {"session": session.session_id, "state": next_state, "replies": replies}
+
+    # start(host, port, http_port): Starts listening; a port of None skips that front end. Returns the servers.
+    async def start(self, host="127.0.0.1", port=8765, http_port=8080):
+        servers = []
+        if port is not None:
+            servers.append(await asyncio.start_server(self.handle_line, host, port, limit=64 * 1024, backlog=1024))
+        if http_port is not None:
+            servers.append(await asyncio.start_server(self.handle_http, host, http_port, limit=64 * 1024, backlog=1024))
+        return servers
+
+    async def serve(self, host="127.0.0.1", port=8765, http_port=8080):
+        servers = await self.start(host, port, http_port)
+        for server in servers:
+            for sock in server.sockets:
+                print("listening on %s:%d" % sock.getsockname()[:2])
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve Astro-chatter over TCP and HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="port of the line protocol, 0 to pick one")
+    parser.add_argument("--http-port", type=int, default=8080, help="port of the HTTP/JSON front end, 0 to pick one")
+    parser.add_argument("--workers", type=int, default=8, help="threads looking up answers")
+    parser.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for an answer")
+    parser.add_argument("--idle-timeout", type=float, default=30*60, help="seconds before an idle session is dropped")
+    parser.add_argument("--preload", action="store_true", help="load the models before listening instead of in the background")
+    parser.add_argument("--trace", action="store_true", help="time the stages of every turn (see GET /metrics)")
+    parser.add_argument("--profile-slow", type=float, default=None, help="profile a sample of lookups, keeping the profiles of those slower than this many seconds (implies --trace)")
+    args = parser.parse_args(argv)
+    if args.trace or args.profile_slow is not None:
+        tracing.enable(True, args.profile_slow)
+    if args.preload:
+        chatbot.warm_up()
+    else:
+        chatbot.start_warm_up()
+    server = chat_server(SessionManager(idle_timeout=args.idle_timeout), args.workers, args.timeout)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.http_port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
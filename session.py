@@ -0,0 +1,117 @@
+import time
+import uuid
+from collections import deque, OrderedDict
+
+# Dialogue sessions
+# The dialogue state tracker of one conversation. It behaves like the dst dictionary nlu and dialogue_policy
+# were written against (dst["dialogue_state_history"][0] is the latest state, "slot" in dst, len(dst) == 0
+# before the first turn), but the two histories are bounded deques: a new entry is prepended in O(1) and the
+# oldest falls off once history_length is reached, so a long conversation doesn't grow without limit.
+
+HISTORIES = ("dialogue_state_history", "user_intent_history")
+
+class DialogueSession:
+    __slots__ = ("session_id", "dialogue_state_history", "user_intent_history", "slots", "last_active")
+
+    def __init__(self, session_id=None, history_length=32):
+        self.session_id = session_id if session_id is not None else uuid.uuid4().hex
+        self.dialogue_state_history = deque(maxlen=history_length)
+        self.user_intent_history = deque(maxlen=history_length)
+        # every other slot nlu extracts (question, intent, ...) keeps only its latest value
+        self.slots = {}
+        self.last_active = time.monotonic()
+
+    # update(input): Stores a list of (slot, value) pairs, newest history entries first.
+    def update(self, input):
+        for slot, value in input:
+            if slot in HISTORIES:
+                history = getattr(self, slot)
+                if isinstance(value, list):
+                    history.extendleft(value)
+                else:
+                    history.appendleft(value)
+            else:
+                self.slots[slot] = value
+        self.last_active = time.monotonic()
+
+    def __getitem__(self, slot):
+        if slot in HISTORIES:
+            return getattr(self, slot)
+        return self.slots[slot]
+
+    def __setitem__(self, slot, value):
+        if slot in HISTORIES:
+            history = getattr(self, slot)
+            history.clear()
+            history.extend(value)
+        else:
+            self.slots[slot] = value
+
+    # a history only counts as present once something has been added to it, like a key of the old dst
+    def __contains__(self, slot):
+        if slot in HISTORIES:
+            return len(getattr(self, slot)) > 0
+        return slot in self.slots
+
+    def __len__(self):
+        return sum(1 for slot in HISTORIES if getattr(self, slot)) + len(self.slots)
+
+    def get(self, slot, default=None):
+        return self[slot] if slot in self else default
+
+    def keys(self):
+        return [slot for slot in HISTORIES if getattr(self, slot)] + list(self.slots)
+
+    def __repr__(self):
+        return "DialogueSession(%r, %r)" % (self.session_id, {slot: self[slot] for slot in self.keys()})
+
+# SessionManager
+# Holds the sessions of every conversation a process is serving. Sessions are kept in order of last use, so
+# the idle ones are always at the front: evicting them only looks at the sessions that are actually evicted,
+# not at all of them.
+class SessionManager:
+    # idle_timeout      seconds a session may go unused before it is evicted
+    # max_sessions      most sessions held at once; the least recently used are evicted beyond that
+    def __init__(self, idle_timeout=30*60, max_sessions=100000, history_length=32):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.history_length = history_length
+        self.sessions = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self.sessions
+
+    # get(session_id): The session with this id, started fresh if it doesn't exist (or was evicted). With no
+    #                  id, a new session with a random id is started.
+    def get(self, session_id=None):
+        now = time.monotonic()
+        current = self.sessions.get(session_id) if session_id is not None else None
+        if current is None:
+            current = DialogueSession(session_id, self.history_length)
+            self.sessions[current.session_id] = current
+        else:
+            self.sessions.move_to_end(session_id)
+        current.last_active = now
+        self.evict(now)
+        return current
+
+    def remove(self, session_id):
+        self.sessions.pop(session_id, None)
+
+    # evict(now): Drops sessions idle for longer than idle_timeout, and the least recently used ones while
+    #             there are more than max_sessions. Returns how many were dropped.
+    def evict(self, now=None):
+        now = time.monotonic() if now is None else now
+        dropped = 0
+        while self.sessions:
+            oldest = next(iter(self.sessions.values()))
+            if len(self.sessions) <= self.max_sessions and now - oldest.last_active <= self.idle_timeout:
+                break
+            self.sessions.popitem(last=False)
+            dropped += 1
+        self.evicted += dropped
+        return dropped
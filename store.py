@@ -0,0 +1,295 @@
+import os
+import sys
+import csv
+import json
+import mmap
+import time
+import zlib
+import atexit
+import hashlib
+import tempfile
+import threading
+
+# Local article store
+# Fetching an article from wikipedia takes two network round trips (search, then the page itself), so every
+# article we fetch is kept on disk and reused. Articles are stored content-addressed: the file name of each
+# article is the hash of its contents, so two titles that resolve to the same page (redirects, different
+# capitalisation) share one compressed copy. A small json index maps titles to content keys and keeps the
+# fetch time (for the TTL) and last access time (for LRU eviction) of each title. In memory the store also counts
+# the titles referring to each content key, so storing a title and dropping one are O(1) rather than a scan
+# of the index.
+#
+# Layout on disk:
+#   <path>/index.json                 {title: {"key": ..., "fetched": ..., "used": ..., "size": ...}}
+#   <path>/index.journal              a json line [title, entry] (entry null for a removed title) per change
+#                                     made to the index since index.json was written
+#   <path>/objects/ab/abcdef....z     zlib compressed json of the article
+#
+# Writing the index appends the titles changed since the last write to the journal, and only rewrites
+# index.json (and empties the journal) once the journal has as many lines as the index has titles, so the
+# cost of writing the index stays proportional to the changes made.
+#
+# Lookups run on several threads, so the index is only read and changed under the store's lock. Objects are
+# read and written outside it: they are never changed once written, and are written to a temporary file first.
+
+default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "articles")
+fixture_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fixtures", "articles.json")
+csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "Most Asked “Space” Question Keywords - Sheet1.csv")
+
+# an article is the part of a WikipediaPage that the bot actually uses, so it can be stored and read back
+# without the wikipedia package
+class article:
+    def __init__(self, title, content, url="", links=None):
+        self.title = title
+        self.content = content
+        self.url = url
+        self.links = links if links is not None else []
+
+    def to_json(self):
+        return {"title": self.title, "url": self.url, "links": self.links, "content": self.content}
+
+def from_page(page):
+    # page.links costs another request for long articles, so a failure there shouldn't lose the article
+    try:
+        links = list(page.links)
+    except Exception:
+        links = []
+    return article(page.title, page.content, page.url, links)
+
+def normalize_title(title):
+    return " ".join(title.split()).casefold()
+
+class article_store:
+    # path          directory the store lives in, created if needed
+    # ttl           seconds before a stored article is considered stale, None to keep articles forever
+    # max_bytes     total compressed size the store may grow to before least recently used articles are evicted
+    # flush_every   puts between writes of the index; it is also written when the process exits
+    def __init__(self, path=default_path, ttl=30*24*60*60, max_bytes=256*1024*1024, flush_every=64):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        # titles changed since the index was last written
+        self.changed = set()
+        self.unflushed = 0
+        # lines in the journal
+        self.journaled = 0
+        self.lock = threading.RLock()
+        self.index = {}
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+        index_file = os.path.join(path, "index.json")
+        if os.path.exists(index_file):
+            with open(index_file) as f:
+                self.index = json.load(f)
+        journal_file = os.path.join(path, "index.journal")
+        if os.path.exists(journal_file):
+            with open(journal_file) as f:
+                for line in f:
+                    try:
+                        name, entry = json.loads(line)
+                    except ValueError:
+                        # a write cut short; rewrite index.json on the next flush rather than append after it
+                        self.journaled = float("inf")
+                        break
+                    if entry is None:
+                        self.index.pop(name, None)
+                    else:
+                        self.index[name] = entry
+                    self.journaled += 1
+        # content key -> number of titles referring to it
+        self.references = {}
+        self.size = 0
+        for entry in self.index.values():
+            self.reference(entry["key"], entry["size"])
+        atexit.register(self.flush)
+
+    # reference(key, size): Counts another title referring to key. Called with the lock held (or before the
+    #                       store is shared).
+    def reference(self, key, size):
+        count = self.references.get(key, 0)
+        if count == 0:
+            self.size += size
+        self.references[key] = count + 1
+
+    def object_path(self, key):
+        return os.path.join(self.path, "objects", key[:2], key + ".z")
+
+    def __contains__(self, title):
+        return normalize_title(title) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    # titles(): Every (normalized) title in the store.
+    def titles(self):
+        with self.lock:
+            return list(self.index)
+
+    # keys(): The content key of every (normalized) title in the store.
+    def keys(self):
+        with self.lock:
+            return {name: entry["key"] for name, entry in self.index.items()}
+
+    def stale(self, title):
+        entry = self.index.get(normalize_title(title))
+        if entry is None:
+            return True
+        return self.ttl is not None and time.time() - entry["fetched"] > self.ttl
+
+    # get(title, allow_stale): Returns the stored article for title, or None if it isn't stored (or has expired
+    #                          and allow_stale is False).
+    def get(self, title, allow_stale=False):
+        name = normalize_title(title)
+        with self.lock:
+            entry = self.index.get(name)
+            if entry is None or (not allow_stale and self.stale(name)):
+                self.misses += 1
+                return None
+        try:
+            with open(self.object_path(entry["key"]), "rb") as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    raw = zlib.decompress(data)
+        except (OSError, ValueError, zlib.error):
+            # the object went missing or got corrupted, forget about it so it gets fetched again
+            with self.lock:
+                if self.index.get(name) is entry:
+                    del self.index[name]
+                    self.release(entry["key"], entry["size"])
+                    self.changed.add(name)
+                self.misses += 1
+            return None
+        with self.lock:
+            entry["used"] = time.time()
+            self.changed.add(name)
+            self.hits += 1
+        return article(**json.loads(raw))
+
+    # put(item, titles): Stores an article under its own title and any extra titles (e.g. the search term that
+    #                    found it). Returns the content key. The index is written every flush_every puts rather
+    #                    than on every one, which would make filling a store quadratic in its size.
+    def put(self, item, titles=()):
+        raw = json.dumps(item.to_json(), sort_keys=True).encode("utf-8")
+        key = hashlib.sha1(raw).hexdigest()
+        object_file = self.object_path(key)
+        if not os.path.exists(object_file):
+            os.makedirs(os.path.dirname(object_file), exist_ok=True)
+            data = zlib.compress(raw, 6)
+            # write then rename, so a reader never sees half an object
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(object_file))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, object_file)
+        size = os.path.getsize(object_file)
+        now = time.time()
+        with self.lock:
+            for title in (item.title,) + tuple(titles):
+                name = normalize_title(title)
+                old = self.index.get(name)
+                self.index[name] = {"key": key, "fetched": now, "used": now, "size": size}
+                self.reference(key, size)
+                if old is not None:
+                    self.release(old["key"], old["size"])
+                self.changed.add(name)
+            self.unflushed += 1
+            self.evict()
+            if self.unflushed >= self.flush_every:
+                self.flush()
+        return key
+
+    # release(key, size): Counts one title fewer referring to key, and deletes the object once none does. Called
+    #                     with the lock held.
+    def release(self, key, size):
+        count = self.references.get(key, 0) - 1
+        if count > 0:
+            self.references[key] = count
+            return
+        self.references.pop(key, None)
+        try:
+            os.remove(self.object_path(key))
+        except OSError:
+            pass
+        self.size -= size
+
+    # evict(): Removes least recently used titles until the store fits in max_bytes.
+    def evict(self):
+        with self.lock:
+            if self.max_bytes is None or self.size <= self.max_bytes:
+                return
+            for name in sorted(self.index, key=lambda name: self.index[name]["used"]):
+                entry = self.index.pop(name)
+                self.release(entry["key"], entry["size"])
+                self.changed.add(name)
+                if self.size <= self.max_bytes:
+                    break
+
+    # flush(): Writes the changes to the index made since the last flush (see above).
+    def flush(self):
+        with self.lock:
+            index_file = os.path.join(self.path, "index.json")
+            journal_file = os.path.join(self.path, "index.journal")
+            if not self.changed and os.path.exists(index_file):
+                return
+            if self.journaled + len(self.changed) > len(self.index) or not os.path.exists(index_file):
+                # one dumps call encodes the whole index in C; json.dump writes it a few bytes at a time from python
+                data = json.dumps(self.index)
+                fd, tmp = tempfile.mkstemp(dir=self.path)
+                with os.fdopen(fd, "w") as f:
+                    f.write(data)
+                os.replace(tmp, index_file)
+                # a crash before this only leaves changes index.json already has to be replayed again
+                if os.path.exists(journal_file):
+                    os.remove(journal_file)
+                self.journaled = 0
+            else:
+                lines = "".join(json.dumps([name, self.index.get(name)]) + "\n" for name in self.changed)
+                with open(journal_file, "a") as f:
+                    f.write(lines)
+                self.journaled += len(self.changed)
+            self.changed = set()
+            self.unflushed = 0
+
+# load_fixtures(store, path): Puts every article in a fixture file into the store, so the bot can run offline.
+def load_fixtures(store, path=fixture_path):
+    with open(path) as f:
+        for item in json.load(f):
+            store.put(article(**item))
+    store.flush()
+    return store
+
+# fixture_store(): A throwaway store holding the bundled fixture corpus, for tests and benchmarks.
+def fixture_store(path=fixture_path):
+    return load_fixtures(article_store(tempfile.mkdtemp(prefix="astro-store-"), ttl=None, max_bytes=None), path)
+
+# csv_intents(): The distinct Intent values of the question keywords csv, in the order they first appear.
+def csv_intents(path=csv_path):
+    intents = []
+    with open(path, newline="") as f:
+        for row in csv.DictReader(f):
+            intent = row["Intent"].strip()
+            if intent and intent not in ("None", "Other") and intent not in intents:
+                intents.append(intent)
+    return intents
+
+# warm(): Pre-fetches an article for every Intent in the csv, so the bot can answer from local data.
+def warm(path=csv_path):
+    import document
+    found = 0
+    intents = csv_intents(path)
+    for intent in intents:
+        if document.get_from_wiki(intent) is not None:
+            found += 1
+        else:
+            print("no article found for", intent)
+    print("stored", found, "of", len(intents), "intents in", document.get_store().path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "warm":
+        warm(*sys.argv[2:3])
+    elif len(sys.argv) > 1 and sys.argv[1] == "fixtures":
+        import document
+        load_fixtures(document.get_store(), *sys.argv[2:3])
+    else:
+        print("usage: python store.py warm [csv] | fixtures [json]")
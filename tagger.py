@@ -0,0 +1,159 @@
+import os
+import re
+import threading
+import numpy as np
+
+# Part-of-speech tagger
+# A hidden Markov model tagger: the tags are the hidden states, the words the observations. Training counts
+# tag-to-tag transitions and tag-to-word emissions in a tagged corpus, and tagging finds the most likely tag
+# sequence with the Viterbi algorithm, following the pseudocode in
+# https://web.stanford.edu/~jurafsky/slp3/8.pdf#subsection.8.4.5
+#
+# Everything is in log space, so long sentences don't underflow, and every time step of Viterbi is one
+# broadcasted K x K max/argmax over all pairs of previous and next tag instead of a loop over states.
+
+corpus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tagged.txt")
+
+# words, numbers and single punctuation marks, e.g. "What's the 384,400 km?" -> what's the 384,400 km ?
+token_pattern = re.compile(r"[A-Za-z]+(?:'[A-Za-z]+)?|\d[\d,.]*\d|\d|[^\w\s]")
+number_pattern = re.compile(r"\d")
+
+# words that weren't seen in training are emitted by one of these classes instead
+UNKNOWN = "<unk>"
+NUMBER = "<num>"
+
+def split_words(text):
+    return token_pattern.findall(text)
+
+# read_corpus(path): Reads a corpus of one sentence per line, written as word/TAG tokens.
+# Returns: a list of sentences, each a list of (word, tag) pairs.
+def read_corpus(path=corpus_path):
+    sentences = []
+    with open(path) as f:
+        for line in f:
+            pairs = [token.rsplit("/", 1) for token in line.split()]
+            if pairs:
+                sentences.append([(word, tag) for word, tag in pairs])
+    return sentences
+
+def log_normalize(counts):
+    return np.log(counts / counts.sum(axis=-1, keepdims=True))
+
+# viterbi(observations, log_transition, log_emission, log_initial): Most likely state sequence for one
+#                                                                   sequence of observations.
+# Parameters:
+# observations      array(T,): observation sequence, int dtype.
+# log_transition    array(K,K): log probability of going from state i to state j
+# log_emission      array(K,M): log probability of state i emitting observation m
+# log_initial       Optional; array(K,): log probability of starting in each state. If None, a uniform initial
+#                   distribution is assumed.
+# Returns: array(T,) of the most likely states.
+def viterbi(observations, log_transition, log_emission, log_initial=None):
+    return viterbi_batch([observations], log_transition, log_emission, log_initial)[0]
+
+# viterbi_batch(sequences, ...): viterbi for many observation sequences at once. The sequences are padded to
+#                                the longest one, and padded steps are masked so they carry the trellis through
+#                                unchanged. Returns a list with an array of states per sequence.
+def viterbi_batch(sequences, log_transition, log_emission, log_initial=None):
+    K = len(log_transition)
+    B = len(sequences)
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    T = int(lengths.max()) if B else 0
+    if T == 0:
+        return [np.zeros(0, dtype=np.int64) for sequence in sequences]
+    if log_initial is None:
+        log_initial = np.full(K, -np.log(K))
+    observations = np.zeros((B, T), dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+        observations[row, :len(sequence)] = sequence
+    mask = np.arange(T) < lengths[:, None]
+    # trellis[b, k]: log probability of the best path for sequence b that ends in state k at the current step
+    trellis = log_initial[None, :] + log_emission[:, observations[:, 0]].T
+    backpointers = np.zeros((T, B, K), dtype=np.int64)
+    stay = np.broadcast_to(np.arange(K), (B, K))
+    for t in range(1, T):
+        # scores[b, i, j]: best path through state i at t-1 and then state j at t
+        scores = trellis[:, :, None] + log_transition[None, :, :]
+        best = scores.argmax(axis=1)
+        step = np.take_along_axis(scores, best[:, None, :], axis=1)[:, 0, :] + log_emission[:, observations[:, t]].T
+        active = mask[:, t][:, None]
+        trellis = np.where(active, step, trellis)
+        backpointers[t] = np.where(active, best, stay)
+    states = np.zeros((B, T), dtype=np.int64)
+    states[:, T - 1] = trellis.argmax(axis=1)
+    rows = np.arange(B)
+    for t in range(T - 1, 0, -1):
+        states[:, t - 1] = backpointers[t, rows, states[:, t]]
+    return [states[row, :length] for row, length in enumerate(lengths)]
+
+class hmm_tagger:
+    # smoothing     count added to every transition and emission, so unseen ones aren't impossible
+    def __init__(self, smoothing=0.1):
+        self.smoothing = smoothing
+        self.tags = []
+        self.word_index = {}
+
+    # train(sentences): Estimates the transition and emission matrices from sentences of (word, tag) pairs.
+    def train(self, sentences):
+        self.tags = sorted({tag for sentence in sentences for word, tag in sentence})
+        tag_index = {tag: i for i, tag in enumerate(self.tags)}
+        word_counts = {}
+        for sentence in sentences:
+            for word, tag in sentence:
+                word = word.lower()
+                word_counts[word] = word_counts.get(word, 0) + 1
+        self.word_index = {UNKNOWN: 0, NUMBER: 1}
+        for word in word_counts:
+            self.word_index[word] = len(self.word_index)
+        K, M = len(self.tags), len(self.word_index)
+        initial = np.full(K, self.smoothing)
+        transition = np.full((K, K), self.smoothing)
+        emission = np.full((K, M), self.smoothing)
+        for sentence in sentences:
+            previous = None
+            for word, tag in sentence:
+                word = word.lower()
+                state = tag_index[tag]
+                if previous is None:
+                    initial[state] += 1
+                else:
+                    transition[previous, state] += 1
+                emission[state, self.word_index[word]] += 1
+                # words seen only once stand in for the words that will never have been seen
+                if word_counts[word] == 1:
+                    emission[state, self.word_class(word)] += 1
+                previous = state
+        self.log_initial = log_normalize(initial)
+        self.log_transition = log_normalize(transition)
+        self.log_emission = log_normalize(emission)
+        return self
+
+    def word_class(self, word):
+        return self.word_index[NUMBER] if number_pattern.search(word) else self.word_index[UNKNOWN]
+
+    def observations(self, words):
+        indices = [self.word_index.get(word.lower()) for word in words]
+        return np.array([self.word_class(word) if index is None else index for word, index in zip(words, indices)], dtype=np.int64)
+
+    # tag(words): The most likely tag of each word in a list of words.
+    def tag(self, words):
+        return self.tag_batch([words])[0]
+
+    # tag_batch(sentences): Tags many lists of words at once.
+    def tag_batch(self, sentences):
+        sequences = [self.observations(words) for words in sentences]
+        states = viterbi_batch(sequences, self.log_transition, self.log_emission, self.log_initial)
+        return [[self.tags[state] for state in sequence] for sequence in states]
+
+default = None
+default_lock = threading.Lock()
+
+# default_tagger(): The tagger trained on the bundled corpus, trained the first time it's needed (by whichever
+#                   thread gets there first; the others wait for it).
+def default_tagger():
+    global default
+    if default is None:
+        with default_lock:
+            if default is None:
+                default = hmm_tagger().train(read_corpus())
+    return default
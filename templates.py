@@ -0,0 +1,115 @@
+import re
+import json
+import random
+
+# Response templates
+# The sentences the bot says, compiled once instead of on every call to nlg. A template is text with slots in
+# angle brackets, filled in from the (slot, value) pairs of the dialogue policy:
+#
+#   <answer>              the value of the slot
+#   <a topic>             the value with "a" or "an" in front, whichever its first word needs ("an asteroid",
+#                         "a unicorn"); <A topic> capitalizes the article for the start of a sentence
+#   <count:moon/moons>    the singular or plural word, depending on whether the count slot is 1 (a list or
+#                         other sized value counts as its length)
+#
+# Every template is split into a list of segments when it is compiled: the literal text between slots as
+# plain strings, and each slot as a (kind, slot, argument) tuple, so rendering is a single pass over the
+# segments and one join.
+#
+# Which of a state's templates is said is picked at random, or in turn ("rotate"), so the bot doesn't repeat
+# itself word for word.
+
+slot_pattern = re.compile(r"<(?:(a|A|an|An) )?(\w+)(?::([^<>/]*)/([^<>]*))?>")
+
+# words that start with a vowel letter but not a vowel sound, and the other way round
+consonant_sounds = ("uni", "use", "usu", "uti", "eu", "one", "once", "ubi", "ura", "uri", "uro")
+vowel_sounds = ("hour", "honest", "honor", "honour", "heir")
+
+def article(word):
+    lower = word.lower()
+    if lower.startswith(vowel_sounds):
+        return "an"
+    if lower.startswith(consonant_sounds):
+        return "a"
+    return "an" if lower[:1] in ("a", "e", "i", "o", "u") else "a"
+
+def count_of(value):
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return len(value)
+    except TypeError:
+        return value
+
+# compile_template(text): The segments of a template: strings, and (kind, slot, argument) tuples for slots.
+def compile_template(text):
+    segments = []
+    position = 0
+    for match in slot_pattern.finditer(text):
+        if match.start() > position:
+            segments.append(text[position:match.start()])
+        prefix, slot, singular, plural = match.groups()
+        if singular is not None:
+            segments.append(("plural", slot, (singular, plural)))
+        elif prefix is not None:
+            segments.append(("article", slot, prefix[0].isupper()))
+        else:
+            segments.append(("value", slot, None))
+        position = match.end()
+    if position < len(text):
+        segments.append(text[position:])
+    return segments
+
+def render_segment(segment, values):
+    kind, slot, argument = segment
+    value = values.get(slot, "")
+    if kind == "value":
+        return str(value)
+    if kind == "plural":
+        return argument[0] if count_of(value) == 1 else argument[1]
+    text = str(value)
+    word = article(text)
+    return (word.capitalize() if argument else word) + " " + text
+
+class template_table:
+    # templates     {state: [template, ...]}
+    # select        "random" or "rotate"
+    # seed          seed of the random choices, for reproducible conversations
+    def __init__(self, templates=None, select="random", seed=None):
+        if select not in ("random", "rotate"):
+            raise ValueError("select must be 'random' or 'rotate', not %r" % (select,))
+        self.select = select
+        self.random = random.Random(seed)
+        self.states = {}
+        self.turns = {}
+        for state, texts in (templates or {}).items():
+            self.add(state, texts)
+
+    def add(self, state, texts):
+        self.states[state] = [compile_template(text) for text in texts]
+        self.turns[state] = 0
+
+    def __contains__(self, state):
+        return state in self.states
+
+    def choose(self, state):
+        options = self.states[state]
+        if len(options) == 1:
+            return options[0]
+        if self.select == "random":
+            return self.random.choice(options)
+        turn = self.turns[state]
+        self.turns[state] = turn + 1
+        return options[turn % len(options)]
+
+    # render(state, slots): A sentence for state, with its slots filled from a list of (slot, value) pairs (or
+    #                       a dict). Slots without a value are left empty.
+    def render(self, state, slots=()):
+        segments = self.choose(state)
+        values = slots if isinstance(slots, dict) else dict(slots)
+        return "".join(segment if segment.__class__ is str else render_segment(segment, values) for segment in segments)
+
+# load(path, ...): A template table from a json file of {state: [template, ...]}.
+def load(path, select="random", seed=None):
+    with open(path) as f:
+        return template_table(json.load(f), select, seed)
@@ -1,4 +1,29 @@
+import os
+import time
+import tempfile
+import numpy as np
+import answer_cache
 import document
+import index
+import ingest
+import intent
+import policy
+import packed
+import qa
+import replay
+import scheduler
+import server
+import session
+import store
+import tagger
+import templates
+import tokenizer
+import tracing
+import word2vec
+
+# run against the bundled fixture corpus instead of wikipedia, so the tests work offline
+document.offline = True
+document.use_store(store.fixture_store())
 
 document.get_from_wiki("NASA")
 document.get_from_wiki("Space")
@@ -8,4 +33,578 @@ document.get_from_wiki("International Space Station")
 #mydoc.pre_compute()
 #print(mydoc.term_frequency("quick"))
 #print(mydoc.term_frequency("lazy"))
-#print(mydoc.get_words)
\ No newline at end of file
+#print(mydoc.get_words)
+
+def test_offline_store():
+    assert document.get_from_wiki("NASA").title == "NASA"
+    assert document.get_from_wiki("nasa").title == "NASA"
+    assert document.get_from_wiki("Space") is None
+    mars = document.document("Mars")
+    assert "Red Planet" in mars.wiki.content
+
+def test_pre_compute():
+    mars = document.document("Mars").pre_compute()
+    words = mars.get_words()
+    assert len(words) == len(set(words)) and "planet" in words
+    assert mars.term_frequency("Mars") == mars.dict["mars"] > mars.term_frequency("phobos") > 0
+    assert mars.term_frequency("unicorn") == 0
+    tokenizer.chunk_size = 16
+    try:
+        assert list(tokenizer.tokens("Earth's atmosphere\nis made of nitrogen", True)) == ["earths", "atmosphere", "made", "nitrogen"]
+    finally:
+        tokenizer.chunk_size = 64 * 1024
+
+def test_store_eviction():
+    articles = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=None)
+    first = store.article("First", "a" * 5000)
+    articles.put(first, ["Alias"])
+    assert articles.get("alias").content == first.content
+    articles.put(store.article("Second", "b" * 5000))
+    articles.put(store.article("Third", "c" * 5000))
+    articles.get("First")
+    articles.max_bytes = articles.size - 1
+    articles.evict()
+    # Second was used least recently, and its object is gone once nothing refers to it
+    assert "Second" not in articles and "First" in articles
+    assert sum(len(files) for _, _, files in os.walk(os.path.join(articles.path, "objects"))) == 2
+    # reopening reads the index back
+    articles.flush()
+    assert store.article_store(articles.path).get("Third").content == "c" * 5000
+    # the index is written every flush_every puts, with every title put since the last write
+    batched = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=None, flush_every=2)
+    batched.put(store.article("One", "1"))
+    assert len(store.article_store(batched.path)) == 0
+    batched.put(store.article("Two", "2"), ["Deux"])
+    assert sorted(store.article_store(batched.path).index) == ["deux", "one", "two"]
+    # a put costs the same however big the store is: 200 puts into a store of 4000 titles take about as long
+    # as 200 into one of 200
+    growing = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=None)
+    def timed_puts(first):
+        start = time.perf_counter()
+        for i in range(first, first + 200):
+            growing.put(store.article("Article %d" % i, "text %d" % i), ["Alias %d" % i])
+        return time.perf_counter() - start
+    small = min(timed_puts(0), timed_puts(200))
+    for first in range(400, 4000, 200):
+        timed_puts(first)
+    assert timed_puts(4000) < 3 * small
+    assert len(growing.references) == 4200 and growing.size == sum(entry["size"] for entry in growing.index.values()) // 2
+    # the index is index.json plus the journal of changes since, and a line cut short ends the journal
+    growing.get("Article 7")
+    growing.flush()
+    with open(os.path.join(growing.path, "index.journal"), "a") as f:
+        f.write('["article 1", {"key": ')
+    reopened = store.article_store(growing.path)
+    assert reopened.index == growing.index and reopened.size == growing.size
+    reopened.put(store.article("Last", "last"))
+    reopened.flush()
+    assert not os.path.exists(os.path.join(growing.path, "index.journal")) and "last" in store.article_store(growing.path)
+
+def test_store_threads():
+    import threading
+    articles = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=20000, flush_every=5)
+    errors = []
+
+    def work(thread):
+        try:
+            for i in range(40):
+                articles.put(store.article("Thread %d article %d" % (thread, i), "%d %d " % (thread, i) * 200))
+                articles.get("Thread %d article %d" % ((thread + 1) % 8, i))
+                articles.flush()
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=work, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == [] and 0 < articles.size <= 20000
+    # the size kept is the size of the objects on disk
+    assert articles.size == sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(os.path.join(articles.path, "objects")) for name in files)
+
+def test_store_ttl():
+    articles = store.article_store(tempfile.mkdtemp(), ttl=60)
+    articles.put(store.article("Old", "old news"))
+    articles.index["old"]["fetched"] = time.time() - 120
+    assert articles.get("Old") is None
+    assert articles.get("Old", allow_stale=True).content == "old news"
+
+def test_packed_corpus():
+    fixtures = store.fixture_store()
+    # the fixture store's index is written once it is filled, so another process sees every article
+    assert len(store.article_store(fixtures.path, ttl=None, max_bytes=None)) == len(fixtures)
+    path = os.path.join(tempfile.mkdtemp(), "corpus.pack")
+    assert packed.build(path, fixtures) == len(list(qa.stored_articles(fixtures)))
+    corpus = packed.packed_corpus(path)
+    item = corpus.get("mars")
+    original = fixtures.get("Mars", allow_stale=True)
+    assert item.title == original.title and item.content == original.content and item.links == original.links
+    for remove_stop_words in (False, True):
+        ids, counts, total = item.term_counts(remove_stop_words)
+        expected = tokenizer.count(original.content, remove_stop_words)
+        assert ids.dtype == np.uint32 and np.array_equal(ids, expected[0]) and np.array_equal(counts, expected[1]) and total == expected[2]
+    assert corpus.get("Pluto") is None and "MARS" in corpus
+    document.use_corpus(corpus)
+    try:
+        mars = document.document("Mars").pre_compute()
+        assert isinstance(mars.wiki, packed.packed_article)
+        assert abs(mars.term_frequency("mars") - mars.dict["mars"]) < 1e-12 and mars.term_frequency("mars") > 0
+    finally:
+        document.use_corpus(None)
+    empty = os.path.join(tempfile.mkdtemp(), "empty.pack")
+    packed.write_corpus(empty, [])
+    assert len(packed.packed_corpus(empty)) == 0
+
+def test_ingest():
+    import json
+    with open(store.fixture_path) as f:
+        articles = [store.article(**item) for item in json.load(f)]
+    target = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=None)
+    checkpoint = os.path.join(tempfile.mkdtemp(), "ingest.json")
+    # every request fails once, so with one attempt nothing gets through
+    wiki = ingest.local_wiki(articles, failures=1)
+    stats = ingest.ingester(wiki, target, workers=4, rate=None, attempts=1, checkpoint=checkpoint).run(["Mars"], depth=1)
+    assert stats["failed"] == 1 and stats["stored"] == 0 and len(target) == 0
+    # resumed with retries: Mars and the pages it links to that the wiki has ("Earth" is found by searching)
+    stats = ingest.ingester(wiki, target, workers=4, rate=None, attempts=3, backoff=0.001, checkpoint=checkpoint).run(["Mars"], depth=1)
+    assert stats["failed"] == 0 and stats["retries"] > 0
+    assert {"mars", "solar system", "nasa", "asteroid belt", "earth"} <= set(target.index)
+    assert target.get("Earth").title == "Atmosphere of Earth" and "mars rover" in json.load(open(checkpoint))["missing"]
+    # everything is done or known to be missing, so running it again asks the wiki for nothing
+    requests = wiki.requests
+    ingest.ingester(wiki, target, rate=None, checkpoint=checkpoint).run(["Mars"], depth=1)
+    assert wiki.requests == requests
+    # a page that can't be read is recorded as failed, and the others are still fetched
+    class broken_wiki(ingest.local_wiki):
+        def page(self, title):
+            if title == "Moon":
+                raise ValueError("unparseable page")
+            return super().page(title)
+    target = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=None, flush_every=1000)
+    checkpoint = os.path.join(tempfile.mkdtemp(), "ingest.json")
+    runner = ingest.ingester(broken_wiki(articles), target, workers=2, rate=None, checkpoint=checkpoint)
+    stats = runner.run(["Moon", "Mars", "Sun"])
+    assert stats["failed"] == 1 and stats["stored"] == 2 and "ValueError" in runner.failed["moon"]
+    # the checkpoint is never ahead of the store's index on disk
+    assert set(json.load(open(checkpoint))["done"]) <= set(store.article_store(target.path).index)
+    assert ingest.best_result("the sun", ["Sun (disambiguation)", "The  Sun"]) == "The  Sun"
+    bucket = ingest.token_bucket(100, burst=1)
+    start = time.perf_counter()
+    for i in range(6):
+        bucket.take()
+    assert time.perf_counter() - start >= 0.045
+
+def test_index_top_k():
+    corpus = index.corpus_index()
+    corpus.add_terms("a", {"mars": 0.5, "red": 0.5})
+    corpus.add_terms("b", {"mars": 0.2, "moon": 0.8})
+    assert [name for name, score in corpus.top_k("red mars")] == ["a", "b"]
+    # documents can still be added after the index has been queried
+    corpus.add_terms("c", {"moon": 0.9, "phobos": 0.1})
+    assert [name for name, score in corpus.top_k("moon phobos", 2)] == ["c", "b"]
+    assert corpus.top_k("venus") == []
+    # bm25 with the same term counts: the shorter document is the better match
+    corpus.add_counts("long", [tokenizer.intern("moon")], [0.1], 100)
+    corpus.add_counts("short", [tokenizer.intern("moon")], [0.5], 20)
+    scores = corpus.bm25("moon")
+    assert scores[4] > scores[3] > 0 and scores[0] == 0
+
+def test_train_batch():
+    sentences = [["mars", "is", "red"], ["the", "moon", "is", "grey"]] * 20
+    model = word2vec.train(sentences, epochs=1, batch_size=16)
+    assert len(model.centers) == len(model.contexts) == 20 * (6 + 10)
+    first = model.loss
+    model.alpha = 0.05
+    model.train_batch(20, 16, verbose=False)
+    assert model.loss < first
+    # the one-hot examples give the same pairs
+    model.X_train = [[1, 0, 0], [0, 1, 0]]
+    model.y_train = [[0, 1, 1], [1, 0, 0]]
+    assert [pair.tolist() for pair in model.one_hot_pairs()] == [[0, 0, 1], [1, 2, 0]]
+
+def test_objectives():
+    codes, points, lengths = word2vec.huffman_codes([10, 1, 1, 5])
+    assert lengths.tolist() == [1, 3, 3, 2]
+    assert len({tuple(code[:length]) for code, length in zip(codes.tolist(), lengths)}) == 4
+    table = word2vec.alias_table([0.5, 0.25, 0.25, 0])
+    samples = np.bincount(word2vec.alias_sample(table, 20000), minlength=4) / 20000
+    assert np.allclose(samples, [0.5, 0.25, 0.25, 0], atol=0.02)
+    sentences = [["mars", "is", "red"], ["the", "moon", "is", "grey"]] * 20
+    for objective in ("negative", "hierarchical"):
+        model = word2vec.train(sentences, epochs=1, batch_size=16, objective=objective)
+        first = model.loss
+        model.alpha = 0.1
+        model.train_batch(20, 16, verbose=False)
+        assert model.loss < first
+
+def test_parallel_training():
+    directory = tempfile.mkdtemp()
+    file_names = []
+    for i, text in enumerate(["Mars is red. The moon is grey. Mars has two moons.", "The sun is a star. Mars orbits the sun."]):
+        file_names.append(os.path.join(directory, "part%d.txt" % i))
+        with open(file_names[-1], "w") as f:
+            f.write(text)
+    assert word2vec.prep_data(file_names[0]) == [" Mars is red", " The moon is grey", " Mars has two moons"]
+    # sentences that cross a block boundary come out whole
+    assert list(word2vec.read_sentences(file_names, block_size=7)) == [sentence.split() for sentence in ["Mars is red", "The moon is grey", "Mars has two moons", "The sun is star", "Mars orbits the sun"]]
+    words, counts = word2vec.build_vocabulary(file_names, min_count=2, workers=2)
+    assert words[0] == "Mars" and counts[0] == 3 and "star" not in words
+    batches = list(word2vec.skipgram_batches(word2vec.read_sentences(file_names), {word: i for i, word in enumerate(words)}, batch_size=4))
+    assert all(len(centers) == len(contexts) for centers, contexts in batches) and len(batches) > 1
+    model = word2vec.train_parallel(file_names, workers=2, epochs=2, N=8, min_count=1)
+    assert model.pairs == 2 * sum(len(centers) for centers, contexts in word2vec.skipgram_batches(word2vec.read_sentences(file_names), model.word_index))
+    assert model.W.shape == (model.V, 8) and np.abs(model.W_).sum() > 0
+
+def test_most_similar():
+    model = word2vec.word2vec()
+    model.initialize(50, ["w%d" % i for i in range(50)])
+    vectors = model.W / np.linalg.norm(model.W, axis=1, keepdims=True)
+    similarities = vectors @ vectors[7]
+    similarities[7] = -np.inf
+    expected = ["w%d" % i for i in np.argsort(-similarities)[:5]]
+    assert [word for word, similarity in model.most_similar("w7", 5)] == expected
+    batch = model.most_similar_batch(["w7", "unknown", "w3"], 5)
+    assert [word for word, similarity in batch[0]] == expected and batch[1] is None
+    assert model.predict("w7", 3) == ["w%d" % i for i in np.argsort(-(model.W[7] @ model.W_))[:4]]
+    path = tempfile.mkdtemp()
+    model.save(path)
+    loaded = word2vec.load(path)
+    assert isinstance(loaded.W, np.memmap) and loaded.words == model.words
+    assert [word for word, similarity in loaded.most_similar("w7", 5)] == expected
+
+def test_viterbi():
+    import itertools
+    rng = np.random.default_rng(0)
+    transition = np.log(rng.dirichlet(np.ones(3), 3))
+    emission = np.log(rng.dirichlet(np.ones(4), 3))
+    initial = np.log(rng.dirichlet(np.ones(3)))
+    sequences = [[0, 3, 1, 1, 2], [2], [3, 0, 0]]
+    for sequence, states in zip(sequences, tagger.viterbi_batch(sequences, transition, emission, initial)):
+        # brute force over every state sequence
+        def score(path):
+            return initial[path[0]] + emission[path[0], sequence[0]] + sum(transition[a, b] + emission[b, o] for a, b, o in zip(path, path[1:], sequence[1:]))
+        best = max(itertools.product(range(3), repeat=len(sequence)), key=score)
+        assert states.tolist() == list(best)
+        assert tagger.viterbi(sequence, transition, emission, initial).tolist() == list(best)
+    model = tagger.default_tagger()
+    assert model.tag("how far is mars from earth ?".split()) == ["ADV", "ADJ", "VERB", "NOUN", "ADP", "NOUN", "."]
+    assert model.tag(["Mars", "has", "14", "moons"])[2] == "NUM"
+
+def test_intent_classifier():
+    model = intent.intent_classifier().train(intent.read_questions())
+    assert model.classify("how far away is mars from the earth")[:2] == ("Mars", "Distance")
+    assert model.classify("who was the first woman to go to space")[0] == "Space Exploration"
+    path = os.path.join(tempfile.mkdtemp(), "model.npz")
+    model.save(path)
+    loaded = intent.intent_classifier().load(path)
+    assert loaded.classify("how much do astronauts get paid") == model.classify("how much do astronauts get paid")
+
+def test_dialogue_session():
+    state = session.DialogueSession("a", history_length=3)
+    assert len(state) == 0 and "dialogue_state_history" not in state
+    state.update([("dialogue_state_history", ["greetings"]), ("question", "is mars red")])
+    state.update([("dialogue_state_history", ["question", "thinking"])])
+    assert state["dialogue_state_history"][0] == "thinking" and list(state["dialogue_state_history"]) == ["thinking", "question", "greetings"]
+    state.update([("dialogue_state_history", "answer")])
+    assert list(state["dialogue_state_history"]) == ["answer", "thinking", "question"]
+    assert state["question"] == "is mars red" and len(state) == 2
+    manager = session.SessionManager(idle_timeout=60, max_sessions=2)
+    first = manager.get("first")
+    manager.get("second")
+    assert manager.get("first") is first
+    manager.get("third")
+    # second was used least recently
+    assert "second" not in manager and len(manager) == 2
+    assert manager.evict(time.monotonic() + 61) == 2 and len(manager) == 0
+
+def test_answer_engine():
+    engine = qa.answer_engine()
+    for name in ("Mars", "Moon", "Astronaut"):
+        engine.add(document.get_from_wiki(name))
+    # adding an article twice does nothing
+    assert engine.add(document.get_from_wiki("Mars")) == 0
+    answer, score, sources = engine.answer("How many moons does Mars have?")
+    assert "Phobos" in answer and sources[0] == "Mars" and 0 < score <= 1
+    assert engine.answer("who was the first person in space")[0].startswith("Yuri Gagarin")
+    assert engine.answer("zzzz qqqq") is None
+    passages = qa.split_passages("Intro one. Intro two.\n\n== History ==\nOld times.\n== References ==\nA book.")
+    assert passages == [("", ["Intro one.", "Intro two."]), ("History", ["Old times."])]
+
+def test_saved_engine():
+    fixtures = store.article_store(tempfile.mkdtemp(), ttl=None, max_bytes=None)
+    for name in ("Mars", "Moon"):
+        fixtures.put(document.get_from_wiki(name))
+    engine = qa.stored_engine(fixtures)
+    assert engine.titles == {"Mars", "Moon"} and os.path.exists(qa.index_path(fixtures))
+    fixtures.put(document.get_from_wiki("Astronaut"))
+    loaded = qa.stored_engine(fixtures)
+    # only the article stored since was added, and the engine was saved again with it
+    assert loaded.titles == {"Mars", "Moon", "Astronaut"} and len(loaded.keys) == 3
+    assert qa.load_engine(qa.index_path(fixtures)).titles == loaded.titles
+    fresh = qa.answer_engine()
+    fresh.add_stored(fixtures)
+    for question in ("How many moons does Mars have?", "who was the first person in space", "how far is the moon"):
+        assert loaded.answer(question) == fresh.answer(question)
+
+def test_lookup_retries_missing_articles():
+    chatbot = server.chatbot
+    question = "how many moons does mars have?"
+    topic = intent.classify(question)[0]
+    fixtures = document.get_store()
+    chatbot.looked_up.discard(topic)
+    # the article can't be had (an empty store, offline), so the topic isn't marked as read
+    document.use_store(store.article_store(tempfile.mkdtemp(), ttl=None))
+    try:
+        chatbot.lookup(question)
+    finally:
+        document.use_store(fixtures)
+    assert topic not in chatbot.looked_up
+    if chatbot.answers is not None:
+        chatbot.answers.clear()
+    chatbot.lookup(question)
+    assert topic in chatbot.looked_up
+
+def test_answer_cache():
+    cache = answer_cache.answer_cache(max_entries=2, ttl=60)
+    answer = ("Mars has two small moons.", 0.9, ["Mars"])
+    cache.put("how many moons does mars have", "Mars", "Moons", answer, now=0)
+    # the same words in another order and with other stop words
+    assert cache.get("Mars: how many moons does it have?", "Mars", "Moons", now=1) == answer
+    cache.put("are all asteroids in the asteroid belt", "Solar System", "Asteroid Belt", ("No.", 1.0, []), now=0)
+    assert cache.get("are all asteroids found in the asteroid belt", "Solar System", "Asteroid Belt", now=1) == ("No.", 1.0, [])
+    assert cache.similar_hits == 1
+    assert cache.get("how many moons does mars have", "Mars", "Size", now=1) is None
+    assert cache.get("how big is mars", "Mars", "Moons", now=1) is None
+    # expired
+    assert cache.get("how many moons does mars have", "Mars", "Moons", now=61) is None and len(cache) == 1
+    cache.clear()
+    cache.put("what is an asteroid", "Asteroid", "", ("a rock", 1.0, []), now=0)
+    cache.put("is mars red", "Mars", "", ("yes", 1.0, []), now=0)
+    cache.get("what is an asteroid", "Asteroid", "", now=1)
+    cache.put("is the moon grey", "Moon", "", ("yes", 1.0, []), now=0)
+    # is mars red was used least recently
+    assert cache.get("is mars red", "Mars", "", now=1) is None and cache.evicted == 1
+    path = os.path.join(tempfile.mkdtemp(), "answers.json")
+    cache.ttl = None
+    cache.save(path)
+    loaded = answer_cache.answer_cache(ttl=None).load(path)
+    assert loaded.get("what is an asteroid?", "Asteroid", "") == ["a rock", 1.0, []]
+    # questions that differ only in a question word or a negation aren't the same question
+    cache = answer_cache.answer_cache()
+    cache.put("who was the first person on the moon", "Moon", "Landing", ("Neil Armstrong.", 1.0, []))
+    assert cache.get("when was the first person on the moon", "Moon", "Landing") is None
+    assert cache.get("Who was the first person on the Moon?", "Moon", "Landing") == ("Neil Armstrong.", 1.0, [])
+    cache.put("is there life on mars", "Mars", "Life", ("Not that we know of.", 1.0, []))
+    assert cache.get("is there no life on mars", "Mars", "Life") is None and cache.similar_hits == 0
+    assert answer_cache.normalize("which planet has no atmosphere") == answer_cache.normalize("what planet has no atmosphere")
+    # a prepared question is looked up the same way, and the bound similar uses never rules out a pair that is similar
+    asked = answer_cache.prepare("are all asteroids in the asteroid belt")
+    cache.put(asked, "Solar System", "Asteroid Belt", ("No.", 1.0, []))
+    assert cache.get(answer_cache.prepare("are all asteroids found in the asteroid belt"), "Solar System", "Asteroid Belt") == ("No.", 1.0, [])
+    assert cache.similar_hits == 1
+    questions = [answer_cache.prepare(row[0]) for row in intent.read_questions()[:100]]
+    for a in questions:
+        for b in questions:
+            assert answer_cache.bound(a, b) >= answer_cache.similarity(a, b) - 1e-6
+
+def test_templates():
+    table = templates.template_table({
+        "moons": ["<planet> has <count> <count:moon/moons>.", "<A kind> orbits <planet>."],
+        "answer": ["<answer>"],
+    }, select="rotate")
+    assert table.render("moons", [("planet", "Mars"), ("count", 2), ("kind", "asteroid")]) == "Mars has 2 moons."
+    assert table.render("moons", {"planet": "Mars", "kind": "asteroid"}) == "An asteroid orbits Mars."
+    assert table.render("moons", {"planet": "Earth", "count": 1}) == "Earth has 1 moon."
+    assert table.render("answer") == ""
+    assert [templates.article(word) for word in ("orbit", "unicorn", "hour", "rover", "European")] == ["an", "a", "an", "a", "a"]
+    assert templates.compile_template("I found <count> <count:source/sources>") == ["I found ", ("value", "count", None), " ", ("plural", "count", ("source", "sources"))]
+    picks = {templates.template_table({"hi": ["a", "b"]}, seed=seed).render("hi") for seed in range(20)}
+    assert picks == {"a", "b"}
+
+def test_dialogue_policy():
+    rows = {(state, intent): next_state for state, intent, next_state in policy.transitions}
+    walked = set()
+    for state in policy.states:
+        for intent in policy.intents + ("something new",):
+            expected = rows.get((state, intent), rows.get(("*", intent), rows[(state, "*")]))
+            conversation = session.DialogueSession()
+            conversation.update([("dialogue_state_history", [state]), ("user_intent_history", [intent]), ("sources", ["Mars", "Moon"])])
+            next_state, slots = server.chatbot.dialogue_policy(conversation)
+            assert next_state == expected, (state, intent, next_state)
+            assert conversation["dialogue_state_history"][0] == next_state
+            walked.add((state, intent))
+            if next_state == "sources":
+                assert dict(slots) == {"sources": "Mars and Moon", "count": 2}
+    # every row of the table was walked
+    assert all(state == "*" or intent == "*" or (state, intent) in walked for state, intent in rows)
+    assert server.chatbot.dialogue_policy(session.DialogueSession())[0] == "greetings"
+    # an answer that wasn't found has no sources to give
+    conversation = session.DialogueSession()
+    conversation.update([("dialogue_state_history", ["answer"]), ("user_intent_history", ["learn_more"]), ("sources", [])])
+    next_state, slots = server.chatbot.dialogue_policy(conversation)
+    assert next_state == "no_sources" and server.chatbot.nlg(next_state, slots) == "I couldn't find a source for that."
+    # a state only a guard leads to is still reachable
+    policy.state_machine([("a", "*", "b"), ("b", "*", "a"), ("c", "*", "a")], ["a", "b", "c"], "a", guards={"b": (bool, "c")})
+    # a state that can't be reached, or that has no way out, is caught when the table is compiled
+    for broken in ([("a", "*", "a"), ("b", "*", "a")], [("a", "x", "b"), ("b", "*", "a")], [("a", "*", "c")]):
+        try:
+            policy.state_machine(broken, ["a", "b"], "a")
+            assert False, broken
+        except ValueError:
+            pass
+
+def test_replay():
+    report = replay.run(6, memory=False)
+    assert report["conversations"] == 6 and report["turns"] == report["stages"]["turn"]["count"] > 0
+    assert report["stages"]["lookup"]["count"] >= 6
+    for stage in replay.stages:
+        assert sum(report["stages"][stage]["histogram"]) == report["stages"][stage]["count"]
+    slower = dict(report, turns_per_second=report["turns_per_second"] / 2)
+    assert replay.compare(report, report) == [] and replay.compare(report, slower) == ["turns/s"]
+
+def test_lazy_start():
+    import sys
+    import subprocess
+    script = "import importlib, sys; importlib.import_module('Astro-chatbot'); print('wikipedia' in sys.modules)"
+    loaded = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    assert loaded.stdout.strip() == "False"
+    warming = server.chatbot.start_warm_up()
+    assert server.chatbot.start_warm_up() is warming
+    warming.join(60)
+    assert tagger.default is not None and intent.default is not None and qa.default is not None
+
+def test_tracing():
+    import asyncio
+    assert tracing.span("off") is tracing.nothing
+    times = tracing.histogram()
+    for ms in range(1, 1001):
+        times.add(ms / 1000)
+    # interpolated within the bucket, the percentiles are close to the exact ones
+    assert abs(times.percentile(50) - 0.5) < 0.01 and abs(times.percentile(99) - 0.99) < 0.02 and times.percentile(100) == 1.0
+    tracing.reset()
+    tracing.enable(True, profile_slow=0.0, profile_rate=1.0)
+    try:
+        server.chatbot.nlu("how far is mars from earth?", session.DialogueSession())
+        server.chatbot.lookup("how far is mars from earth?")
+        server.chatbot.lookup("how far is mars from earth?")
+        document.get_from_wiki("Mars")
+        snapshot = tracing.snapshot()
+        chat = server.chat_server(workers=1)
+        status, metrics = asyncio.run(chat.http_response("GET", "/metrics", b""))
+        chat.lookups.shutdown()
+        tracing.reset()
+    finally:
+        tracing.enable(False)
+        tracing.profile_slow = None
+    assert status == "200 OK" and metrics["tracing"]["spans"]["lookup"]["count"] == 2
+    for name in ("nlu", "parse", "lookup", "get_from_wiki"):
+        assert snapshot["spans"][name]["count"] >= 1, name
+    assert snapshot["spans"]["lookup"]["count"] == 2 and snapshot["counters"]["lookup.cache_hit"] >= 1
+    assert snapshot["counters"]["get_from_wiki.stored"] >= 1
+    # every lookup was profiled, and kept, with a threshold of 0
+    assert snapshot["profiles"] and snapshot["profiles"][0]["span"] == "lookup" and "function calls" in snapshot["profiles"][0]["stats"]
+    assert tracing.snapshot()["spans"] == {}
+
+def test_lookup_scheduler():
+    import threading
+    release = threading.Event()
+    calls = []
+
+    def blocked_lookup(question):
+        calls.append(question)
+        release.wait(5)
+        return question.upper()
+
+    lookups = scheduler.lookup_scheduler(blocked_lookup, workers=1, timeout=5)
+    first = lookups.submit("is mars red?")
+    # the same question, written differently, shares the lookup
+    assert lookups.submit("Is  Mars red") is first and lookups.deduplicated == 1
+    queued = lookups.submit("what is an asteroid?")
+    # nobody else waits for the queued question, so it is cancelled before it runs
+    lookups.cancel("what is an asteroid?", queued)
+    assert queued.cancelled() and lookups.cancelled == 1
+    # one of the two callers gives up, the other still gets the answer
+    assert lookups.result("is mars red?", first, timeout=0.01) is None and not first.cancelled()
+    release.set()
+    assert lookups.result("is mars red?", first) == "IS MARS RED?"
+    assert calls == ["is mars red?"] and lookups.stats()["pending"] == 0
+    expired = lookups.submit("how far is mars?", timeout=-1)
+    assert lookups.result("how far is mars?", expired) is None and lookups.expired == 1
+    lookups.shutdown()
+    # a lookup that raises gives None too, and nothing is left pending
+    failing = scheduler.lookup_scheduler(lambda question: {}[question], workers=1)
+    assert failing.lookup("is mars red?") is None and failing.stats()["pending"] == 0
+    failing.shutdown()
+
+def test_chat_server():
+    import json
+    import asyncio
+
+    errors = []
+
+    async def talk():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        chat = server.chat_server(workers=2)
+        line, http = await chat.start(port=0, http_port=0)
+        reader, writer = await asyncio.open_connection(*line.sockets[0].getsockname()[:2])
+        await reader.readuntil(b"\n\n")
+        writer.write(b"hello\nhow far is mars from earth?\n")
+        await reader.readuntil(b"\n\n")
+        replies = (await reader.readuntil(b"\n\n")).decode().split("\n")[:-2]
+        writer.close()
+        # thinking, then the answer, in the same turn
+        assert len(replies) == 2
+        # a line over the stream limit ends the conversation
+        reader, writer = await asyncio.open_connection(*line.sockets[0].getsockname()[:2])
+        await reader.readuntil(b"\n\n")
+        writer.write(b"x" * (100 * 1024) + b"\n")
+        assert await reader.read() == b""
+        writer.close()
+        reader, writer = await asyncio.open_connection(*http.sockets[0].getsockname()[:2])
+        responses = []
+        for body in ({"message": "hello"}, {"message": "is there life on mars?"}):
+            if responses:
+                body["session"] = responses[-1]["session"]
+            data = json.dumps(body).encode()
+            writer.write(b"POST /chat HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(data) + data)
+            headers = await reader.readuntil(b"\r\n\r\n")
+            length = int(headers.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            responses.append(json.loads(await reader.readexactly(length)))
+        # a body over max_body is refused, and the connection closed
+        writer.write(b"POST /chat HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % (server.max_body + 1))
+        refused = await reader.read()
+        assert refused.startswith(b"HTTP/1.1 413 ") and b"Connection: close" in refused
+        writer.close()
+        for listening in (line, http):
+            listening.close()
+        chat.lookups.shutdown()
+        return responses
+
+    first, second = asyncio.run(talk())
+    assert errors == []
+    assert len(first["replies"]) == 2 and first["state"] == "question"
+    assert second["session"] == first["session"] and second["state"] == "answer" and len(second["replies"]) == 2
+
+    async def failing_lookup():
+        chat = server.chat_server(workers=1)
+        chat.lookups.function = lambda question: {}[question]
+        status, reply = await chat.http_response("POST", "/chat", b'{"message": "how far is mars from earth?"}')
+        chat.lookups.shutdown()
+        return status, reply
+
+    # a lookup that raises ends the turn with the fallback answer instead of dropping the connection
+    status, reply = asyncio.run(failing_lookup())
+    assert status == "200 OK" and reply["state"] == "answer" and reply["replies"][-1] == server.chatbot.no_answer
+    # a session id that isn't a string is refused rather than crashing the handler
+    chat = server.chat_server(workers=1)
+    for body in (b'{"session": [1]}', b'{"session": {}}', b'{"session": 7, "message": "hi"}'):
+        assert asyncio.run(chat.http_response("POST", "/chat", body))[0] == "400 Bad Request"
+    chat.lookups.shutdown()
+
+
+if __name__ == '__main__':
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+    print("ok")
@@ -0,0 +1,79 @@
+import re
+from collections import Counter
+import numpy as np
+from word2vec import stop_words
+
+# Tokenizer
+# Turns text into a stream of normalized terms in a single pass: text is case folded and has its apostrophes
+# dropped ("Earth's" -> "earths", like the question keywords csv spells it), one compiled regex finds the
+# words, and stop words are optionally skipped. Terms are interned into a process-wide term table so
+# documents, the corpus index and the models can all refer to a term by the same integer id.
+
+word_pattern = re.compile(r"[^\W_]+")
+whitespace = re.compile(r"\s")
+apostrophes = str.maketrans("", "", "'’")
+stop_set = frozenset(stop_words)
+chunk_size = 64 * 1024
+
+# process-wide term table: term_ids maps a term to its id, term_list maps an id back to its term
+term_ids = {}
+term_list = []
+
+def normalize(word):
+    return word.translate(apostrophes).casefold()
+
+# chunks(text): Splits text into pieces of about chunk_size characters, cutting only at whitespace so no
+#               word is split in two. text may also be any iterable of strings (e.g. the lines of a file).
+def chunks(text):
+    if not isinstance(text, str):
+        yield from text
+        return
+    start = 0
+    while start < len(text):
+        end = start + chunk_size
+        if end < len(text):
+            space = whitespace.search(text, end)
+            end = len(text) if space is None else space.start()
+        yield text[start:end]
+        start = end
+
+# chunk_terms(chunk, remove_stop_words): The normalized terms of one chunk as a list. Normalizing the whole
+#                                        chunk at once and letting findall build the list keeps the per-word
+#                                        work in C.
+def chunk_terms(chunk, remove_stop_words=False):
+    terms = word_pattern.findall(normalize(chunk))
+    if remove_stop_words:
+        terms = [term for term in terms if term not in stop_set]
+    return terms
+
+# tokens(text, remove_stop_words): Yields the normalized terms of text a chunk at a time, so memory use stays
+#                                  bounded by the chunk size instead of the size of the text.
+def tokens(text, remove_stop_words=False):
+    for chunk in chunks(text):
+        yield from chunk_terms(chunk, remove_stop_words)
+
+# intern(term): The id of term in the term table, adding it if it's new.
+def intern(term):
+    term_id = term_ids.get(term)
+    if term_id is None:
+        term_id = term_ids[term] = len(term_list)
+        term_list.append(term)
+    return term_id
+
+# lookup(term): The id of term, or -1 if it has never been seen. Unlike intern this doesn't grow the table,
+#               so it is what queries should use.
+def lookup(term):
+    return term_ids.get(term, -1)
+
+# count(text, remove_stop_words): Counts the terms of text in one pass.
+# Returns: (term ids, counts, total) where term ids is a sorted uint32 array, counts the matching uint32
+#          array of occurrences and total the number of terms counted.
+def count(text, remove_stop_words=False):
+    # Counter counts the strings in C; only the distinct terms then go through the term table
+    counts = Counter()
+    for chunk in chunks(text):
+        counts.update(chunk_terms(chunk, remove_stop_words))
+    ids = np.fromiter(map(intern, counts), dtype=np.uint32, count=len(counts))
+    values = np.fromiter(counts.values(), dtype=np.uint32, count=len(counts))
+    order = np.argsort(ids)
+    return ids[order], values[order], int(values.sum())
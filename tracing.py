@@ -0,0 +1,185 @@
+import io
+import os
+import time
+import random
+import bisect
+import pstats
+import cProfile
+import functools
+import threading
+from collections import deque
+
+# Tracing
+# Shows where the time of a turn goes. The stages of the pipeline (fetching an article, pre_compute, parse,
+# nlu, lookup, nlg, ...) are spans, timed with the monotonic perf_counter and added to a histogram per span
+# name; counters count things that happen (an article found in the store, an answer found in the cache):
+#
+#   with tracing.span("qa.answer"):     times a block
+#   @tracing.traced("nlu")              times every call of a function
+#   tracing.count("lookup.cache_hit")   adds to a counter
+#   tracing.snapshot()                  everything recorded so far, as a dict of plain values
+#
+# Tracing is off unless enabled (with enable(), or the ASTRO_TRACE environment variable). Off, a span is one
+# check of a module global and a shared do-nothing context manager, so the hooks can stay in the code.
+#
+# Spans can also be profiled: with a slow threshold set (enable(profile_slow=...) or ASTRO_PROFILE_SLOW, in
+# seconds), a sample of the spans started with profile=True (profile_rate of them) run under cProfile, and the
+# profile of any that take longer than the threshold is kept (the last max_profiles of them) in the snapshot.
+# One span is profiled at a time, across all threads.
+
+enabled = os.environ.get("ASTRO_TRACE", "") not in ("", "0")
+# seconds a profiled span must take for its profile to be kept, None to never profile
+profile_slow = float(os.environ["ASTRO_PROFILE_SLOW"]) if os.environ.get("ASTRO_PROFILE_SLOW") else None
+# fraction of profile=True spans that are profiled
+profile_rate = float(os.environ.get("ASTRO_PROFILE_RATE", "0.1"))
+max_profiles = 10
+
+# upper bounds of the histogram buckets, in microseconds: 20 to a factor of ten from 1us to 10s, each about
+# 12% wider than the one before, so percentiles stay close enough to compare runs by; the last bucket holds
+# everything slower
+bucket_bounds = tuple(float("%.3g" % 10 ** (i / 20)) for i in range(7 * 20 + 1))
+
+class histogram:
+    def __init__(self):
+        self.counts = [0] * (len(bucket_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(bucket_bounds, seconds * 1e6)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # percentile(q): The q-th percentile in seconds, interpolated within the bucket it falls in as if the times
+    #                in it were spread evenly; the slowest time for the last bucket.
+    def percentile(self, q):
+        rank = q / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if bucket == len(bucket_bounds):
+                    return self.max
+                lower = bucket_bounds[bucket - 1] if bucket else 0.0
+                value = lower + (bucket_bounds[bucket] - lower) * (rank - seen) / count
+                return min(value / 1e6, self.max)
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {"count": self.count, "total_ms": self.total * 1000, "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+                "p50_ms": self.percentile(50) * 1000, "p90_ms": self.percentile(90) * 1000, "p99_ms": self.percentile(99) * 1000,
+                "max_ms": self.max * 1000, "histogram": list(self.counts)}
+
+lock = threading.Lock()
+histograms = {}
+counters = {}
+profiles = deque(maxlen=max_profiles)
+# held by the span being profiled
+profiling = threading.Lock()
+
+# enable(on, profile_slow, profile_rate): Turns tracing on (or off), and sets the profiling settings given.
+def enable(on=True, profile_slow=None, profile_rate=None):
+    global enabled
+    enabled = on
+    if profile_slow is not None:
+        globals()["profile_slow"] = profile_slow
+    if profile_rate is not None:
+        globals()["profile_rate"] = profile_rate
+
+def observe(name, seconds):
+    with lock:
+        found = histograms.get(name)
+        if found is None:
+            found = histograms[name] = histogram()
+        found.add(seconds)
+
+def count(name, n=1):
+    if enabled:
+        with lock:
+            counters[name] = counters.get(name, 0) + n
+
+class null_span:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+nothing = null_span()
+
+class timed_span:
+    __slots__ = ("name", "profile", "profiler", "start")
+
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+        self.profiler = None
+
+    def __enter__(self):
+        if self.profile and profile_slow is not None and random.random() < profile_rate and profiling.acquire(blocking=False):
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        if self.profiler is not None:
+            self.profiler.disable()
+            profiling.release()
+            if seconds >= profile_slow:
+                keep_profile(self.name, seconds, self.profiler)
+        observe(self.name, seconds)
+        return False
+
+# span(name, profile): A context manager timing its block into the histogram of name (if tracing is on).
+def span(name, profile=False):
+    if not enabled:
+        return nothing
+    return timed_span(name, profile)
+
+# traced(name, profile): Decorator timing every call of a function as a span (named after the function by
+#                        default).
+def traced(name=None, profile=False):
+    def decorate(function):
+        span_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with timed_span(span_name, profile):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def keep_profile(name, seconds, profiler, lines=25):
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats("cumulative").print_stats(lines)
+    with lock:
+        profiles.append({"span": name, "ms": seconds * 1000, "time": time.time(), "stats": text.getvalue()})
+
+# snapshot(reset): Everything recorded so far: {"spans": {name: summary}, "counters": {name: n},
+#                  "profiles": [...]}, as plain values that can be written out as json. With reset, starts
+#                  recording afresh.
+def snapshot(reset=False):
+    with lock:
+        result = {"enabled": enabled, "spans": {name: found.summary() for name, found in sorted(histograms.items())},
+                  "counters": dict(sorted(counters.items())), "profiles": list(profiles), "bucket_bounds_us": list(bucket_bounds)}
+        if reset:
+            clear()
+    return result
+
+def clear():
+    histograms.clear()
+    counters.clear()
+    profiles.clear()
+
+def reset():
+    with lock:
+        clear()
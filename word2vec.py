@@ -1,7 +1,13 @@
 # This implementation from geeks for geeks:
 #https://www.geeksforgeeks.org/implement-your-own-word2vecskip-gram-model-in-python/
 
+import os
 import re
+import json
+import heapq
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 #from nltk.corpus import stopwords
 
@@ -10,6 +16,81 @@ def softmax(x):
     """Compute softmax values for each sets of scores in x."""
     e_x = np.exp(x - np.max(x)) 
     return e_x / e_x.sum()
+
+def softmax_rows(x):
+    """Compute softmax values for every row of x, and the log of each row's normalizer."""
+    x_max = np.max(x, axis=1, keepdims=True)
+    e_x = np.exp(x - x_max)
+    total = e_x.sum(axis=1, keepdims=True)
+    return e_x / total, (np.log(total) + x_max)[:, 0]
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-np.clip(x, -30, 30)))
+
+# alias_table(probabilities): Vose's alias method, so drawing from a discrete distribution over V outcomes
+#                             costs O(1) per sample instead of a search through the cumulative distribution.
+# Returns: (accept, alias) arrays; outcome i is kept with probability accept[i], otherwise alias[i] is drawn.
+def alias_table(probabilities):
+    V = len(probabilities)
+    scaled = np.asarray(probabilities, dtype=np.float64) * V / np.sum(probabilities)
+    accept = np.ones(V)
+    alias = np.arange(V)
+    small = [i for i in range(V) if scaled[i] < 1]
+    large = [i for i in range(V) if scaled[i] >= 1]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        accept[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1 - scaled[less]
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    return accept, alias
+
+def alias_sample(table, size):
+    accept, alias = table
+    outcomes = np.random.randint(len(accept), size=size)
+    return np.where(np.random.random_sample(size) < accept[outcomes], outcomes, alias[outcomes])
+
+# huffman_codes(counts): Builds a Huffman tree over the vocabulary, frequent words getting the shortest codes.
+# Returns: (codes, points, lengths) where row w of codes holds the left/right turns (0/1) from the root to word
+#          w, row w of points the inner nodes passed on the way (0..V-2), both padded to the longest code, and
+#          lengths the length of each word's code.
+def huffman_codes(counts):
+    V = len(counts)
+    heap = [(int(count), i) for i, count in enumerate(counts)]
+    heapq.heapify(heap)
+    parent = np.zeros(2 * V - 1, dtype=np.int64)
+    branch = np.zeros(2 * V - 1, dtype=np.int8)
+    node = V
+    while len(heap) > 1:
+        count_left, left = heapq.heappop(heap)
+        count_right, right = heapq.heappop(heap)
+        parent[left], parent[right] = node, node
+        branch[right] = 1
+        heapq.heappush(heap, (count_left + count_right, node))
+        node += 1
+    root = node - 1
+    paths = []
+    for word in range(V):
+        code, points = [], []
+        current = word
+        while current != root:
+            code.append(branch[current])
+            current = parent[current]
+            points.append(current - V)
+        paths.append((code[::-1], points[::-1]))
+    longest = max(len(code) for code, points in paths) if V > 1 else 0
+    codes = np.zeros((V, longest), dtype=np.int8)
+    points = np.zeros((V, longest), dtype=np.int64)
+    lengths = np.zeros(V, dtype=np.int64)
+    for word, (code, point) in enumerate(paths):
+        codes[word, :len(code)] = code
+        points[word, :len(point)] = point
+        lengths[word] = len(code)
+    return codes, points, lengths
+
 # Variables: 
 # V    Number of unique words in our corpus of text ( Vocabulary )
 # x    Input layer (One hot encoding of our input word ). 
@@ -24,13 +105,29 @@ class word2vec:
         self.y_train = []
         self.window_size = 2
         self.alpha = 0.001
+        self.batch_size = 128
         self.words = []
         self.word_index = {}
+        # training pairs as integer word indices, used by train_batch instead of the one-hot X_train/y_train
+        self.centers = np.zeros(0, dtype=np.int64)
+        self.contexts = np.zeros(0, dtype=np.int64)
+        # training objective of train_batch:
+        # 'softmax'         full softmax over the vocabulary, O(V*N) per pair
+        # 'negative'        skip-gram with negative sampling, the context word against `negative` words drawn
+        #                   from the unigram distribution raised to the 3/4 power, O(negative*N) per pair
+        # 'hierarchical'    hierarchical softmax over a Huffman tree of the vocabulary, O(log(V)*N) per pair
+        self.objective = "softmax"
+        self.negative = 5
+        # how often each word occurs, for the negative sampler and the Huffman tree (counted from the
+        # training pairs if not set)
+        self.word_counts = None
+        self.W_norm = None
     
     def initialize(self,V,data):
         self.V = V
         self.W = np.random.uniform(-0.8, 0.8, (self.V, self.N))
         self.W_ = np.random.uniform(-0.8, 0.8, (self.N, self.V))
+        self.W_norm = None
         self.words = data
         for i in range(len(data)):
             self.word_index[data[i]] = i
@@ -78,30 +175,211 @@ class word2vec:
                 self.loss += C*np.log(np.sum(np.exp(self.u)))
             print("Epoch ",x," with loss= ",self.loss)
             self.alpha *= 1/((1+self.alpha*x))
+        self.W_norm = None
+
+    # skipgram_pairs(sentences): Sets the training pairs to every (centre, context) pair of word indices within
+    #                            window_size of each other in sentences (lists of words). Unknown words are
+    #                            dropped first.
+    def skipgram_pairs(self, sentences):
+        centers = []
+        contexts = []
+        for sentence in sentences:
+            indices = np.array([self.word_index[word] for word in sentence if word in self.word_index], dtype=np.int64)
+            for offset in range(1, self.window_size + 1):
+                if offset >= len(indices):
+                    break
+                centers += [indices[:-offset], indices[offset:]]
+                contexts += [indices[offset:], indices[:-offset]]
+        self.centers = np.concatenate(centers) if centers else np.zeros(0, dtype=np.int64)
+        self.contexts = np.concatenate(contexts) if contexts else np.zeros(0, dtype=np.int64)
+        return self.centers, self.contexts
+
+    # one_hot_pairs(): Sets the training pairs from the one-hot X_train and multi-hot y_train examples.
+    def one_hot_pairs(self):
+        centers = np.argmax(np.asarray(self.X_train), axis=1)
+        rows, self.contexts = np.nonzero(np.asarray(self.y_train))
+        self.centers = centers[rows]
+        return self.centers, self.contexts
+
+    # train_batch(epochs, batch_size): Trains on the index pairs in minibatches with the selected objective.
+    # Instead of multiplying one-hot vectors, the hidden layer of a batch is a row gather from W, and the
+    # gradient for W only touches the rows of the centre words in the batch.
+    def train_batch(self, epochs, batch_size=None, verbose=True):
+        batch_size = batch_size or self.batch_size
+        step = self.step_function()
+        self.prepare_objective()
+        n = len(self.centers)
+        for x in range(1, epochs + 1):
+            self.loss = 0
+            order = np.random.permutation(n)
+            for start in range(0, n, batch_size):
+                batch = order[start:start + batch_size]
+                self.loss += self.train_step(step, self.centers[batch], self.contexts[batch])
+            if verbose:
+                print("Epoch ",x," with loss= ",self.loss)
+            self.alpha *= 1/((1+self.alpha*x))
+        self.W_norm = None
+
+    # train_step(step, centers, contexts): Trains on one batch of pairs and returns its loss.
+    def train_step(self, step, centers, contexts):
+        h = self.W[centers]
+        loss, derivative_h = step(h, contexts)
+        # a centre word can appear more than once in a batch, np.add.at accumulates those rows
+        np.add.at(self.W, centers, -self.alpha * derivative_h)
+        return loss
+
+    def step_function(self):
+        return {"softmax": self.softmax_step, "negative": self.negative_step, "hierarchical": self.hierarchical_step}[self.objective]
+
+    # prepare_objective(): Builds the sampler or tree the objective needs, once per vocabulary.
+    def prepare_objective(self):
+        if self.objective == "softmax":
+            return
+        if self.word_counts is None or len(self.word_counts) != self.V:
+            self.word_counts = np.bincount(np.concatenate([self.centers, self.contexts]), minlength=self.V)
+        if self.objective == "negative" and getattr(self, "sampler_counts", None) is not self.word_counts:
+            self.sampler = alias_table(np.power(self.word_counts + 1e-3, 0.75))
+            self.sampler_counts = self.word_counts
+        if self.objective == "hierarchical" and getattr(self, "tree_counts", None) is not self.word_counts:
+            self.codes, self.points, self.code_lengths = huffman_codes(self.word_counts)
+            # one output vector per inner node of the tree, starting at zero like the original word2vec
+            self.W_tree = np.zeros((max(self.V - 1, 1), self.N))
+            self.tree_counts = self.word_counts
+
+    # Each step takes the hidden layer h (batch x N) and the context words of a batch, updates the output
+    # weights and returns the loss and the derivative of the loss with respect to h.
+    def softmax_step(self, h, contexts):
+        rows = np.arange(len(contexts))
+        u = h @ self.W_
+        y, log_normalizer = softmax_rows(u)
+        loss = float(np.sum(log_normalizer - u[rows, contexts]))
+        # the error is y minus the one-hot label, without ever building the label
+        y[rows, contexts] -= 1
+        derivative_h = y @ self.W_.T
+        self.W_ -= self.alpha * (h.T @ y)
+        return loss, derivative_h
+
+    def negative_step(self, h, contexts):
+        # column 0 is the real context word, the rest are the sampled negatives
+        targets = np.empty((len(contexts), self.negative + 1), dtype=np.int64)
+        targets[:, 0] = contexts
+        targets[:, 1:] = alias_sample(self.sampler, (len(contexts), self.negative))
+        output = self.W_.T
+        vectors = output[targets]
+        scores = np.einsum("bn,bkn->bk", h, vectors)
+        labels = np.zeros_like(scores)
+        labels[:, 0] = 1
+        probabilities = sigmoid(scores)
+        loss = -float(np.sum(np.log(np.where(labels == 1, probabilities, 1 - probabilities) + 1e-10)))
+        error = probabilities - labels
+        derivative_h = np.einsum("bk,bkn->bn", error, vectors)
+        np.add.at(output, targets, -self.alpha * error[:, :, None] * h[:, None, :])
+        return loss, derivative_h
+
+    def hierarchical_step(self, h, contexts):
+        points = self.points[contexts]
+        mask = np.arange(points.shape[1]) < self.code_lengths[contexts][:, None]
+        # a 0 in the code means turning left at that node, which the model predicts with sigmoid(score)
+        labels = 1 - self.codes[contexts]
+        vectors = self.W_tree[points]
+        scores = np.einsum("bn,bln->bl", h, vectors)
+        probabilities = sigmoid(scores)
+        loss = -float(np.sum(mask * np.log(np.where(labels == 1, probabilities, 1 - probabilities) + 1e-10)))
+        error = (probabilities - labels) * mask
+        derivative_h = np.einsum("bl,bln->bn", error, vectors)
+        np.add.at(self.W_tree, points, -self.alpha * error[:, :, None] * h[:, None, :])
+        return loss, derivative_h
 
     def predict(self,word,num_predictions):
-        if word in self.words:
+        if word in self.word_index:
             index = self.word_index[word]
-            X = [0 for i in range(self.V)]
-            X[index] = 1
-            prediction = self.feed_forward(X)
-            output = {}
-            for i in range(self.V):
-                output[prediction[i][0]] = i
-            top_context_words = []
-            for k in sorted(output,reverse=True):
-                top_context_words.append(self.words[output[k]])
-                if(len(top_context_words)>num_predictions):
-                    break
-            return top_context_words
+            # the one-hot product W.T x is just row index of W
+            u = self.W[index] @ self.W_
+            return [self.words[i] for i in top_indices(u, num_predictions + 1)]
         else:
             print("Word not found in dictionary")
 
+    # vectors(): The rows of W scaled to unit length, so cosine similarity is a dot product. Computed once
+    #            after training (or loaded from disk) and reused by every query.
+    def vectors(self):
+        if self.W_norm is None or len(self.W_norm) != self.V:
+            norms = np.linalg.norm(self.W, axis=1, keepdims=True)
+            self.W_norm = (self.W / np.maximum(norms, 1e-12)).astype(np.float32)
+        return self.W_norm
+
+    # most_similar(word, k): The k words whose embeddings are closest to word's by cosine similarity, as a list
+    #                        of (word, similarity), most similar first. Returns None for unknown words.
+    def most_similar(self, word, k=10):
+        return self.most_similar_batch([word], k)[0]
+
+    # most_similar_batch(words, k): most_similar for many words at once, with one matrix product for all of
+    #                               them. Returns a list with an entry per word.
+    def most_similar_batch(self, words, k=10):
+        vectors = self.vectors()
+        known = [self.word_index[word] for word in words if word in self.word_index]
+        similarities = vectors[known] @ vectors.T
+        # the word itself would always come out on top
+        similarities[np.arange(len(known)), known] = -np.inf
+        best = top_indices(similarities, k)
+        results = iter([[(self.words[j], float(similarities[row, j])) for j in best[row]] for row in range(len(known))])
+        return [next(results) if word in self.word_index else None for word in words]
+
+    # save(path): Writes the model to the directory path: the weights as .npy files that load can memory-map,
+    #             and the vocabulary as a text file with one word per line.
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "W.npy"), self.W)
+        np.save(os.path.join(path, "W_.npy"), self.W_)
+        np.save(os.path.join(path, "vectors.npy"), self.vectors())
+        with open(os.path.join(path, "vocab.txt"), "w") as f:
+            f.write("\n".join(self.words))
+        with open(os.path.join(path, "model.json"), "w") as f:
+            json.dump({"N": self.N, "window_size": self.window_size, "objective": self.objective}, f)
+
+# top_indices(scores, k): Indices of the k largest scores (of each row, for a 2d array), largest first. Uses
+#                         np.argpartition so only the k best are sorted.
+def top_indices(scores, k):
+    k = min(k, scores.shape[-1])
+    if k == 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    best = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(scores, best, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(best, order, axis=-1)
+
+# load(path, mmap_mode): Reads a model written by word2vec.save. The weights are memory-mapped by default, so
+#                        loading is instant and processes sharing a model share its pages.
+def load(path, mmap_mode="r"):
+    model = word2vec()
+    with open(os.path.join(path, "model.json")) as f:
+        settings = json.load(f)
+    model.N = settings["N"]
+    model.window_size = settings["window_size"]
+    model.objective = settings["objective"]
+    with open(os.path.join(path, "vocab.txt")) as f:
+        model.words = f.read().split("\n")
+    model.word_index = {word: i for i, word in enumerate(model.words)}
+    model.V = len(model.words)
+    model.W = np.load(os.path.join(path, "W.npy"), mmap_mode=mmap_mode)
+    model.W_ = np.load(os.path.join(path, "W_.npy"), mmap_mode=mmap_mode)
+    model.W_norm = np.load(os.path.join(path, "vectors.npy"), mmap_mode=mmap_mode)
+    return model
+
 
 # TODO implement word2vec
 #https://towardsdatascience.com/a-word2vec-implementation-using-numpy-and-python-d256cf0e5f28
 
-stop_words = []
+# english stop words, the same list as nltk's stopwords.words('english') without the contractions
+stop_words = ["i", "me", "my", "myself", "we", "our", "ours", "ourselves", "you", "your", "yours",
+              "yourself", "yourselves", "he", "him", "his", "himself", "she", "her", "hers", "herself", "it",
+              "its", "itself", "they", "them", "their", "theirs", "themselves", "what", "which", "who",
+              "whom", "this", "that", "these", "those", "am", "is", "are", "was", "were", "be", "been",
+              "being", "have", "has", "had", "having", "do", "does", "did", "doing", "a", "an", "the", "and",
+              "but", "if", "or", "because", "as", "until", "while", "of", "at", "by", "for", "with", "about",
+              "against", "between", "into", "through", "during", "before", "after", "above", "below", "to",
+              "from", "up", "down", "in", "out", "on", "off", "over", "under", "again", "further", "then",
+              "once", "here", "there", "when", "where", "why", "how", "all", "any", "both", "each", "few",
+              "more", "most", "other", "some", "such", "no", "nor", "not", "only", "own", "same", "so",
+              "than", "too", "very", "s", "t", "can", "will", "just", "don", "should", "now"]
 
 #word_to_index : A dictionary mapping each word to an integer value
 # {‘modern’: 0, ‘humans’: 1} 
@@ -110,27 +388,165 @@ stop_words = []
 #corpus : The entire data consisting of all the words 
 #vocab_size : Number of unique words in the corpus
 
-# Input: a bunch of tuples of words
-def train():
-    pass
+# Input: a bunch of tuples of words, i.e. sentences
+# Returns: a word2vec model trained on them with minibatches
+def train(sentences, epochs=5, batch_size=128, N=10, objective="softmax"):
+    sentences = [list(sentence) for sentence in sentences]
+    words = sorted({word for sentence in sentences for word in sentence})
+    model = word2vec()
+    model.N = N
+    model.objective = objective
+    model.initialize(len(words), words)
+    model.skipgram_pairs(sentences)
+    model.train_batch(epochs, batch_size)
+    return model
 
 # Prep the data for training
+# Returns: every sentence of the file as a string of its words, each preceded by a space
 def prep_data(file_name, stop_word_removal='no'):
-    file_contents = []
-    with open(file_name) as f:
-        file_contents = f.read()
-    text = []
-    for val in file_contents.split('.'):
-        sent = re.findall("[A-Za-z]+", val)
-        line = ''
-        for words in sent:
-            
-            if stop_word_removal == 'yes': 
-                if len(words) > 1 and words not in stop_words:
-                    line = line + ' ' + words
-            else:
-                if len(words) > 1 :
-                    line = line + ' ' + words
-        text.append(line)
-    return text
-    pass
+    return [''.join(' ' + word for word in sentence) for sentence in read_sentences([file_name], stop_word_removal)]
+
+# read_sentences(file_names, stop_word_removal): Yields the sentences of many files as lists of words, reading
+#                                                each file a block at a time instead of all at once.
+#                                                Sentences end at '.', words are runs of letters longer than
+#                                                one character.
+def read_sentences(file_names, stop_word_removal='no', block_size=1024*1024):
+    words_pattern = re.compile("[A-Za-z]+")
+    stop_set = frozenset(stop_words) if stop_word_removal == 'yes' else frozenset()
+    for file_name in file_names:
+        with open(file_name) as f:
+            rest = ''
+            while True:
+                block = f.read(block_size)
+                # the last piece of a block may be a sentence that continues in the next block
+                pieces = (rest + block).split('.')
+                rest = pieces.pop() if block else ''
+                for piece in pieces + ([rest] if not block else []):
+                    sentence = [word for word in words_pattern.findall(piece) if len(word) > 1 and word not in stop_set]
+                    if sentence:
+                        yield sentence
+                if not block:
+                    break
+
+def count_file(args):
+    file_name, stop_word_removal = args
+    counts = Counter()
+    for sentence in read_sentences([file_name], stop_word_removal):
+        counts.update(sentence)
+    return counts
+
+# build_vocabulary(file_names, min_count, workers): Counts the words of every file in a pool of worker
+#                                                   processes and keeps the words seen at least min_count
+#                                                   times.
+# Returns: (words, counts) with the most frequent words first.
+def build_vocabulary(file_names, min_count=5, workers=None, stop_word_removal='no'):
+    counts = Counter()
+    jobs = [(file_name, stop_word_removal) for file_name in file_names]
+    if workers == 1 or len(jobs) < 2:
+        results = list(map(count_file, jobs))
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(count_file, jobs))
+    for file_counts in results:
+        counts.update(file_counts)
+    kept = [(word, count) for word, count in counts.most_common() if count >= min_count]
+    return [word for word, count in kept], np.array([count for word, count in kept], dtype=np.int64)
+
+# skipgram_batches(sentences, word_index, window_size, batch_size): Yields (centers, contexts) arrays of word
+#                                                                  indices of about batch_size pairs, generated
+#                                                                  lazily from a stream of sentences.
+def skipgram_batches(sentences, word_index, window_size=2, batch_size=256):
+    centers, contexts, pending = [], [], 0
+    for sentence in sentences:
+        indices = np.array([word_index[word] for word in sentence if word in word_index], dtype=np.int64)
+        for offset in range(1, min(window_size, len(indices) - 1) + 1):
+            centers += [indices[:-offset], indices[offset:]]
+            contexts += [indices[offset:], indices[:-offset]]
+            pending += 2 * (len(indices) - offset)
+        if pending >= batch_size:
+            yield np.concatenate(centers), np.concatenate(contexts)
+            centers, contexts, pending = [], [], 0
+    if pending:
+        yield np.concatenate(centers), np.concatenate(contexts)
+
+# Hogwild training
+# Every worker process trains on its own share of the sentences and updates the same weight matrices (W, W_
+# and, for hierarchical softmax, W_tree) in shared memory without any locking. Updates for different words rarely touch the same rows, so the occasional lost
+# update costs less than serializing the workers would.
+
+def shared_array(shape):
+    memory = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+    return memory, np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+
+def shared_matrices(model):
+    return ["W", "W_", "W_tree"] if model.objective == "hierarchical" else ["W", "W_"]
+
+def hogwild_worker(args):
+    model, shared, file_names, worker, workers, epochs, batch_size = args
+    memories = []
+    try:
+        for attribute, name, shape in shared:
+            memories.append(shared_memory.SharedMemory(name=name))
+            setattr(model, attribute, np.ndarray(shape, dtype=np.float64, buffer=memories[-1].buf))
+        np.random.seed(worker)
+        step = model.step_function()
+        model.prepare_objective()
+        loss, pairs = 0.0, 0
+        for x in range(1, epochs + 1):
+            # each worker takes every workers-th sentence, so the work is shared even with a single file
+            sentences = (sentence for i, sentence in enumerate(read_sentences(file_names)) if i % workers == worker)
+            for centers, contexts in skipgram_batches(sentences, model.word_index, model.window_size, batch_size):
+                loss += model.train_step(step, centers, contexts)
+                pairs += len(centers)
+            model.alpha *= 1/((1+model.alpha*x))
+        return loss, pairs
+    finally:
+        for attribute, name, shape in shared:
+            setattr(model, attribute, None)
+        for memory in memories:
+            memory.close()
+
+# train_parallel(file_names, workers, epochs, ...): Builds the vocabulary of the files in parallel and trains a
+#                                                   model on them with Hogwild across worker processes.
+# Returns: the trained model; model.loss and model.pairs hold the total loss and number of pairs trained.
+def train_parallel(file_names, workers=4, epochs=1, batch_size=256, N=100, min_count=5, objective="negative"):
+    words, counts = build_vocabulary(file_names, min_count, workers)
+    model = word2vec()
+    model.N = N
+    model.objective = objective
+    model.initialize(len(words), words)
+    model.word_counts = counts
+    if objective != "softmax":
+        # the sampled objectives start the way the original word2vec does: small input weights, zero output
+        # weights and a larger learning rate
+        model.alpha = 0.025
+        model.W = np.random.uniform(-0.5 / N, 0.5 / N, (model.V, N))
+        model.W_ = np.zeros((N, model.V))
+    # the sampler or tree is built once here and sent to every worker
+    model.prepare_objective()
+    memories = []
+    matrices = {}
+    try:
+        shared = []
+        for attribute in shared_matrices(model):
+            matrix = getattr(model, attribute)
+            memory, array = shared_array(matrix.shape)
+            array[:] = matrix
+            memories.append(memory)
+            matrices[attribute] = matrix
+            shared.append((attribute, memory.name, matrix.shape))
+            setattr(model, attribute, None)
+        jobs = [(model, shared, file_names, worker, workers, epochs, batch_size) for worker in range(workers)]
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(hogwild_worker, jobs))
+        for (attribute, name, shape), memory in zip(shared, memories):
+            matrices[attribute][:] = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    finally:
+        for attribute, matrix in matrices.items():
+            setattr(model, attribute, matrix)
+        for memory in memories:
+            memory.close()
+            memory.unlink()
+    model.loss = sum(loss for loss, pairs in results)
+    model.pairs = sum(pairs for loss, pairs in results)
+    return model